@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+分批 UPDATE 批大小/延迟调优
+以 WbMaterialIns_UPDATE_Optimized_V2_Batch.sql 的分批更新为对象，
+每批提交后从数据库快照还原(或在回滚事务内)按网格或自适应搜索批大小和批间延迟，
+测量总耗时、每批延迟、锁升级次数以及并发读请求被阻塞的程度，
+在给定阻塞预算内推荐吞吐量最高的设置
+"""
+
+import json
+import re
+import threading
+import time
+from datetime import datetime
+
+from db_connection import connect
+from param_binding import substitute_literals
+from query_watchdog import StatementWatchdog, timeout_message
+from timing_harness import percentile
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+TARGET_DATABASE = 'logistics-test'
+TARGET_TABLE = '[logistics-test].dbo.WbMaterialIns'
+BATCH_SCRIPT = 'UPDATE-ins优化/WbMaterialIns_UPDATE_Optimized_V2_Batch.sql'
+
+# snapshot: 每批自动提交(与生产一致)，试验结束后从数据库快照还原，需独占目标库；推荐以此模式为准
+# rollback: 所有批次在一个事务内执行后回滚，行锁从第一批一直持有到回滚，读阻塞等于整个试验时长，
+#           批间延迟只会拉长阻塞，因此不做延迟扫描，阻塞指标也不能与 snapshot 模式比较
+TUNE_MODES = ('snapshot', 'rollback')
+DEFAULT_BATCH_SIZES = (1000, 2500, 5000, 10000, 20000)
+DEFAULT_DELAYS_MS = (0, 50, 100, 250)
+
+# 与脚本的 UPDATE TOP / DELETE TOP 语义一致，但两句按 Id 顺序取同一批行
+BATCH_UPDATE_SQL = f"""
+WITH batch AS (SELECT TOP (?) Id FROM #ToUpdate ORDER BY Id)
+UPDATE ins
+SET ReceivingDailyReportID = NULL
+FROM {TARGET_TABLE} ins
+INNER JOIN batch ON ins.Id = batch.Id
+"""
+
+BATCH_DELETE_SQL = """
+WITH batch AS (SELECT TOP (?) Id FROM #ToUpdate ORDER BY Id)
+DELETE FROM batch
+"""
+
+# 并发读：与更新范围相同的区间扫描，遇到未提交的行锁即被阻塞
+READER_SQL = f"""
+SELECT COUNT(*) FROM {TARGET_TABLE}
+WHERE TenantId = ? AND SiteDate >= DATEADD(MONTH, -2, CAST(? AS DATE))
+"""
+
+# 索引级锁升级累计次数，取试验前后差值
+LOCK_PROMOTION_SQL = f"""
+SELECT ISNULL(SUM(index_lock_promotion_count), 0), ISNULL(SUM(index_lock_promotion_attempt_count), 0)
+FROM sys.dm_db_index_operational_stats(DB_ID('{TARGET_DATABASE}'), OBJECT_ID('{TARGET_TABLE}'), NULL, NULL)
+"""
+
+
+def load_batch_script(path=BATCH_SCRIPT):
+    """
+    解析分批脚本，返回 {'stage_sql', 'index_sql', 'batch_size', 'delay_ms'}
+
+    stage_sql 为 Step 1 生成 #ToUpdate 的语句，batch_size/delay_ms 为脚本当前写死的值
+    """
+    with open(path, encoding='utf-8-sig') as f:
+        script = f.read()
+    stage = re.search(r'SELECT\s+ins\.Id\s+INTO\s+#ToUpdate\b.*?;', script, re.I | re.S)
+    index = re.search(r'CREATE\s+CLUSTERED\s+INDEX\s+\w+\s+ON\s+#ToUpdate\s*\(\s*Id\s*\)\s*;', script, re.I)
+    batch_size = re.search(r'@BatchSize\s+INT\s*=\s*(\d+)', script, re.I)
+    delay = re.search(r"WAITFOR\s+DELAY\s+'(\d+):(\d+):(\d+)(?:\.(\d+))?'", script, re.I)
+    if not stage:
+        raise ValueError(f"未找到生成 #ToUpdate 的语句: {path}")
+
+    delay_ms = None
+    if delay:
+        hours, minutes, seconds = (int(delay.group(i)) for i in (1, 2, 3))
+        fraction = (delay.group(4) or '0').ljust(3, '0')[:3]
+        delay_ms = ((hours * 60 + minutes) * 60 + seconds) * 1000 + int(fraction)
+    return {
+        'stage_sql': stage.group(0),
+        'index_sql': index.group(0) if index else 'CREATE CLUSTERED INDEX IX_ToUpdate ON #ToUpdate(Id);',
+        'batch_size': int(batch_size.group(1)) if batch_size else None,
+        'delay_ms': delay_ms
+    }
+
+
+def limit_stage(stage_sql, row_limit):
+    """只取前 row_limit 行做试验，缩短大表上单次试验的时间"""
+    if not row_limit:
+        return stage_sql
+    return re.sub(r'SELECT\s+ins\.Id', f'SELECT TOP ({int(row_limit)}) ins.Id', stage_sql, count=1, flags=re.I)
+
+
+class _Reader(threading.Thread):
+    """并发读线程：独立自动提交连接，循环执行区间扫描并记录每次延迟"""
+
+    def __init__(self, index, params, stop, interval_ms=50):
+        super().__init__(name=f'reader-{index:02d}', daemon=True)
+        self.params = params
+        self.stop = stop
+        self.interval_ms = interval_ms
+        self.latencies = []
+        self.errors = 0
+        self.conn = connect(DEFAULT_DATABASE, autocommit=True)
+
+    def probe(self):
+        cursor = self.conn.cursor()
+        started = time.perf_counter()
+        try:
+            cursor.execute(READER_SQL, self.params['TenantID'], self.params['ReportDate'])
+            cursor.fetchall()
+        finally:
+            cursor.close()
+        return (time.perf_counter() - started) * 1000
+
+    def run(self):
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.latencies.append(self.probe())
+                except Exception:
+                    self.errors += 1
+                self.stop.wait(self.interval_ms / 1000)
+        finally:
+            self.conn.close()
+
+
+def measure_reader_baseline(params, probes=10):
+    """无写入时读请求的中位延迟，作为阻塞计算的基线"""
+    reader = _Reader(0, params, threading.Event())
+    try:
+        latencies = sorted(reader.probe() for _ in range(probes))
+    finally:
+        reader.conn.close()
+    return round(percentile(latencies, 50), 1)
+
+
+def summarize_readers(readers, baseline_ms):
+    """读请求延迟超出基线的部分视为被阻塞时间"""
+    latencies = sorted(lat for reader in readers for lat in reader.latencies)
+    stalls = sorted(max(0.0, lat - baseline_ms) for lat in latencies)
+    return {
+        'probes': len(latencies),
+        'errors': sum(reader.errors for reader in readers),
+        'p95_ms': round(percentile(latencies, 95), 1) if latencies else None,
+        'blocked_probes': sum(1 for stall in stalls if stall > baseline_ms),
+        'blocked_ms': round(sum(stalls), 1),
+        'stall_p95_ms': round(percentile(stalls, 95), 1) if stalls else 0.0,
+        'max_stall_ms': round(stalls[-1], 1) if stalls else 0.0
+    }
+
+
+def _lock_promotions(monitor):
+    cursor = monitor.cursor()
+    try:
+        cursor.execute(LOCK_PROMOTION_SQL)
+        promotions, attempts = cursor.fetchone()
+    finally:
+        cursor.close()
+    return promotions, attempts
+
+
+def create_snapshot(database=TARGET_DATABASE):
+    """为目标库创建数据库快照，快照文件与数据文件同目录"""
+    snapshot = f"{database}_tuner_ss"
+    conn = connect('master', autocommit=True)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT name, physical_name FROM sys.master_files WHERE database_id = DB_ID(?) AND type = 0",
+                       database)
+        files = ', '.join(f"(NAME = [{name}], FILENAME = '{path}.tuner_ss')" for name, path in cursor.fetchall())
+        cursor.execute(f"CREATE DATABASE [{snapshot}] ON {files} AS SNAPSHOT OF [{database}]")
+    finally:
+        cursor.close()
+        conn.close()
+    return snapshot
+
+
+def revert_snapshot(snapshot, database=TARGET_DATABASE):
+    """从快照还原目标库(断开其他连接)"""
+    conn = connect('master', autocommit=True)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"ALTER DATABASE [{database}] SET SINGLE_USER WITH ROLLBACK IMMEDIATE")
+        try:
+            cursor.execute(f"RESTORE DATABASE [{database}] FROM DATABASE_SNAPSHOT = '{snapshot}'")
+        finally:
+            cursor.execute(f"ALTER DATABASE [{database}] SET MULTI_USER")
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def drop_snapshot(snapshot):
+    conn = connect('master', autocommit=True)
+    try:
+        conn.cursor().execute(f"DROP DATABASE [{snapshot}]")
+    finally:
+        conn.close()
+
+
+def run_trial(script, params, batch_size, delay_ms, mode='snapshot', readers=2, row_limit=None,
+              baseline_ms=0.0, timeout_ms=None, snapshot=None):
+    """
+    以给定批大小和延迟执行一次完整的分批更新
+
+    返回总耗时、吞吐量、每批延迟百分位、锁升级次数和并发读阻塞统计；
+    试验出错只记入 error 并照常还原快照，快照还原失败则向上抛出
+    """
+    result = {'batch_size': batch_size, 'delay_ms': delay_ms, 'mode': mode, 'rows': 0, 'batches': 0,
+              'timed_out': False, 'error': None, 'blocking_comparable': mode == 'snapshot'}
+    stop = threading.Event()
+    reader_threads = []
+    writer = monitor = cursor = None
+    try:
+        writer = connect(DEFAULT_DATABASE, autocommit=(mode == 'snapshot'))
+        monitor = connect(DEFAULT_DATABASE, autocommit=True)
+        cursor = writer.cursor()
+        cursor.execute(substitute_literals(limit_stage(script['stage_sql'], row_limit), params))
+        cursor.execute(script['index_sql'])
+        cursor.execute("SELECT COUNT(*) FROM #ToUpdate")
+        result['total_rows'] = cursor.fetchone()[0]
+
+        promotions_before, attempts_before = _lock_promotions(monitor)
+        reader_threads = [_Reader(i, params, stop) for i in range(readers)]
+        for reader in reader_threads:
+            reader.start()
+
+        batch_ms = []
+        started = time.perf_counter()
+        while True:
+            batch_started = time.perf_counter()
+            with StatementWatchdog(cursor, timeout_ms) as watchdog:
+                try:
+                    cursor.execute(BATCH_UPDATE_SQL, batch_size)
+                    updated = cursor.rowcount
+                    cursor.execute(BATCH_DELETE_SQL, batch_size)
+                    removed = cursor.rowcount
+                except Exception as e:
+                    result['error'] = str(e)
+                    break
+            if watchdog.fired:
+                result['timed_out'] = True
+                result['error'] = timeout_message(watchdog.fired_at_ms)
+                break
+            if removed <= 0:
+                break
+            batch_ms.append((time.perf_counter() - batch_started) * 1000)
+            result['rows'] += max(updated, 0)
+            result['batches'] += 1
+            if delay_ms:
+                time.sleep(delay_ms / 1000)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        promotions_after, attempts_after = _lock_promotions(monitor)
+    except Exception as e:
+        # 单个批大小/延迟设置失败只记入本次试验，不中断整个搜索
+        result['error'] = str(e)
+        return result
+    finally:
+        # 先回滚释放锁，再停止读线程，被阻塞的读请求随之结束并计入统计
+        if mode == 'rollback' and writer is not None:
+            writer.rollback()
+        stop.set()
+        for reader in reader_threads:
+            reader.join()
+        for resource in (cursor, writer, monitor):
+            if resource is not None:
+                resource.close()
+        if mode == 'snapshot' and snapshot:
+            revert_snapshot(snapshot)
+
+    batch_ms.sort()
+    result.update({
+        'elapsed_ms': round(elapsed_ms, 1),
+        'rows_per_s': round(result['rows'] / (elapsed_ms / 1000), 1) if elapsed_ms > 0 else None,
+        'batch_p50_ms': round(percentile(batch_ms, 50), 1) if batch_ms else None,
+        'batch_p95_ms': round(percentile(batch_ms, 95), 1) if batch_ms else None,
+        'batch_max_ms': round(batch_ms[-1], 1) if batch_ms else None,
+        'lock_escalations': promotions_after - promotions_before,
+        'lock_escalation_attempts': attempts_after - attempts_before,
+        'readers': summarize_readers(reader_threads, baseline_ms)
+    })
+    return result
+
+
+def within_budget(trial, blocking_budget_ms):
+    """读请求阻塞的 p95 不超过预算，且试验本身没有失败"""
+    return not trial['error'] and trial['readers']['stall_p95_ms'] <= blocking_budget_ms
+
+
+def grid_search(script, params, batch_sizes=DEFAULT_BATCH_SIZES, delays_ms=DEFAULT_DELAYS_MS, **trial_options):
+    """批大小 × 延迟全组合逐一试验"""
+    trials = []
+    for delay_ms in delays_ms:
+        for batch_size in batch_sizes:
+            trial = run_trial(script, params, batch_size, delay_ms, **trial_options)
+            print_trial(trial)
+            trials.append(trial)
+    return trials
+
+
+def adaptive_search(script, params, blocking_budget_ms, delays_ms=DEFAULT_DELAYS_MS, start=1000, max_batch=50000,
+                    refine_steps=2, **trial_options):
+    """
+    每个延迟下从 start 起倍增批大小直到超出阻塞预算(或吞吐不再提升)，
+    再在最后一个合格值和第一个超预算值之间二分 refine_steps 次
+    """
+    trials = []
+
+    def attempt(batch_size, delay_ms):
+        trial = run_trial(script, params, batch_size, delay_ms, **trial_options)
+        print_trial(trial)
+        trials.append(trial)
+        return trial
+
+    for delay_ms in delays_ms:
+        good, bad, best_rate = None, None, 0.0
+        batch_size = start
+        while batch_size <= max_batch:
+            trial = attempt(batch_size, delay_ms)
+            if not within_budget(trial, blocking_budget_ms):
+                bad = batch_size
+                break
+            good = batch_size
+            if (trial['rows_per_s'] or 0) <= best_rate:
+                break
+            best_rate = trial['rows_per_s'] or 0
+            batch_size *= 2
+
+        for _ in range(refine_steps if good and bad else 0):
+            middle = (good + bad) // 2
+            if middle in (good, bad):
+                break
+            if within_budget(attempt(middle, delay_ms), blocking_budget_ms):
+                good = middle
+            else:
+                bad = middle
+    return trials
+
+
+def recommend(trials, blocking_budget_ms):
+    """预算内吞吐量最高的设置；吞吐量相近(5%以内)时取阻塞更少者"""
+    eligible = [t for t in trials if within_budget(t, blocking_budget_ms) and t['rows_per_s']]
+    if not eligible:
+        return None
+    top_rate = max(t['rows_per_s'] for t in eligible)
+    near_top = [t for t in eligible if t['rows_per_s'] >= top_rate * 0.95]
+    best = min(near_top, key=lambda t: (t['readers']['stall_p95_ms'], t['lock_escalations'], -t['rows_per_s']))
+    return {'batch_size': best['batch_size'], 'delay_ms': best['delay_ms'], 'rows_per_s': best['rows_per_s'],
+            'stall_p95_ms': best['readers']['stall_p95_ms'], 'lock_escalations': best['lock_escalations']}
+
+
+def tune(params, blocking_budget_ms=200, search='grid', mode='snapshot', readers=2, row_limit=None,
+         timeout_ms=None, path=BATCH_SCRIPT, **search_options):
+    """
+    调优入口：search 为 'grid' 或 'adaptive'，返回全部试验和推荐设置
+
+    rollback 模式只扫描批大小(延迟固定为0)，推荐结果仅供参考
+    """
+    if mode not in TUNE_MODES:
+        raise ValueError(f"未知模式: {mode}")
+    if mode == 'rollback':
+        search_options['delays_ms'] = (0,)
+    script = load_batch_script(path)
+    baseline_ms = measure_reader_baseline(params)
+    print(f"[*] 脚本当前设置: 批大小 {script['batch_size']}, 延迟 {script['delay_ms']} ms")
+    print(f"[*] 读请求基线延迟 {baseline_ms} ms, 阻塞预算 p95 ≤ {blocking_budget_ms} ms, 模式 {mode}")
+
+    snapshot = create_snapshot() if mode == 'snapshot' else None
+    trial_options = {'mode': mode, 'readers': readers, 'row_limit': row_limit, 'baseline_ms': baseline_ms,
+                     'timeout_ms': timeout_ms, 'snapshot': snapshot}
+    try:
+        if search == 'adaptive':
+            trials = adaptive_search(script, params, blocking_budget_ms, **search_options, **trial_options)
+        else:
+            trials = grid_search(script, params, **search_options, **trial_options)
+    except BaseException:
+        # 走到这里说明快照还原失败或调优被中断，目标库可能仍带着试验提交的更新，快照是唯一的还原手段
+        if snapshot:
+            print(f"[!] 调优中止，已保留快照 [{snapshot}]，确认后执行 "
+                  f"RESTORE DATABASE [{TARGET_DATABASE}] FROM DATABASE_SNAPSHOT = '{snapshot}' 还原，再删除快照")
+        raise
+    if snapshot:
+        drop_snapshot(snapshot)
+
+    current = [t for t in trials if t['batch_size'] == script['batch_size'] and t['delay_ms'] == script['delay_ms']]
+    return {
+        'mode': mode,
+        'blocking_comparable': mode == 'snapshot',
+        'search': search,
+        'blocking_budget_ms': blocking_budget_ms,
+        'reader_baseline_ms': baseline_ms,
+        'script_settings': {'batch_size': script['batch_size'], 'delay_ms': script['delay_ms']},
+        'script_settings_trial': current[0] if current else None,
+        'trials': trials,
+        'recommended': recommend(trials, blocking_budget_ms)
+    }
+
+
+def print_trial(trial):
+    label = f"批 {trial['batch_size']:>6,} / 延迟 {trial['delay_ms']:>4} ms"
+    if trial['error']:
+        print(f"[-] {label}: {trial['error']}")
+        return
+    readers = trial['readers']
+    print(f"[+] {label}: {trial['rows']:,} 行 / {trial['batches']} 批, 总耗时 {trial['elapsed_ms']:,.0f} ms, "
+          f"{trial['rows_per_s'] or 0:,.0f} 行/秒, 每批 p95 {trial['batch_p95_ms']} ms, "
+          f"锁升级 {trial['lock_escalations']} 次, 读阻塞 p95 {readers['stall_p95_ms']} ms "
+          f"(最长 {readers['max_stall_ms']} ms)")
+
+
+def main():
+    params = {'TenantID': 1, 'ReportDate': datetime(2025, 11, 30)}
+
+    print("=" * 60)
+    print("WbMaterialIns 分批更新 批大小/延迟调优")
+    print("=" * 60)
+
+    report = tune(params, blocking_budget_ms=200, search='grid', mode='snapshot', timeout_ms=300000)
+    if not report['blocking_comparable']:
+        print("\n[!] rollback 模式下锁持有到最终回滚，读阻塞反映的是整个试验时长而不是单批，推荐仅供参考")
+
+    best = report['recommended']
+    if best:
+        print(f"\n[+] 推荐: @BatchSize = {best['batch_size']}, WAITFOR DELAY {best['delay_ms']} ms "
+              f"({best['rows_per_s']:,.0f} 行/秒, 读阻塞 p95 {best['stall_p95_ms']} ms)")
+    else:
+        print("\n[!] 没有满足阻塞预算的设置，可放宽预算或增大延迟")
+
+    output_file = f"batch_update_tuning_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump({'test_date': datetime.now().isoformat(), 'params': params, **report},
+                  f, ensure_ascii=False, indent=2, default=str)
+    print(f"[+] 结果已保存: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
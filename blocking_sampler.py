@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+阻塞与等待采样
+测试运行期间由后台线程按固定间隔轮询
+sys.dm_exec_requests / sys.dm_os_waiting_tasks / sys.dm_tran_locks，
+记录阻塞链、头阻塞者、等待类型和锁资源，并标记当时正在测试的存储过程和轮次
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from db_connection import connect
+
+# 一次往返返回三个结果集：活动请求(含阻塞者会话信息)、等待任务、等待中及阻塞者持有的锁
+SAMPLE_SQL = """
+SET NOCOUNT ON;
+SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED;
+
+SELECT r.session_id, r.blocking_session_id, r.status, r.command, DB_NAME(r.database_id) AS database_name,
+       r.wait_type, r.wait_time AS wait_time_ms, r.wait_resource, r.total_elapsed_time AS elapsed_ms,
+       OBJECT_NAME(st.objectid, st.dbid) AS object_name,
+       SUBSTRING(st.text, r.statement_start_offset / 2 + 1,
+                 (CASE WHEN r.statement_end_offset = -1 THEN DATALENGTH(st.text)
+                       ELSE r.statement_end_offset END - r.statement_start_offset) / 2 + 1) AS statement_text
+FROM sys.dm_exec_requests r
+OUTER APPLY sys.dm_exec_sql_text(r.sql_handle) st
+WHERE r.session_id <> @@SPID AND r.session_id > 50
+UNION ALL
+-- 没有活动请求但持有锁的头阻塞者(例如未提交事务的空闲会话)
+SELECT s.session_id, 0, s.status, NULL, DB_NAME(s.database_id), NULL, NULL, NULL, NULL, NULL,
+       LEFT(st.text, 4000)
+FROM sys.dm_exec_sessions s
+INNER JOIN sys.dm_exec_connections c ON c.session_id = s.session_id
+OUTER APPLY sys.dm_exec_sql_text(c.most_recent_sql_handle) st
+WHERE s.session_id IN (SELECT blocking_session_id FROM sys.dm_exec_requests WHERE blocking_session_id > 0)
+  AND NOT EXISTS (SELECT 1 FROM sys.dm_exec_requests r2 WHERE r2.session_id = s.session_id);
+
+SELECT wt.session_id, wt.wait_type, wt.wait_duration_ms, wt.blocking_session_id, wt.resource_description
+FROM sys.dm_os_waiting_tasks wt
+WHERE wt.session_id > 50 AND wt.session_id <> @@SPID;
+
+SELECT l.request_session_id AS session_id, l.resource_type, DB_NAME(l.resource_database_id) AS database_name,
+       l.resource_associated_entity_id AS entity_id, l.resource_description, l.request_mode, l.request_status
+FROM sys.dm_tran_locks l
+WHERE l.request_status <> 'GRANT'
+   OR l.request_session_id IN (SELECT blocking_session_id FROM sys.dm_exec_requests WHERE blocking_session_id > 0);
+"""
+
+# 与分析报告中等待统计查询保持一致的良性等待
+BENIGN_WAITS = {
+    'CLR_SEMAPHORE', 'LAZYWRITER_SLEEP', 'RESOURCE_QUEUE', 'SLEEP_TASK', 'SLEEP_SYSTEMTASK',
+    'SQLTRACE_BUFFER_FLUSH', 'WAITFOR', 'LOGMGR_QUEUE', 'CHECKPOINT_QUEUE', 'REQUEST_FOR_DEADLOCK_SEARCH',
+    'XE_TIMER_EVENT', 'BROKER_TO_FLUSH', 'BROKER_TASK_STOP', 'CLR_MANUAL_EVENT', 'CLR_AUTO_EVENT',
+    'DISPATCHER_QUEUE_SEMAPHORE', 'FT_IFTS_SCHEDULER_IDLE_WAIT', 'XE_DISPATCHER_WAIT', 'XE_DISPATCHER_JOIN',
+    'SQLTRACE_INCREMENTAL_FLUSH_SLEEP'
+}
+
+
+def _rows_as_dicts(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def build_blocking_chains(requests):
+    """由请求的 blocking_session_id 关系构造阻塞链，返回 {头阻塞者: [被阻塞会话(按层级展开)]}"""
+    blocked_by = {r['session_id']: r['blocking_session_id'] for r in requests
+                  if r['blocking_session_id'] and r['blocking_session_id'] != r['session_id']}
+    children = {}
+    for session, blocker in blocked_by.items():
+        children.setdefault(blocker, []).append(session)
+
+    chains = {}
+    for blocker in children:
+        # 头阻塞者：阻塞了别人，自己没有被阻塞(或处于环中，取最小会话号打断)
+        head, seen = blocker, set()
+        while head in blocked_by and head not in seen:
+            seen.add(head)
+            head = blocked_by[head]
+        if head in seen:
+            head = min(seen)
+        if head in chains:
+            continue
+
+        ordered, pending, visited = [], list(children.get(head, [])), {head}
+        while pending:
+            session = pending.pop(0)
+            if session in visited:
+                continue
+            visited.add(session)
+            ordered.append(session)
+            pending.extend(children.get(session, []))
+        chains[head] = ordered
+    return chains
+
+
+class BlockingSampler(threading.Thread):
+    """
+    后台采样线程，使用独立连接(不干扰被测会话)
+
+    用法:
+        sampler = BlockingSampler(interval_ms=500)
+        sampler.start()
+        with sampler.active('dbo.CashFlowBalance', round_no=1):
+            ...
+        sampler.stop()
+        summary = sampler.summarize()
+    """
+
+    def __init__(self, database='master', interval_ms=500):
+        super().__init__(name='blocking-sampler', daemon=True)
+        self.database = database
+        self.interval_ms = interval_ms
+        self.samples = []
+        self.errors = 0
+        self._tag = None
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def watch_session(self, conn, label=None):
+        """登记被测会话的 SPID，采样时可识别它是被阻塞方还是阻塞方"""
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT @@SPID")
+            spid = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        with self._lock:
+            self._watched[spid] = label or spid
+        return spid
+
+    @contextmanager
+    def active(self, procedure, round_no=None):
+        """标记当前正在测试的存储过程和轮次"""
+        with self._lock:
+            previous, self._tag = self._tag, {'procedure': procedure, 'round': round_no}
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._tag = previous
+
+    def sample_once(self, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(SAMPLE_SQL)
+            requests = _rows_as_dicts(cursor)
+            cursor.nextset()
+            waiting_tasks = _rows_as_dicts(cursor)
+            cursor.nextset()
+            locks = _rows_as_dicts(cursor)
+        finally:
+            cursor.close()
+
+        with self._lock:
+            tag = dict(self._tag) if self._tag else None
+            watched = dict(self._watched)
+
+        return {
+            'time': datetime.now().isoformat(),
+            'tag': tag,
+            'chains': {str(head): sessions for head, sessions in build_blocking_chains(requests).items()},
+            'requests': [r for r in requests if r['wait_type'] not in BENIGN_WAITS],
+            'waiting_tasks': [w for w in waiting_tasks if w['wait_type'] not in BENIGN_WAITS],
+            'locks': locks,
+            'watched': {str(spid): label for spid, label in watched.items()
+                        if any(r['session_id'] == spid for r in requests)}
+        }
+
+    def run(self):
+        conn = connect(self.database, autocommit=True)
+        try:
+            while not self._stop_event.is_set():
+                started = time.perf_counter()
+                try:
+                    sample = self.sample_once(conn)
+                    with self._lock:
+                        self.samples.append(sample)
+                except Exception:
+                    self.errors += 1
+                remaining = self.interval_ms / 1000 - (time.perf_counter() - started)
+                self._stop_event.wait(max(remaining, 0))
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def summarize(self):
+        """按测试对象汇总：等待类型、头阻塞者、被等待的锁资源、被测会话被阻塞的次数"""
+        with self._lock:
+            samples = list(self.samples)
+            watched = dict(self._watched)
+
+        groups = {}
+        for sample in samples:
+            tag = sample['tag'] or {'procedure': None, 'round': None}
+            key = f"{tag['procedure'] or '(空闲)'}#{tag['round'] if tag['round'] is not None else '-'}"
+            group = groups.setdefault(key, {
+                'procedure': tag['procedure'], 'round': tag['round'], 'samples': 0,
+                'blocked_samples': 0, 'watched_blocked_samples': 0, 'max_chain_length': 0,
+                'waits': {}, 'head_blockers': {}, 'lock_resources': {}
+            })
+            group['samples'] += 1
+            if sample['chains']:
+                group['blocked_samples'] += 1
+                group['max_chain_length'] = max(group['max_chain_length'],
+                                                max(len(s) for s in sample['chains'].values()))
+
+            for head, sessions in sample['chains'].items():
+                blocker = group['head_blockers'].setdefault(head, {'samples': 0, 'blocked_sessions': 0,
+                                                                   'statement': None})
+                blocker['samples'] += 1
+                blocker['blocked_sessions'] = max(blocker['blocked_sessions'], len(sessions))
+                for r in sample['requests']:
+                    if str(r['session_id']) == head and r['statement_text']:
+                        blocker['statement'] = ' '.join(r['statement_text'].split())[:200]
+
+            for w in sample['waiting_tasks']:
+                wait = group['waits'].setdefault(w['wait_type'], {'samples': 0, 'max_wait_ms': 0})
+                wait['samples'] += 1
+                wait['max_wait_ms'] = max(wait['max_wait_ms'], w['wait_duration_ms'] or 0)
+                if w['session_id'] in watched and w['blocking_session_id']:
+                    group['watched_blocked_samples'] += 1
+
+            for lock in sample['locks']:
+                if lock['request_status'] == 'GRANT':
+                    continue
+                resource = f"{lock['database_name']}:{lock['resource_type']}:{lock['entity_id']} ({lock['request_mode']})"
+                group['lock_resources'][resource] = group['lock_resources'].get(resource, 0) + 1
+
+        return {'interval_ms': self.interval_ms, 'sample_count': len(samples), 'errors': self.errors,
+                'groups': list(groups.values())}
+
+
+def print_summary(summary, top=5):
+    """打印阻塞与等待汇总"""
+    print(f"\n[+] 阻塞/等待采样: {summary['sample_count']} 次 (间隔 {summary['interval_ms']} ms, "
+          f"采样失败 {summary['errors']} 次)")
+    for group in summary['groups']:
+        if group['procedure'] is None and not group['blocked_samples']:
+            continue
+        round_text = f" 第 {group['round']} 轮" if group['round'] is not None else ''
+        print(f"\n  {group['procedure'] or '(空闲)'}{round_text}: 采样 {group['samples']} 次, "
+              f"存在阻塞 {group['blocked_samples']} 次, 被测会话被阻塞 {group['watched_blocked_samples']} 次, "
+              f"最长阻塞链 {group['max_chain_length']}")
+        waits = sorted(group['waits'].items(), key=lambda kv: kv[1]['samples'], reverse=True)
+        for wait_type, wait in waits[:top]:
+            print(f"    等待 {wait_type:<30} {wait['samples']:>5} 次, 最长 {wait['max_wait_ms']:,} ms")
+        for head, blocker in sorted(group['head_blockers'].items(), key=lambda kv: -kv[1]['samples'])[:top]:
+            print(f"    头阻塞者 {head}: {blocker['samples']} 次, 最多阻塞 {blocker['blocked_sessions']} 个会话 "
+                  f"{blocker['statement'] or ''}")
+        for resource, count in sorted(group['lock_resources'].items(), key=lambda kv: -kv[1])[:top]:
+            print(f"    锁等待 {resource}: {count} 次")
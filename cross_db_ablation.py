@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+跨库依赖消融测试
+找出语句或存储过程中的三段/四段名外部引用([logistics-test].dbo.X、[172.16.199.200].[logistics-mt-prod].dbo.X)，
+为每个外部对象建立同结构的本地空临时表，逐个替换后计时，
+得出每个跨库/跨服务器依赖占总耗时的比例
+"""
+
+import itertools
+import json
+import re
+import time
+from datetime import datetime
+
+from analyze_usp_GenerateWorkbenchKanban_Business import get_sp_definition
+from db_connection import connect
+from param_binding import bind_statement
+from parallel_runner import build_exec_statement, is_procedure_name
+from query_watchdog import StatementWatchdog, timeout_message
+from row_drain import drain_rows
+from timing_harness import percentile
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+DATABASE_INFO_FILE = 'database_info.csv'
+
+_LITERAL_RE = re.compile(r"(--[^\n]*|/\*.*?\*/|'(?:[^']|'')*')", re.S)
+_PART = r'(?:\[[^\]]+\]|[A-Za-z_][\w$]*)'
+# 至少两个点的多段名，允许 db..object 这样的空schema
+_NAME_RE = re.compile(rf'(?<![\w@#$\]]){_PART}(?:\.(?:{_PART})?)+\.{_PART}')
+_PART_RE = re.compile(rf'\.|{_PART}')
+_variant_numbers = itertools.count(1)
+
+_PROC_HEADER_RE = re.compile(r'\b(?:CREATE|ALTER)(?:\s+OR\s+ALTER)?\s+PROC(?:EDURE)?\s+[\w\.\[\]\-]+', re.I)
+
+
+def load_known_databases(conn=None):
+    """本实例上的数据库名(小写)；无连接时读取 database_info.csv"""
+    if conn is not None:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT name FROM sys.databases")
+            return {row[0].lower() for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+    with open(DATABASE_INFO_FILE, encoding='utf-8-sig') as f:
+        return {line.split(',')[0].strip().lower() for line in f.readlines()[1:] if line.strip()}
+
+
+def _split_parts(name):
+    """把多段名拆成各段(去掉方括号)，空schema保留为空串"""
+    parts, current = [], ''
+    for token in _PART_RE.findall(name):
+        if token == '.':
+            parts.append(current)
+            current = ''
+        else:
+            current = token.strip('[]')
+    parts.append(current)
+    return parts
+
+
+def _external_prefix(parts, current_database, known_databases):
+    """返回多段名中外部对象部分所占的段数(3=跨库, 4=跨服务器)，不是外部引用时返回 0"""
+    first = parts[0].lower()
+    if first in known_databases:
+        if len(parts) >= 3 and first not in (current_database.lower(), 'tempdb'):
+            return 3
+        return 0
+    if len(parts) >= 4 and parts[1]:
+        return 4
+    return 0
+
+
+def _code_segments(sql):
+    """按注释/字符串切分，奇数下标为注释或字符串，不做替换"""
+    return _LITERAL_RE.split(sql)
+
+
+def find_external_references(sql, current_database=DEFAULT_DATABASE, known_databases=None):
+    """
+    找出所有跨库(三段名)和跨服务器(四段名)引用
+
+    返回 {对象键: {'object': 规范名, 'kind': 'database'/'server', 'references': 次数}}
+    """
+    known_databases = known_databases or load_known_databases()
+    references = {}
+    for index, segment in enumerate(_code_segments(sql)):
+        if index % 2:
+            continue
+        for match in _NAME_RE.finditer(segment):
+            parts = _split_parts(match.group(0))
+            size = _external_prefix(parts, current_database, known_databases)
+            if not size:
+                continue
+            object_parts = [p or 'dbo' for p in parts[:size]]
+            key = '.'.join(p.lower() for p in object_parts)
+            entry = references.setdefault(key, {
+                'object': '.'.join(f"[{p}]" for p in object_parts),
+                'kind': 'database' if size == 3 else 'server',
+                'references': 0
+            })
+            entry['references'] += 1
+    return references
+
+
+def replace_references(sql, replacements, current_database=DEFAULT_DATABASE, known_databases=None):
+    """把指定外部对象(键 -> 本地名)替换掉，带列名的引用只替换对象前缀"""
+    known_databases = known_databases or load_known_databases()
+
+    def substitute(match):
+        parts = _split_parts(match.group(0))
+        size = _external_prefix(parts, current_database, known_databases)
+        if not size:
+            return match.group(0)
+        key = '.'.join((p or 'dbo').lower() for p in parts[:size])
+        if key not in replacements:
+            return match.group(0)
+        rest = parts[size:]
+        return '.'.join([replacements[key]] + [f"[{p}]" for p in rest])
+
+    segments = _code_segments(sql)
+    for index in range(0, len(segments), 2):
+        segments[index] = _NAME_RE.sub(substitute, segments[index])
+    return ''.join(segments)
+
+
+def create_stubs(conn, references):
+    """为每个外部对象建立同结构的本地空临时表 #ablation_stub_N，返回 {键: 临时表名 或 None}"""
+    stubs = {}
+    cursor = conn.cursor()
+    try:
+        for number, (key, entry) in enumerate(references.items(), 1):
+            stub = f"#ablation_stub_{number}"
+            try:
+                cursor.execute(f"IF OBJECT_ID('tempdb..{stub}') IS NOT NULL DROP TABLE {stub}")
+                cursor.execute(f"SELECT TOP 0 * INTO {stub} FROM {entry['object']}")
+                conn.commit()
+                stubs[key] = stub
+            except Exception as e:
+                conn.rollback()
+                entry['stub_error'] = str(e)
+                stubs[key] = None
+                print(f"  [-] 无法为 {entry['object']} 建立本地空表: {e}")
+    finally:
+        cursor.close()
+    return stubs
+
+
+def drop_stubs(conn, stubs):
+    cursor = conn.cursor()
+    try:
+        for stub in stubs.values():
+            if stub:
+                cursor.execute(f"IF OBJECT_ID('tempdb..{stub}') IS NOT NULL DROP TABLE {stub}")
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+class _Variant:
+    """一个待计时的版本：SQL批处理或以临时存储过程形式创建的存储过程副本"""
+
+    def __init__(self, conn, name, sql, params, procedure_header=None):
+        self.conn = conn
+        self.name = name
+        self.params = params or {}
+        self.procedure = None
+        if procedure_header is not None:
+            # 存储过程副本创建为会话级临时存储过程，对象解析仍在当前数据库中进行
+            self.procedure = f"#ablation_{next(_variant_numbers)}"
+            self.create_sql = _PROC_HEADER_RE.sub(f"CREATE PROCEDURE {self.procedure}", sql, count=1)
+            self.exec_sql, self.values = build_exec_statement(self.procedure, self.params)
+        elif self.params:
+            self.exec_sql, self.values, _ = bind_statement(sql, self.params)
+        else:
+            self.exec_sql, self.values = sql, []
+
+    def prepare(self):
+        if self.procedure:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(f"IF OBJECT_ID('tempdb..{self.procedure}') IS NOT NULL DROP PROCEDURE {self.procedure}")
+                cursor.execute(self.create_sql)
+                self.conn.commit()
+            finally:
+                cursor.close()
+
+    def cleanup(self):
+        if self.procedure:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(f"IF OBJECT_ID('tempdb..{self.procedure}') IS NOT NULL DROP PROCEDURE {self.procedure}")
+                self.conn.commit()
+            finally:
+                cursor.close()
+
+    def run_once(self, timeout_ms):
+        cursor = self.conn.cursor()
+        watchdog = StatementWatchdog(cursor, timeout_ms)
+        start = time.perf_counter()
+        try:
+            with watchdog:
+                cursor.execute(self.exec_sql, *self.values)
+                drain_rows(cursor, 'discard')
+            return {'success': True, 'duration_ms': (time.perf_counter() - start) * 1000}
+        except Exception as e:
+            error = timeout_message(watchdog.fired_at_ms) if watchdog.fired else str(e)
+            return {'success': False, 'duration_ms': (time.perf_counter() - start) * 1000, 'error': error}
+        finally:
+            cursor.close()
+            self.conn.rollback()
+
+
+def time_variant(variant, rounds=3, warmup=1, timeout_ms=120000):
+    """预热后执行若干轮，返回中位耗时"""
+    try:
+        variant.prepare()
+    except Exception as e:
+        return {'variant': variant.name, 'success': False, 'error': str(e), 'median_ms': None}
+
+    try:
+        for _ in range(warmup):
+            warm = variant.run_once(timeout_ms)
+            if not warm['success']:
+                return {'variant': variant.name, 'success': False, 'error': warm['error'], 'median_ms': None}
+        runs = [variant.run_once(timeout_ms) for _ in range(rounds)]
+    finally:
+        variant.cleanup()
+
+    durations = sorted(r['duration_ms'] for r in runs if r['success'])
+    failed = [r for r in runs if not r['success']]
+    return {
+        'variant': variant.name,
+        'success': bool(durations),
+        'durations_ms': durations,
+        'median_ms': percentile(durations, 50),
+        'error': failed[0]['error'] if failed else None
+    }
+
+
+def ablate(conn, target, params=None, database=DEFAULT_DATABASE, rounds=3, warmup=1, timeout_ms=120000):
+    """
+    对语句或存储过程做跨库依赖消融
+
+    依次计时：原始版本、每次只把一个外部对象换成本地空表的版本、全部替换的版本
+    """
+    procedure_header = None
+    if is_procedure_name(target):
+        sql = get_sp_definition(conn, target.strip())
+        if not sql:
+            raise ValueError(f"未找到存储过程: {target}")
+        procedure_header = target.strip()
+    else:
+        sql = target
+
+    known = load_known_databases(conn)
+    references = find_external_references(sql, database, known)
+    report = {'target': target if procedure_header else ' '.join(sql.split())[:200],
+              'database': database, 'test_date': datetime.now().isoformat(),
+              'dependencies': [], 'variants': []}
+    if not references:
+        print("[+] 未发现跨库/跨服务器引用")
+        return report
+
+    print(f"[+] 发现 {len(references)} 个外部对象:")
+    for entry in references.values():
+        print(f"  {entry['object']} ({'跨服务器' if entry['kind'] == 'server' else '跨库'}, 引用 {entry['references']} 次)")
+
+    stubs = create_stubs(conn, references)
+    try:
+        def variant(name, replacements):
+            text = replace_references(sql, replacements, database, known) if replacements else sql
+            return _Variant(conn, name, text, params, procedure_header)
+
+        print("\n[*] 计时原始版本...")
+        baseline = time_variant(variant('original', {}), rounds, warmup, timeout_ms)
+        report['variants'].append(baseline)
+
+        available = {key: stub for key, stub in stubs.items() if stub}
+        for key, entry in references.items():
+            dependency = dict(entry, stub=stubs[key])
+            if stubs[key]:
+                print(f"[*] 计时替换 {entry['object']} 后的版本...")
+                result = time_variant(variant(f"without {entry['object']}", {key: stubs[key]}),
+                                      rounds, warmup, timeout_ms)
+                report['variants'].append(result)
+                dependency['ablated_ms'] = result['median_ms']
+                if baseline['success'] and result['success']:
+                    dependency['saved_ms'] = baseline['median_ms'] - result['median_ms']
+                    dependency['share'] = dependency['saved_ms'] / baseline['median_ms'] if baseline['median_ms'] else 0
+            report['dependencies'].append(dependency)
+
+        if len(available) > 1:
+            print("[*] 计时全部替换为本地空表的版本...")
+            local_only = time_variant(variant('local only', available), rounds, warmup, timeout_ms)
+            report['variants'].append(local_only)
+            if baseline['success'] and local_only['success']:
+                report['remote_share'] = 1 - local_only['median_ms'] / baseline['median_ms'] if baseline['median_ms'] else 0
+    finally:
+        drop_stubs(conn, stubs)
+
+    report['dependencies'].sort(key=lambda d: d.get('saved_ms') or 0, reverse=True)
+    return report
+
+
+def print_report(report):
+    """打印消融结果"""
+    for v in report['variants']:
+        status = f"{v['median_ms']:,.0f} ms" if v['success'] else f"失败: {v['error']}"
+        print(f"  {v['variant']:<80} {status}")
+
+    print(f"\n  {'外部对象':<70} {'引用':>5} {'节省(ms)':>12} {'占比':>8}")
+    for d in report['dependencies']:
+        saved = f"{d['saved_ms']:,.0f}" if d.get('saved_ms') is not None else '-'
+        share = f"{d['share']:.1%}" if d.get('share') is not None else '-'
+        print(f"  {d['object']:<70} {d['references']:>5} {saved:>12} {share:>8}")
+    if 'remote_share' in report:
+        print(f"\n[+] 全部外部依赖合计占比: {report['remote_share']:.1%}")
+
+
+def main():
+    """主函数"""
+    sql = """
+    SELECT TOP 1000 detail.ID, Report.StationID, detail.ProjectID, Report.ReportDate,
+           MES.PlanId, MES.IsLubricatePumpMortar
+    FROM ProductionDailyReportDetails detail WITH (NOLOCK)
+        LEFT JOIN dbo.ProductionDailyReports Report WITH (NOLOCK) ON detail.DailyReportID = Report.ID
+        LEFT JOIN [logistics-test].dbo.View_GetProductionDetailsAndLPM MES WITH (NOLOCK) ON detail.OriginalID = MES.Id
+    WHERE ISNULL(Report.isDeleted, 0) = 0
+          AND detail.ProjectID IS NOT NULL
+          AND Report.ReportDate BETWEEN @beginDate AND @endDate
+    """
+    params = {'beginDate': datetime(2025, 11, 1), 'endDate': datetime(2025, 11, 30)}
+
+    print("=" * 60)
+    print("跨库依赖消融测试")
+    print("=" * 60)
+
+    conn = connect(DEFAULT_DATABASE)
+    try:
+        report = ablate(conn, sql, params)
+    finally:
+        conn.close()
+    print_report(report)
+
+    output_file = f"cross_db_ablation_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[+] 结果已保存到: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+共享数据库连接层
+只解析一次可用的ODBC驱动并缓存，按数据库维护有界的热连接池，
+连接归还时重置会话状态(SET选项、临时表)，避免每轮测试都付出建连开销
+"""
+
+import atexit
+import queue
+import threading
+from contextlib import contextmanager
+
+import pyodbc
+
+DB_CONFIG = {
+    'server': '127.0.0.1,5433',
+    'username': 'sa',
+    'password': '123456'
+}
+
+# 按优先级排列的候选驱动
+DRIVERS = [
+    'ODBC Driver 18 for SQL Server',
+    'ODBC Driver 17 for SQL Server',
+    'ODBC Driver 13 for SQL Server',
+    'SQL Server Native Client 11.0',
+    'SQL Server'
+]
+
+# 默认预置连接池的业务库
+POOLED_DATABASES = ['Statistics-CT-test', 'logistics-test', 'Weighbridge-test']
+
+# SET SHOWPLAN_* 必须单独成批(否则报错1067)，且开启时后续批处理只编译不执行，所以最先单独发送
+RESET_SHOWPLAN_SQL = "SET SHOWPLAN_XML OFF"
+
+# 归还连接时执行的会话重置批处理
+RESET_SESSION_SQL = """
+IF @@TRANCOUNT > 0 ROLLBACK;
+SET STATISTICS IO OFF;
+SET STATISTICS TIME OFF;
+SET STATISTICS XML OFF;
+SET NOCOUNT OFF;
+SET XACT_ABORT OFF;
+SET LOCK_TIMEOUT -1;
+SET DEADLOCK_PRIORITY NORMAL;
+SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
+
+DECLARE @drop NVARCHAR(MAX) = N'';
+SELECT @drop += N'DROP TABLE ' + QUOTENAME(t.base_name) + N';'
+FROM (
+    SELECT object_id, base_name = LEFT(name, CHARINDEX(N'_____', name + N'_____') - 1)
+    FROM tempdb.sys.tables
+    WHERE name LIKE N'#[^#]%'
+) t
+WHERE OBJECT_ID(N'tempdb..' + t.base_name) = t.object_id;
+EXEC (@drop);
+"""
+
+_driver_lock = threading.Lock()
+_resolved_driver = None
+
+_pools_lock = threading.Lock()
+_pools = {}
+
+
+def build_connection_string(database, driver):
+    """构造ODBC连接字符串"""
+    return (
+        f"DRIVER={{{driver}}};"
+        f"SERVER={DB_CONFIG['server']};"
+        f"DATABASE={database};"
+        f"UID={DB_CONFIG['username']};"
+        f"PWD={DB_CONFIG['password']};"
+        f"TrustServerCertificate=yes;"
+    )
+
+
+def resolve_driver(timeout=10):
+    """解析可用的ODBC驱动，结果在进程内缓存，只探测一次"""
+    global _resolved_driver
+
+    if _resolved_driver:
+        return _resolved_driver
+
+    with _driver_lock:
+        if _resolved_driver:
+            return _resolved_driver
+
+        # 只探测本机已安装的驱动，避免对不存在的驱动逐个等待超时
+        installed = set(pyodbc.drivers())
+        candidates = [d for d in DRIVERS if d in installed] or DRIVERS
+
+        for driver in candidates:
+            try:
+                conn = pyodbc.connect(build_connection_string('master', driver), timeout=timeout)
+                conn.close()
+                _resolved_driver = driver
+                print(f"[+] 已解析ODBC驱动: {driver}")
+                return driver
+            except pyodbc.Error:
+                continue
+
+    raise Exception("无法连接到数据库，请检查ODBC驱动是否安装")
+
+
+def connect(database, timeout=10, autocommit=False):
+    """使用缓存的驱动建立一条新连接(不经过连接池)"""
+    driver = resolve_driver(timeout=timeout)
+    return pyodbc.connect(build_connection_string(database, driver), timeout=timeout, autocommit=autocommit)
+
+
+def reset_session(conn, database):
+    """重置会话状态：回滚未提交事务、恢复SET选项、删除本会话的临时表、切回原数据库"""
+    conn.rollback()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(RESET_SHOWPLAN_SQL)
+        cursor.execute(RESET_SESSION_SQL)
+        while cursor.nextset():
+            pass
+        cursor.execute(f"USE [{database}]")
+    finally:
+        cursor.close()
+    conn.commit()
+
+
+class ConnectionPool:
+    """单个数据库的有界连接池"""
+
+    def __init__(self, database, max_size=4, timeout=10):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+    def acquire(self, wait=None):
+        """取出一条连接；池满时最多等待 wait 秒"""
+        if self._closed:
+            raise Exception(f"连接池已关闭: {self.database}")
+
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return connect(self.database, timeout=self.timeout)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=wait)
+        except queue.Empty:
+            raise Exception(f"等待连接超时: {self.database} (上限 {self.max_size})")
+
+    def release(self, conn):
+        """归还连接；会话重置失败的连接直接丢弃"""
+        if self._closed:
+            self._discard(conn)
+            return
+
+        try:
+            reset_session(conn, self.database)
+        except pyodbc.Error:
+            self._discard(conn)
+            return
+
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self, wait=None):
+        """以上下文管理器方式借用连接"""
+        conn = self.acquire(wait=wait)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """关闭池中所有空闲连接"""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+def get_pool(database, max_size=4, timeout=10):
+    """获取(必要时创建)指定数据库的连接池"""
+    with _pools_lock:
+        pool = _pools.get(database)
+        if pool is None:
+            pool = ConnectionPool(database, max_size=max_size, timeout=timeout)
+            _pools[database] = pool
+        return pool
+
+
+@contextmanager
+def pooled_connection(database, wait=None):
+    """从对应数据库的连接池借用一条连接"""
+    with get_pool(database).connection(wait=wait) as conn:
+        yield conn
+
+
+def warm_up(databases=None, size=1):
+    """为常用数据库预先建立连接，使第一轮测试也不含建连时间"""
+    for database in databases or POOLED_DATABASES:
+        pool = get_pool(database)
+        conns = [pool.acquire() for _ in range(min(size, pool.max_size))]
+        for conn in conns:
+            pool.release(conn)
+        if not check_reuse(pool):
+            print(f"[!] {database}: 归还的连接未能复用，请检查会话重置批处理")
+
+
+def check_reuse(pool):
+    """确认连接经 acquire → release → acquire 后仍是同一条(会话重置失败的连接会被丢弃而无法复用)"""
+    conn = pool.acquire()
+    pool.release(conn)
+    again = pool.acquire()
+    try:
+        return again is conn
+    finally:
+        pool.release(again)
+
+
+def close_all_pools():
+    """关闭所有连接池"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_all_pools)
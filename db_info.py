@@ -1,35 +1,15 @@
+import os
 import pyodbc
 import pandas as pd
 from datetime import datetime
 
-# 数据库连接配置
-server = '127.0.0.1,5433'
+from db_connection import connect, resolve_driver
+
 database = 'master'  # 先连接到master数据库
-username = 'sa'
-password = '123456'  # 密码可以随便填写
 
 try:
-    # 尝试多个ODBC驱动
-    drivers = [
-        'ODBC Driver 18 for SQL Server',
-        'ODBC Driver 17 for SQL Server',
-        'SQL Server Native Client 11.0',
-        'SQL Server'
-    ]
-
-    conn = None
-    for driver in drivers:
-        try:
-            print(f"尝试使用驱动: {driver}")
-            conn_str = f'DRIVER={{{driver}}};SERVER={server};DATABASE={database};UID={username};PWD={password};TrustServerCertificate=yes'
-            conn = pyodbc.connect(conn_str, timeout=10)
-            print(f"成功连接,使用驱动: {driver}")
-            break
-        except pyodbc.Error as e:
-            continue
-
-    if conn is None:
-        raise Exception("无法找到可用的ODBC驱动")
+    conn = connect(database, timeout=10)
+    print(f"成功连接,使用驱动: {resolve_driver()}")
     cursor = conn.cursor()
 
     print("=" * 80)
@@ -64,32 +44,28 @@ try:
         print(f"    - 排序规则: {db[6]}")
         print()
 
-    # 2. 获取SQL Server版本信息
+    # 2. 获取SQL Server版本信息（版本和服务器属性一次往返取回）
     print("【2. SQL Server 版本信息】")
     print("-" * 80)
-    cursor.execute("SELECT @@VERSION AS 版本信息")
-    version = cursor.fetchone()
-    print(version[0])
+    cursor.execute("""
+        SELECT
+            @@VERSION AS 版本信息,
+            CAST(SERVERPROPERTY('ProductVersion') AS NVARCHAR(128)) AS 产品版本,
+            CAST(SERVERPROPERTY('ProductLevel') AS NVARCHAR(128)) AS 产品级别,
+            CAST(SERVERPROPERTY('Edition') AS NVARCHAR(128)) AS 版本,
+            CAST(SERVERPROPERTY('ServerName') AS NVARCHAR(128)) AS 服务器名称
+    """)
+    server = cursor.fetchone()
+    print(server[0])
     print()
 
     # 3. 获取服务器属性
     print("【3. 服务器基本信息】")
     print("-" * 80)
-    cursor.execute("SELECT SERVERPROPERTY('ProductVersion') AS 产品版本")
-    prod_version = cursor.fetchone()
-    print(f"  产品版本: {prod_version[0]}")
-
-    cursor.execute("SELECT SERVERPROPERTY('ProductLevel') AS 产品级别")
-    prod_level = cursor.fetchone()
-    print(f"  产品级别: {prod_level[0]}")
-
-    cursor.execute("SELECT SERVERPROPERTY('Edition') AS 版本")
-    edition = cursor.fetchone()
-    print(f"  版本: {edition[0]}")
-
-    cursor.execute("SELECT SERVERPROPERTY('ServerName') AS 服务器名称")
-    server_name = cursor.fetchone()
-    print(f"  服务器名称: {server_name[0]}")
+    print(f"  产品版本: {server[1]}")
+    print(f"  产品级别: {server[2]}")
+    print(f"  版本: {server[3]}")
+    print(f"  服务器名称: {server[4]}")
     print()
 
     # 4. 获取数据库大小信息
@@ -152,7 +128,8 @@ try:
     data = cursor.fetchall()
     df = pd.DataFrame.from_records(data, columns=columns)
 
-    output_file = 'd:/Lakin/project/sql-performance/database_info.csv'
+    # 写到脚本所在目录，db_inventory.py 等工具从这里读取数据库清单
+    output_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'database_info.csv')
     df.to_csv(output_file, index=False, encoding='utf-8-sig')
     print(f"  数据库信息已导出到: {output_file}")
     print()
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+多数据库清单采集
+对 database_info.csv 中的全部数据库并行采集：表行数、索引使用情况(sys.dm_db_index_usage_stats)、
+索引碎片和数据文件 I/O(sys.dm_io_virtual_file_stats)；每个数据库一次往返返回多个结果集，
+结果按时间戳保存为快照，两个快照对比可得到数据增长和 I/O 热点
+"""
+
+import csv
+import glob
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from db_connection import connect
+
+DATABASE_INFO_FILE = 'database_info.csv'
+SNAPSHOT_DIR = 'inventory_snapshots'
+
+# 服务器信息一次取回
+SERVER_SQL = """
+SELECT @@VERSION AS version,
+       CAST(SERVERPROPERTY('ProductVersion') AS NVARCHAR(128)) AS product_version,
+       CAST(SERVERPROPERTY('ProductLevel') AS NVARCHAR(128)) AS product_level,
+       CAST(SERVERPROPERTY('Edition') AS NVARCHAR(128)) AS edition,
+       CAST(SERVERPROPERTY('ServerName') AS NVARCHAR(128)) AS server_name,
+       (SELECT sqlserver_start_time FROM sys.dm_os_sys_info) AS start_time
+"""
+
+# 每个数据库一次往返：表行数、索引使用、碎片、文件I/O 四个结果集
+INVENTORY_SQL = """
+SET NOCOUNT ON;
+SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED;
+
+SELECT s.name AS schema_name, t.name AS table_name,
+       SUM(CASE WHEN ps.index_id IN (0, 1) THEN ps.row_count ELSE 0 END) AS row_count,
+       SUM(ps.reserved_page_count) * 8 AS reserved_kb
+FROM sys.tables t
+INNER JOIN sys.schemas s ON s.schema_id = t.schema_id
+INNER JOIN sys.dm_db_partition_stats ps ON ps.object_id = t.object_id
+WHERE t.is_ms_shipped = 0
+GROUP BY s.name, t.name;
+
+SELECT OBJECT_SCHEMA_NAME(i.object_id) AS schema_name, OBJECT_NAME(i.object_id) AS table_name,
+       i.name AS index_name, i.type_desc,
+       ISNULL(us.user_seeks, 0) AS user_seeks, ISNULL(us.user_scans, 0) AS user_scans,
+       ISNULL(us.user_lookups, 0) AS user_lookups, ISNULL(us.user_updates, 0) AS user_updates,
+       us.last_user_seek, us.last_user_scan, us.last_user_update
+FROM sys.indexes i
+INNER JOIN sys.tables t ON t.object_id = i.object_id AND t.is_ms_shipped = 0
+LEFT JOIN sys.dm_db_index_usage_stats us
+       ON us.database_id = DB_ID() AND us.object_id = i.object_id AND us.index_id = i.index_id;
+
+SELECT OBJECT_SCHEMA_NAME(ps.object_id) AS schema_name, OBJECT_NAME(ps.object_id) AS table_name,
+       i.name AS index_name, ps.index_type_desc, ps.partition_number,
+       ps.avg_fragmentation_in_percent, ps.page_count
+FROM sys.dm_db_index_physical_stats(DB_ID(), NULL, NULL, NULL, 'LIMITED') ps
+INNER JOIN sys.indexes i ON i.object_id = ps.object_id AND i.index_id = ps.index_id
+WHERE ps.page_count >= ? AND ps.alloc_unit_type_desc = 'IN_ROW_DATA';
+
+SELECT df.name AS file_name, df.type_desc, df.physical_name, df.size * 8 / 1024 AS size_mb,
+       vfs.num_of_reads, vfs.num_of_bytes_read, vfs.io_stall_read_ms,
+       vfs.num_of_writes, vfs.num_of_bytes_written, vfs.io_stall_write_ms
+FROM sys.dm_io_virtual_file_stats(DB_ID(), NULL) vfs
+INNER JOIN sys.database_files df ON df.file_id = vfs.file_id;
+"""
+
+# 碎片统计只看不少于该页数的索引，小索引的碎片率没有意义且扫描成本不值得
+MIN_FRAGMENTATION_PAGES = 100
+RESULT_SETS = ('tables', 'index_usage', 'fragmentation', 'files')
+
+
+def load_databases(path=DATABASE_INFO_FILE):
+    """database_info.csv 中状态为 ONLINE 的数据库名"""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        return [row['DatabaseName'] for row in csv.DictReader(f)
+                if (row.get('State') or 'ONLINE').upper() == 'ONLINE']
+
+
+def _rows_as_dicts(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def collect_database(database, min_pages=MIN_FRAGMENTATION_PAGES):
+    """在独立连接上对单个数据库执行批量清单查询"""
+    started = time.perf_counter()
+    conn = connect(database, autocommit=True)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(INVENTORY_SQL, min_pages)
+        result = {}
+        for index, name in enumerate(RESULT_SETS):
+            if index:
+                cursor.nextset()
+            result[name] = _rows_as_dicts(cursor)
+    finally:
+        cursor.close()
+        conn.close()
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def collect_server():
+    conn = connect('master', autocommit=True)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SERVER_SQL)
+        return _rows_as_dicts(cursor)[0]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def collect_inventory(databases=None, max_workers=4):
+    """并行采集全部数据库，失败的数据库记录错误后继续"""
+    databases = databases or load_databases()
+    snapshot = {'taken_at': datetime.now().isoformat(), 'server': collect_server(), 'databases': {}, 'errors': {}}
+
+    print(f"[*] 采集 {len(databases)} 个数据库 (并发 {max_workers})...")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inventory') as executor:
+        futures = {executor.submit(collect_database, database): database for database in databases}
+        for future in as_completed(futures):
+            database = futures[future]
+            try:
+                snapshot['databases'][database] = future.result()
+                data = snapshot['databases'][database]
+                print(f"  [+] {database}: {len(data['tables'])} 张表, {len(data['index_usage'])} 个索引, "
+                      f"{data['elapsed_ms']:.0f} ms")
+            except Exception as e:
+                snapshot['errors'][database] = str(e)
+                print(f"  [-] {database}: {e}")
+    snapshot['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    print(f"[+] 采集完成，总耗时 {snapshot['elapsed_ms']:,.0f} ms")
+    return snapshot
+
+
+def save_snapshot(snapshot, directory=SNAPSHOT_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"inventory_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False, indent=2, default=str)
+    return path
+
+
+def load_snapshot(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def list_snapshots(directory=SNAPSHOT_DIR):
+    """按时间先后返回已保存的快照文件"""
+    return sorted(glob.glob(os.path.join(directory, 'inventory_*.json')))
+
+
+def _keyed(rows, *fields):
+    return {tuple(row[field] for field in fields): row for row in rows}
+
+
+def diff_snapshots(old, new):
+    """
+    对比两个快照
+
+    表：行数和占用空间增长；文件：区间内读写次数、字节数和平均I/O等待；
+    索引：区间内的查找/扫描/更新次数。实例重启后DMV计数清零，此时I/O和索引使用按新快照的绝对值计
+    """
+    restarted = str(old['server'].get('start_time')) != str(new['server'].get('start_time'))
+    growth, files, indexes = [], [], []
+
+    for database, data in new['databases'].items():
+        before = old['databases'].get(database)
+        if before is None:
+            continue
+
+        old_tables = _keyed(before['tables'], 'schema_name', 'table_name')
+        for key, table in _keyed(data['tables'], 'schema_name', 'table_name').items():
+            previous = old_tables.get(key, {'row_count': 0, 'reserved_kb': 0})
+            rows_delta = table['row_count'] - previous['row_count']
+            if rows_delta or table['reserved_kb'] != previous['reserved_kb']:
+                growth.append({'database': database, 'table': f"{key[0]}.{key[1]}", 'rows': table['row_count'],
+                               'rows_delta': rows_delta, 'reserved_kb_delta': table['reserved_kb'] - previous['reserved_kb'],
+                               'new_table': key not in old_tables})
+
+        old_files = _keyed(before['files'], 'file_name')
+        for key, file in _keyed(data['files'], 'file_name').items():
+            previous = old_files.get(key) if not restarted else None
+            delta = {field: file[field] - (previous[field] if previous else 0)
+                     for field in ('num_of_reads', 'num_of_bytes_read', 'io_stall_read_ms',
+                                   'num_of_writes', 'num_of_bytes_written', 'io_stall_write_ms')}
+            ios = delta['num_of_reads'] + delta['num_of_writes']
+            files.append({'database': database, 'file': key[0], 'type': file['type_desc'],
+                          'size_mb_delta': file['size_mb'] - (old_files[key]['size_mb'] if key in old_files else 0),
+                          **delta, 'io_stall_ms': delta['io_stall_read_ms'] + delta['io_stall_write_ms'],
+                          'avg_stall_ms': round((delta['io_stall_read_ms'] + delta['io_stall_write_ms']) / ios, 2)
+                          if ios else 0.0})
+
+        old_usage = _keyed(before['index_usage'], 'schema_name', 'table_name', 'index_name')
+        for key, usage in _keyed(data['index_usage'], 'schema_name', 'table_name', 'index_name').items():
+            previous = old_usage.get(key) if not restarted else None
+            delta = {field: usage[field] - (previous[field] if previous else 0)
+                     for field in ('user_seeks', 'user_scans', 'user_lookups', 'user_updates')}
+            if any(delta.values()):
+                indexes.append({'database': database, 'table': f"{key[0]}.{key[1]}", 'index': key[2],
+                                'reads': delta['user_seeks'] + delta['user_scans'] + delta['user_lookups'],
+                                **delta})
+
+    return {
+        'from': old['taken_at'],
+        'to': new['taken_at'],
+        'restarted': restarted,
+        'table_growth': sorted(growth, key=lambda g: -abs(g['rows_delta'])),
+        'file_io': sorted(files, key=lambda f: -f['io_stall_ms']),
+        'index_activity': sorted(indexes, key=lambda i: -(i['reads'] + i['user_updates']))
+    }
+
+
+def fragmented_indexes(snapshot, threshold=30.0):
+    """碎片率超过阈值的索引，按页数降序"""
+    found = [{'database': database, 'table': f"{row['schema_name']}.{row['table_name']}", 'index': row['index_name'],
+              'fragmentation': round(row['avg_fragmentation_in_percent'], 1), 'page_count': row['page_count']}
+             for database, data in snapshot['databases'].items() for row in data['fragmentation']
+             if row['avg_fragmentation_in_percent'] >= threshold]
+    return sorted(found, key=lambda f: -f['page_count'])
+
+
+def print_diff(diff, top=10):
+    print(f"\n[+] 快照对比: {diff['from']} → {diff['to']}")
+    if diff['restarted']:
+        print("[!] 实例在两次快照之间重启过，I/O 和索引使用按新快照累计值计算")
+
+    print(f"\n  数据增长 Top {top}:")
+    for g in diff['table_growth'][:top]:
+        print(f"    {g['database']}.{g['table']:<50} {g['rows_delta']:>+12,} 行 "
+              f"({g['reserved_kb_delta']:+,} KB){' [新表]' if g['new_table'] else ''}")
+
+    print(f"\n  I/O 热点 Top {top} (按I/O等待):")
+    for f in diff['file_io'][:top]:
+        print(f"    {f['database']}/{f['file']:<30} 读 {f['num_of_reads']:>10,} 写 {f['num_of_writes']:>10,} "
+              f"等待 {f['io_stall_ms']:>10,} ms (平均 {f['avg_stall_ms']} ms)")
+
+    print(f"\n  索引活动 Top {top}:")
+    for i in diff['index_activity'][:top]:
+        print(f"    {i['database']}.{i['table']}.{i['index'] or '(堆)'}: 读 {i['reads']:,}, 更新 {i['user_updates']:,}")
+
+
+def main():
+    print("=" * 60)
+    print("多数据库清单采集")
+    print("=" * 60)
+
+    previous = list_snapshots()
+    snapshot = collect_inventory()
+    path = save_snapshot(snapshot)
+    print(f"[+] 快照已保存: {path}")
+
+    fragmented = fragmented_indexes(snapshot)
+    if fragmented:
+        print(f"\n[!] 碎片率 ≥30% 的索引 {len(fragmented)} 个:")
+        for f in fragmented[:10]:
+            print(f"    {f['database']}.{f['table']}.{f['index']}: {f['fragmentation']}% ({f['page_count']:,} 页)")
+
+    if previous:
+        diff = diff_snapshots(load_snapshot(previous[-1]), snapshot)
+        print_diff(diff)
+        output_file = f"inventory_diff_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(diff, f, ensure_ascii=False, indent=2, default=str)
+        print(f"\n[+] 对比结果已保存: {output_file}")
+    else:
+        print("[*] 没有更早的快照，下次运行时将自动与本次快照对比")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+DMV快照差值采集
+在每轮执行前后各用一个批处理查询抓取
+sys.dm_exec_procedure_stats / sys.dm_exec_query_stats / sys.dm_exec_session_wait_stats，
+按差值计算服务器端的CPU、读写、耗时、行数和等待，从而把服务器耗时和传输耗时区分开
+"""
+
+# 一次往返返回三个结果集：存储过程统计、语句统计、本会话等待统计
+SNAPSHOT_SQL = """
+SET NOCOUNT ON;
+DECLARE @object_id INT = OBJECT_ID(?);
+
+SELECT execution_count, total_worker_time, total_elapsed_time,
+       total_logical_reads, total_logical_writes, total_physical_reads
+FROM sys.dm_exec_procedure_stats
+WHERE database_id = DB_ID() AND object_id = @object_id;
+
+SELECT qs.statement_start_offset, qs.execution_count, qs.total_worker_time, qs.total_elapsed_time,
+       qs.total_logical_reads, qs.total_logical_writes, qs.total_physical_reads, qs.total_rows
+FROM sys.dm_exec_procedure_stats ps
+INNER JOIN sys.dm_exec_query_stats qs ON qs.sql_handle = ps.sql_handle AND qs.plan_handle = ps.plan_handle
+WHERE ps.database_id = DB_ID() AND ps.object_id = @object_id;
+
+SELECT wait_type, waiting_tasks_count, wait_time_ms, signal_wait_time_ms
+FROM sys.dm_exec_session_wait_stats
+WHERE session_id = @@SPID;
+"""
+
+PROCEDURE_COUNTERS = ('execution_count', 'total_worker_time', 'total_elapsed_time',
+                      'total_logical_reads', 'total_logical_writes', 'total_physical_reads')
+QUERY_COUNTERS = PROCEDURE_COUNTERS + ('total_rows',)
+WAIT_COUNTERS = ('waiting_tasks_count', 'wait_time_ms', 'signal_wait_time_ms')
+
+
+def _rows_as_dicts(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def take_snapshot(conn, sp_name):
+    """抓取一次快照(必须与被测执行使用同一会话，才能取到本会话的等待统计)"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SNAPSHOT_SQL, sp_name)
+        procedure_rows = _rows_as_dicts(cursor)
+        cursor.nextset()
+        query_rows = _rows_as_dicts(cursor)
+        cursor.nextset()
+        wait_rows = _rows_as_dicts(cursor)
+    finally:
+        cursor.close()
+
+    return {
+        'procedure': procedure_rows[0] if procedure_rows else None,
+        'statements': {row['statement_start_offset']: row for row in query_rows},
+        'waits': {row['wait_type']: row for row in wait_rows}
+    }
+
+
+def _delta(before, after, counters):
+    """计算计数器差值；计划被逐出后重新编译时计数会归零，此时以after为准"""
+    if after is None:
+        return None
+    if before is None or after['execution_count'] < before['execution_count']:
+        return {c: after[c] for c in counters}
+    return {c: after[c] - before[c] for c in counters}
+
+
+def diff_snapshots(before, after):
+    """计算两次快照之间的服务器端开销(时间单位统一为毫秒)"""
+    procedure = _delta(before['procedure'], after['procedure'], PROCEDURE_COUNTERS)
+
+    statements = []
+    for offset, row in after['statements'].items():
+        delta = _delta(before['statements'].get(offset), row, QUERY_COUNTERS)
+        if delta and delta['execution_count'] > 0:
+            statements.append({
+                'statement_start_offset': offset,
+                'executions': delta['execution_count'],
+                'worker_time_ms': delta['total_worker_time'] / 1000,
+                'elapsed_ms': delta['total_elapsed_time'] / 1000,
+                'logical_reads': delta['total_logical_reads'],
+                'logical_writes': delta['total_logical_writes'],
+                'rows': delta['total_rows']
+            })
+    statements.sort(key=lambda s: s['elapsed_ms'], reverse=True)
+
+    waits = []
+    for wait_type, row in after['waits'].items():
+        previous = before['waits'].get(wait_type)
+        delta = {c: row[c] - (previous[c] if previous else 0) for c in WAIT_COUNTERS}
+        if delta['wait_time_ms'] > 0 or delta['waiting_tasks_count'] > 0:
+            waits.append({'wait_type': wait_type, **delta})
+    waits.sort(key=lambda w: w['wait_time_ms'], reverse=True)
+
+    result = {
+        'statements': statements,
+        'waits': waits,
+        'wait_time_ms': sum(w['wait_time_ms'] for w in waits)
+    }
+
+    if procedure:
+        result.update({
+            'executions': procedure['execution_count'],
+            'worker_time_ms': procedure['total_worker_time'] / 1000,
+            'elapsed_ms': procedure['total_elapsed_time'] / 1000,
+            'logical_reads': procedure['total_logical_reads'],
+            'logical_writes': procedure['total_logical_writes'],
+            'physical_reads': procedure['total_physical_reads'],
+            'rows': sum(s['rows'] for s in statements)
+        })
+    return result
+
+
+def split_server_time(duration_ms, server):
+    """用客户端墙钟减去服务器耗时，得到网络传输和结果获取的开销"""
+    if not server or server.get('elapsed_ms') is None:
+        return None
+    return max(duration_ms - server['elapsed_ms'], 0.0)
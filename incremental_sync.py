@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+远程视图增量同步
+按数据源维护高水位(修改时间或rowversion)，只拉取变化的行，按有界分块读取，
+通过 fast_executemany 写入临时暂存表后 MERGE(或删除后批量插入)到本地物化表，
+高水位与数据在同一事务提交；高水位列为 NULL 的行无法增量识别，每次按主键重新同步；
+报告同步延迟和行/秒，使报表语句可以关联本地表而不是跨库/跨服务器视图
+"""
+
+import json
+import time
+from datetime import datetime
+
+from db_connection import connect
+
+SYNC_METHODS = ('merge', 'executemany')
+WATERMARK_TYPES = ('datetime', 'rowversion')
+
+DEFAULT_CHUNK_SIZE = 5000
+
+SYNC_SOURCES = [
+    {
+        'name': 'ProductionDetailsAndLPM',
+        'source_database': 'logistics-test',
+        'source_object': 'dbo.View_GetProductionDetailsAndLPM',
+        'key_columns': ['Id'],
+        'watermark_column': 'LastModificationTime',
+        'watermark_type': 'datetime',
+        'target_database': 'Statistics-CT-test',
+        'target_table': 'dbo.ProductionDetailsAndLPM_Local'
+    },
+    {
+        'name': 'ProductionFactAmt',
+        'source_database': 'logistics-mt-prod',
+        'source_object': 'dbo.View_GetProductionFactAmt',
+        'key_columns': ['ProductionDetailId', 'Material'],
+        'watermark_column': 'ModifyTime',
+        'watermark_type': 'datetime',
+        'target_database': 'Statistics-CT-test',
+        'target_table': 'dbo.Production_Fact_Local'
+    }
+]
+
+WATERMARK_TABLE_SQL = """
+IF OBJECT_ID('dbo.SyncWatermarks') IS NULL
+    CREATE TABLE dbo.SyncWatermarks (
+        SourceName NVARCHAR(128) NOT NULL PRIMARY KEY,
+        WatermarkType NVARCHAR(20) NOT NULL,
+        Watermark NVARCHAR(64) NULL,
+        LastKey NVARCHAR(400) NULL,
+        LastSyncTime DATETIME NOT NULL,
+        LastRows BIGINT NOT NULL
+    )
+"""
+
+UPSERT_WATERMARK_SQL = """
+MERGE dbo.SyncWatermarks AS t
+USING (SELECT ? AS SourceName, ? AS WatermarkType, ? AS Watermark, ? AS LastKey, ? AS LastRows) AS s
+    ON t.SourceName = s.SourceName
+WHEN MATCHED THEN UPDATE SET Watermark = s.Watermark, LastKey = s.LastKey,
+                             LastSyncTime = GETDATE(), LastRows = s.LastRows
+WHEN NOT MATCHED THEN INSERT (SourceName, WatermarkType, Watermark, LastKey, LastSyncTime, LastRows)
+                      VALUES (s.SourceName, s.WatermarkType, s.Watermark, s.LastKey, GETDATE(), s.LastRows);
+"""
+
+DESCRIBE_SQL = """
+SELECT name, system_type_name, is_nullable
+FROM sys.dm_exec_describe_first_result_set(?, NULL, 0)
+WHERE is_hidden = 0
+ORDER BY column_ordinal
+"""
+
+
+def _quote(name):
+    return f"[{name.strip('[]')}]"
+
+
+def _encode_watermark(value, watermark_type):
+    """高水位以文本保存：datetime 用ISO格式，rowversion 用十六进制"""
+    if value is None:
+        return None
+    if watermark_type == 'rowversion':
+        return bytes(value).hex()
+    return value.isoformat(sep=' ', timespec='microseconds')
+
+
+def _decode_watermark(text, watermark_type):
+    if text is None:
+        return None
+    if watermark_type == 'rowversion':
+        return bytes.fromhex(text)
+    return datetime.fromisoformat(text)
+
+
+def keyset_predicate(columns):
+    """
+    生成 (c1, c2, ...) > (?, ?, ...) 的展开形式，用于按高水位+主键分页
+
+    返回 (sql, 取值顺序)，取值顺序为各占位符对应的列下标
+    """
+    clauses, order = [], []
+    for i, column in enumerate(columns):
+        terms = [f"{_quote(c)} = ?" for c in columns[:i]] + [f"{_quote(column)} > ?"]
+        clauses.append('(' + ' AND '.join(terms) + ')')
+        order.extend(range(i + 1))
+    return ' OR '.join(clauses), order
+
+
+def describe_source(conn, source):
+    """读取源视图/表的列名和类型"""
+    columns = source.get('columns')
+    cursor = conn.cursor()
+    try:
+        select_list = ', '.join(_quote(c) for c in columns) if columns else '*'
+        cursor.execute(DESCRIBE_SQL, f"SELECT {select_list} FROM {source['source_object']}")
+        return [(row.name, row.system_type_name, bool(row.is_nullable)) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def ensure_target(conn, source, columns):
+    """目标表不存在时按源结构建表(主键为 key_columns)，并确保高水位表存在"""
+    key_columns = {c.lower() for c in source['key_columns']}
+    definitions = [
+        f"{_quote(name)} {sql_type} {'NOT NULL' if name.lower() in key_columns or not nullable else 'NULL'}"
+        for name, sql_type, nullable in columns
+    ]
+    definitions.append("SyncTime DATETIME NOT NULL DEFAULT GETDATE()")
+    definitions.append(f"PRIMARY KEY ({', '.join(_quote(c) for c in source['key_columns'])})")
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(WATERMARK_TABLE_SQL)
+        cursor.execute(f"IF OBJECT_ID(?) IS NULL CREATE TABLE {source['target_table']} ({', '.join(definitions)})",
+                       source['target_table'])
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def load_watermark(conn, source):
+    """读取上次同步的高水位和最后一行的主键"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT Watermark, LastKey FROM dbo.SyncWatermarks WHERE SourceName = ?", source['name'])
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if not row or row.Watermark is None:
+        return None, None
+    return _decode_watermark(row.Watermark, source['watermark_type']), json.loads(row.LastKey)
+
+
+def _upper_bound(conn, source):
+    """本次同步的上界：datetime 取开始时的最大修改时间；rowversion 取最小活动版本(避免漏掉未提交事务)"""
+    cursor = conn.cursor()
+    try:
+        if source['watermark_type'] == 'rowversion':
+            cursor.execute("SELECT MIN_ACTIVE_ROWVERSION()")
+        else:
+            cursor.execute(f"SELECT MAX({_quote(source['watermark_column'])}) FROM {source['source_object']}")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def _upsert_merge(cursor, table, column_names, key_columns, rows):
+    """fast_executemany 写入暂存表后 MERGE 到目标表"""
+    columns = ', '.join(_quote(c) for c in column_names)
+    cursor.execute(f"IF OBJECT_ID('tempdb..#sync_stage') IS NOT NULL DROP TABLE #sync_stage; "
+                   f"SELECT TOP 0 {columns} INTO #sync_stage FROM {table}")
+    cursor.fast_executemany = True
+    cursor.executemany(f"INSERT INTO #sync_stage ({columns}) VALUES ({', '.join('?' * len(column_names))})", rows)
+
+    on = ' AND '.join(f"t.{_quote(c)} = s.{_quote(c)}" for c in key_columns)
+    updates = ', '.join(f"{_quote(c)} = s.{_quote(c)}" for c in column_names
+                        if c.lower() not in {k.lower() for k in key_columns})
+    cursor.execute(f"""
+        MERGE {table} AS t
+        USING #sync_stage AS s ON {on}
+        {f'WHEN MATCHED THEN UPDATE SET {updates}, SyncTime = GETDATE()' if updates else ''}
+        WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({', '.join(f's.{_quote(c)}' for c in column_names)});
+        DROP TABLE #sync_stage;
+    """)
+
+
+def _upsert_executemany(cursor, table, column_names, key_columns, rows):
+    """按主键删除后 fast_executemany 批量插入"""
+    positions = [[c.lower() for c in column_names].index(k.lower()) for k in key_columns]
+    cursor.fast_executemany = True
+    cursor.executemany(f"DELETE FROM {table} WHERE {' AND '.join(f'{_quote(k)} = ?' for k in key_columns)}",
+                       [[row[p] for p in positions] for row in rows])
+    cursor.executemany(f"INSERT INTO {table} ({', '.join(_quote(c) for c in column_names)}) "
+                       f"VALUES ({', '.join('?' * len(column_names))})", rows)
+
+
+def _sync_null_watermarks(source_conn, target_conn, source, column_names, upsert, chunk_size, stats):
+    """高水位列为 NULL 的行过不了 > 高水位 的条件，按主键分页整体重新同步(不推进高水位)"""
+    key_columns = list(source['key_columns'])
+    positions = [[c.lower() for c in column_names].index(c.lower()) for c in key_columns]
+    predicate, order = keyset_predicate(key_columns)
+    select_list = ', '.join(_quote(c) for c in column_names)
+    order_by = ', '.join(_quote(c) for c in key_columns)
+    last_key = None
+    while True:
+        where = [f"{_quote(source['watermark_column'])} IS NULL"]
+        values = []
+        if last_key is not None:
+            where.append(f"({predicate})")
+            values.extend(last_key[i] for i in order)
+
+        read_start = time.perf_counter()
+        cursor = source_conn.cursor()
+        try:
+            cursor.execute(f"SELECT TOP ({int(chunk_size)}) {select_list} FROM {source['source_object']} "
+                           f"WHERE {' AND '.join(where)} ORDER BY {order_by}", *values)
+            rows = [list(row) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            source_conn.rollback()
+        stats['read_ms'] += (time.perf_counter() - read_start) * 1000
+        if not rows:
+            break
+        last_key = [rows[-1][p] for p in positions]
+
+        write_start = time.perf_counter()
+        cursor = target_conn.cursor()
+        try:
+            upsert(cursor, source['target_table'], column_names, key_columns, rows)
+            target_conn.commit()
+        except Exception:
+            target_conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        stats['write_ms'] += (time.perf_counter() - write_start) * 1000
+
+        stats['rows'] += len(rows)
+        stats['null_watermark_rows'] += len(rows)
+        if len(rows) < chunk_size:
+            break
+
+
+def sync_source(source, method='merge', chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    同步一个数据源
+
+    每块按 (高水位列, 主键) 排序读取 chunk_size 行，写入目标表后与高水位一起提交，
+    中途失败时下次从最后一个已提交的块继续；之后再重同步高水位列为 NULL 的行
+    """
+    if method not in SYNC_METHODS:
+        raise ValueError(f"未知的同步方式: {method}")
+    if source['watermark_type'] not in WATERMARK_TYPES:
+        raise ValueError(f"未知的高水位类型: {source['watermark_type']}")
+
+    order_columns = [source['watermark_column']] + list(source['key_columns'])
+    source_conn = connect(source['source_database'])
+    target_conn = connect(source['target_database'])
+    stats = {'source': source['name'], 'method': method, 'rows': 0, 'chunks': 0, 'null_watermark_rows': 0,
+             'read_ms': 0.0, 'write_ms': 0.0, 'start_time': datetime.now().isoformat()}
+
+    try:
+        columns = describe_source(source_conn, source)
+        column_names = [name for name, _, _ in columns]
+        ensure_target(target_conn, source, columns)
+        watermark, last_key = load_watermark(target_conn, source)
+        upper = _upper_bound(source_conn, source)
+        stats['watermark_before'] = _encode_watermark(watermark, source['watermark_type'])
+
+        positions = [[c.lower() for c in column_names].index(c.lower()) for c in order_columns]
+        predicate, order = keyset_predicate(order_columns)
+        bound = '<' if source['watermark_type'] == 'rowversion' else '<='
+        select_list = ', '.join(_quote(c) for c in column_names)
+        order_by = ', '.join(_quote(c) for c in order_columns)
+        upsert = _upsert_merge if method == 'merge' else _upsert_executemany
+
+        sync_start = time.perf_counter()
+        while upper is not None:
+            where = [f"{_quote(source['watermark_column'])} {bound} ?"]
+            values = [upper]
+            if watermark is not None:
+                position = [watermark] + list(last_key)
+                where.append(f"({predicate})")
+                values.extend(position[i] for i in order)
+
+            read_start = time.perf_counter()
+            cursor = source_conn.cursor()
+            try:
+                cursor.execute(f"SELECT TOP ({int(chunk_size)}) {select_list} FROM {source['source_object']} "
+                               f"WHERE {' AND '.join(where)} ORDER BY {order_by}", *values)
+                rows = [list(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+                source_conn.rollback()
+            stats['read_ms'] += (time.perf_counter() - read_start) * 1000
+            if not rows:
+                break
+
+            last = rows[-1]
+            watermark = last[positions[0]]
+            last_key = [last[p] for p in positions[1:]]
+
+            write_start = time.perf_counter()
+            cursor = target_conn.cursor()
+            try:
+                upsert(cursor, source['target_table'], column_names, source['key_columns'], rows)
+                cursor.execute(UPSERT_WATERMARK_SQL, source['name'], source['watermark_type'],
+                               _encode_watermark(watermark, source['watermark_type']),
+                               json.dumps(last_key, ensure_ascii=False, default=str), len(rows))
+                target_conn.commit()
+            except Exception:
+                target_conn.rollback()
+                raise
+            finally:
+                cursor.close()
+            stats['write_ms'] += (time.perf_counter() - write_start) * 1000
+
+            stats['rows'] += len(rows)
+            stats['chunks'] += 1
+            print(f"  [{source['name']}] 第 {stats['chunks']} 块: {len(rows):,} 行, 累计 {stats['rows']:,} 行")
+            if len(rows) < chunk_size:
+                break
+
+        _sync_null_watermarks(source_conn, target_conn, source, column_names, upsert, chunk_size, stats)
+        if stats['null_watermark_rows']:
+            print(f"  [{source['name']}] 高水位为 NULL 的行: {stats['null_watermark_rows']:,} 行")
+
+        elapsed_s = time.perf_counter() - sync_start
+        stats['elapsed_s'] = elapsed_s
+        stats['rows_per_s'] = stats['rows'] / elapsed_s if elapsed_s else 0.0
+        stats['watermark_after'] = _encode_watermark(watermark, source['watermark_type'])
+        stats['lag_s'] = measure_lag(source_conn, source, watermark)
+    finally:
+        source_conn.close()
+        target_conn.close()
+
+    stats['end_time'] = datetime.now().isoformat()
+    return stats
+
+
+def measure_lag(conn, source, watermark):
+    """
+    同步延迟：datetime 为源端最大修改时间与已同步高水位之差(秒)，源端空闲且已同步完时为 0；
+    rowversion 无法换算为时间，返回 None
+    """
+    if watermark is None or source['watermark_type'] != 'datetime':
+        return None
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT MAX({_quote(source['watermark_column'])}) FROM {source['source_object']}")
+        latest = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.rollback()
+    if latest is None:
+        return 0.0
+    return max((latest - watermark).total_seconds(), 0.0)
+
+
+def run_schedule(sources, interval_s=900, iterations=None, method='merge', chunk_size=DEFAULT_CHUNK_SIZE):
+    """按固定间隔循环同步(默认15分钟)；iterations 为 None 时一直运行"""
+    history = []
+    iteration = 0
+    while iterations is None or iteration < iterations:
+        iteration += 1
+        started = time.perf_counter()
+        print(f"\n[*] 第 {iteration} 次同步 ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')})")
+        for source in sources:
+            try:
+                stats = sync_source(source, method, chunk_size)
+                lag = f"{stats['lag_s']:.0f} 秒" if stats['lag_s'] is not None else '-'
+                print(f"[+] {source['name']}: {stats['rows']:,} 行, {stats['rows_per_s']:,.0f} 行/秒, 延迟 {lag}")
+            except Exception as e:
+                stats = {'source': source['name'], 'error': str(e), 'end_time': datetime.now().isoformat()}
+                print(f"[-] {source['name']} 同步失败: {e}")
+            history.append(stats)
+
+        if iterations is not None and iteration >= iterations:
+            break
+        time.sleep(max(interval_s - (time.perf_counter() - started), 0))
+    return history
+
+
+def main():
+    """主函数"""
+    print("=" * 60)
+    print("远程视图增量同步")
+    print("=" * 60)
+
+    history = run_schedule(SYNC_SOURCES, iterations=1, method='merge')
+
+    output_file = f"sync_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, indent=2, default=str)
+    print(f"[+] 结果已保存到: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+缺失索引合并工具
+解析各优化目录下手写的索引脚本，读取线上已有索引和 sys.dm_db_missing_index_* 建议，
+合并为最小索引集合：识别完全重复、左前缀冗余以及可合并INCLUDE列的索引，
+避免热点表为冗余索引付出写入和存储开销
+"""
+
+import os
+import re
+from datetime import datetime
+
+from db_connection import connect
+
+INDEX_SCRIPTS = [
+    'usp_UpdateProjectRiskRelationInfo优化/Create_Indexes.sql',
+    'cashflowBalance存储过程优化/CashFlowBalance_Indexes.sql',
+    'INSERT_ProductionDailyReportDetails优化/ProductionDailyReportDetails_INSERT_Indexes.sql',
+    'UPDATE-ins优化/WbMaterialIns_UPDATE_Indexes.sql'
+]
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+# 来源优先级：线上已存在的索引优先保留，其次是脚本，最后是DMV建议
+SOURCE_PRIORITY = {'live': 0, 'script': 1, 'dmv': 2}
+
+_STATEMENT_RE = re.compile(
+    r"\bUSE\s+\[?(?P<database>[\w\-]+)\]?"
+    r"|\bCREATE\s+(?P<unique>UNIQUE\s+)?(?:(?P<kind>CLUSTERED|NONCLUSTERED)\s+)?INDEX\s+(?P<name>\[?\w+\]?)"
+    r"\s+ON\s+(?P<table>[\w\.\[\]\-]+)\s*\((?P<keys>[^)]*)\)"
+    r"(?:\s*INCLUDE\s*\((?P<include>[^)]*)\))?"
+    r"(?:\s*WHERE\s+(?P<filter>.+?)(?=\s+WITH\b|;|\bGO\b|$))?",
+    re.I | re.S
+)
+
+LIVE_INDEXES_SQL = """
+SELECT sch.name AS schema_name, t.name AS table_name, i.name AS index_name, i.is_unique, i.is_primary_key,
+       i.type_desc, i.filter_definition, c.name AS column_name, ic.key_ordinal, ic.is_descending_key,
+       ic.is_included_column,
+       ISNULL(us.user_seeks + us.user_scans + us.user_lookups, 0) AS user_reads,
+       ISNULL(us.user_updates, 0) AS user_updates
+FROM sys.indexes i
+INNER JOIN sys.tables t ON t.object_id = i.object_id
+INNER JOIN sys.schemas sch ON sch.schema_id = t.schema_id
+INNER JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+INNER JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+LEFT JOIN sys.dm_db_index_usage_stats us
+    ON us.database_id = DB_ID() AND us.object_id = i.object_id AND us.index_id = i.index_id
+WHERE i.type IN (1, 2) AND t.is_ms_shipped = 0
+ORDER BY sch.name, t.name, i.index_id, ic.is_included_column, ic.key_ordinal, ic.index_column_id
+"""
+
+MISSING_INDEXES_SQL = """
+SELECT OBJECT_SCHEMA_NAME(d.object_id, d.database_id) AS schema_name,
+       OBJECT_NAME(d.object_id, d.database_id) AS table_name,
+       d.equality_columns, d.inequality_columns, d.included_columns,
+       s.user_seeks, s.user_scans, s.avg_total_user_cost, s.avg_user_impact
+FROM sys.dm_db_missing_index_details d
+INNER JOIN sys.dm_db_missing_index_groups g ON g.index_handle = d.index_handle
+INNER JOIN sys.dm_db_missing_index_group_stats s ON s.group_handle = g.index_group_handle
+WHERE d.database_id = DB_ID()
+"""
+
+
+def _strip_comments_and_strings(sql):
+    """去掉注释并清空字符串内容(PRINT 中的示例语句不应被当作索引定义)"""
+    return re.sub(r"--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'", lambda m: "''" if m.group(0).startswith("'") else ' ',
+                  sql, flags=re.S)
+
+
+def _clean_name(name):
+    return name.strip().strip('[]')
+
+
+def normalize_table(table):
+    """统一表名为 schema.table 形式"""
+    parts = [_clean_name(p) for p in table.split('.') if p.strip()]
+    if len(parts) == 1:
+        parts.insert(0, 'dbo')
+    return '.'.join(parts[-2:])
+
+
+def _parse_key_columns(text):
+    keys = []
+    for column in text.split(','):
+        tokens = column.split()
+        if not tokens:
+            continue
+        direction = tokens[1].upper() if len(tokens) > 1 and tokens[1].upper() in ('ASC', 'DESC') else 'ASC'
+        keys.append((_clean_name(tokens[0]), direction))
+    return keys
+
+
+def _parse_column_list(text):
+    return [_clean_name(c) for c in (text or '').split(',') if c.strip()]
+
+
+def make_index(database, table, name, keys, include=(), unique=False, clustered=False, primary_key=False,
+               filter_definition=None, source='script', origin=None, reads=None, writes=None):
+    """构造统一的索引描述"""
+    return {
+        'database': database,
+        'table': normalize_table(table),
+        'name': name,
+        'keys': list(keys),
+        'include': list(dict.fromkeys(include)),
+        'unique': unique,
+        'clustered': clustered,
+        'primary_key': primary_key,
+        'filter': ' '.join(filter_definition.split()) if filter_definition else None,
+        'source': source,
+        'origin': origin,
+        'reads': reads,
+        'writes': writes,
+        'absorbed': []
+    }
+
+
+def parse_index_script(path, default_database=DEFAULT_DATABASE):
+    """解析索引脚本中的 CREATE INDEX 语句，按 USE 语句确定所属数据库"""
+    with open(path, encoding='utf-8-sig') as f:
+        sql = _strip_comments_and_strings(f.read())
+
+    database = default_database
+    indexes = []
+    for match in _STATEMENT_RE.finditer(sql):
+        if match.group('database'):
+            database = match.group('database')
+            continue
+        indexes.append(make_index(
+            database, match.group('table'), _clean_name(match.group('name')),
+            _parse_key_columns(match.group('keys')), _parse_column_list(match.group('include')),
+            unique=bool(match.group('unique')),
+            clustered=(match.group('kind') or '').upper() == 'CLUSTERED',
+            filter_definition=match.group('filter'),
+            source='script', origin=os.path.basename(path)
+        ))
+    return indexes
+
+
+def load_live_indexes(conn, database):
+    """读取线上已有的聚集/非聚集索引及其读写次数"""
+    cursor = conn.cursor()
+    cursor.execute(LIVE_INDEXES_SQL)
+    indexes = {}
+    for row in cursor.fetchall():
+        key = (row.schema_name, row.table_name, row.index_name)
+        index = indexes.get(key)
+        if index is None:
+            index = indexes[key] = make_index(
+                database, f"{row.schema_name}.{row.table_name}", row.index_name, [],
+                unique=bool(row.is_unique), clustered=row.type_desc == 'CLUSTERED',
+                primary_key=bool(row.is_primary_key), filter_definition=row.filter_definition,
+                source='live', origin=database, reads=row.user_reads, writes=row.user_updates
+            )
+        if row.is_included_column:
+            index['include'].append(row.column_name)
+        elif row.key_ordinal:
+            index['keys'].append((row.column_name, 'DESC' if row.is_descending_key else 'ASC'))
+    cursor.close()
+    return list(indexes.values())
+
+
+def load_missing_indexes(conn, database):
+    """读取 sys.dm_db_missing_index_* 中的缺失索引建议"""
+    cursor = conn.cursor()
+    cursor.execute(MISSING_INDEXES_SQL)
+    indexes = []
+    for row in cursor.fetchall():
+        keys = [(c, 'ASC') for c in _parse_column_list(row.equality_columns) + _parse_column_list(row.inequality_columns)]
+        name = f"IX_{row.table_name}_{'_'.join(c for c, _ in keys[:3])}_Missing"
+        index = make_index(database, f"{row.schema_name}.{row.table_name}", name, keys,
+                           _parse_column_list(row.included_columns), source='dmv', origin='dm_db_missing_index',
+                           reads=row.user_seeks + row.user_scans)
+        index['impact'] = float(row.avg_user_impact or 0)
+        indexes.append(index)
+    cursor.close()
+    return indexes
+
+
+def _lower_keys(index):
+    return [(c.lower(), d) for c, d in index['keys']]
+
+
+def _is_protected(index):
+    """聚集索引、主键和唯一索引承担约束语义，不作为被合并的一方"""
+    return index['clustered'] or index['primary_key'] or index['unique']
+
+
+def _covered_columns(index):
+    return {c.lower() for c, _ in index['keys']} | {c.lower() for c in index['include']}
+
+
+def _absorb(kept, index, reason):
+    """把 index 合并进 kept：补齐 INCLUDE 列并记录合并原因"""
+    covered = _covered_columns(kept)
+    extra = [c for c in [k for k, _ in index['keys']] + index['include'] if c.lower() not in covered]
+    if extra and not kept['clustered']:
+        kept['include'].extend(extra)
+        kept['include_changed'] = True
+    kept['absorbed'].append({'index': index, 'reason': reason, 'added_include': extra if not kept['clustered'] else []})
+
+
+def consolidate(indexes):
+    """
+    合并为最小索引集合
+
+    返回 (最终保留的索引列表, 被合并掉的 (索引, 原因, 保留索引) 列表)
+    """
+    by_table = {}
+    for index in indexes:
+        by_table.setdefault((index['database'], index['table'].lower()), []).append(index)
+
+    final, removed = [], []
+    for _, table_indexes in sorted(by_table.items()):
+        ordered = sorted(table_indexes, key=lambda i: (not _is_protected(i), -len(i['keys']),
+                                                       SOURCE_PRIORITY[i['source']]))
+        kept = []
+        for index in ordered:
+            target, reason = None, None
+            if not _is_protected(index):
+                keys = _lower_keys(index)
+                for candidate in kept:
+                    if candidate['filter'] != index['filter']:
+                        continue
+                    candidate_keys = _lower_keys(candidate)
+                    if candidate_keys == keys:
+                        extra = _covered_columns(index) - _covered_columns(candidate)
+                        if extra and (candidate['clustered'] or candidate['primary_key']):
+                            continue
+                        target, reason = candidate, 'include_merge' if extra else 'duplicate'
+                        break
+                    if candidate_keys[:len(keys)] == keys and not (candidate['clustered'] or candidate['primary_key']):
+                        target, reason = candidate, 'left_prefix'
+                        break
+
+            if target is None:
+                kept.append(index)
+            else:
+                _absorb(target, index, reason)
+                removed.append((index, reason, target))
+        final.extend(kept)
+
+    return final, removed
+
+
+def _format_keys(index):
+    return ', '.join(f"[{c}]" + (' DESC' if d == 'DESC' else '') for c, d in index['keys'])
+
+
+def _format_include(index):
+    return f"\n    INCLUDE ({', '.join(f'[{c}]' for c in index['include'])})" if index['include'] else ''
+
+
+def _format_filter(index):
+    return f"\n    WHERE {index['filter']}" if index['filter'] else ''
+
+
+def generate_script(final, removed):
+    """生成合并后的索引脚本：新建、补齐INCLUDE列(DROP_EXISTING)以及删除冗余的线上索引"""
+    lines = [
+        '-- ============================================',
+        '-- 合并后的索引脚本',
+        f"-- 生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+        '-- ============================================',
+        ''
+    ]
+    database = None
+
+    def use(db):
+        nonlocal database
+        if db != database:
+            lines.extend([f"USE [{db}];", 'GO', ''])
+            database = db
+
+    for index in final:
+        if index['source'] == 'live' and not index.get('include_changed'):
+            continue
+        use(index['database'])
+        unique = 'UNIQUE ' if index['unique'] else ''
+        kind = 'CLUSTERED' if index['clustered'] else 'NONCLUSTERED'
+        options = 'DROP_EXISTING = ON, ONLINE = ON, SORT_IN_TEMPDB = ON' if index['source'] == 'live' \
+            else 'ONLINE = ON, SORT_IN_TEMPDB = ON, FILLFACTOR = 90'
+        merged = ', '.join(a['index']['name'] for a in index['absorbed'])
+        lines.append(f"-- 来源: {index['source']} ({index['origin']})" + (f", 合并: {merged}" if merged else ''))
+        lines.append(f"CREATE {unique}{kind} INDEX [{index['name']}]\n    ON {index['table']} ({_format_keys(index)})"
+                     f"{_format_include(index)}{_format_filter(index)}\n    WITH ({options});")
+        lines.extend(['GO', ''])
+
+    for index, reason, target in removed:
+        if index['source'] != 'live':
+            continue
+        use(index['database'])
+        lines.append(f"-- {reason}: 已被 {target['name']} 覆盖 (读 {index['reads']}, 写 {index['writes']})")
+        lines.append(f"DROP INDEX [{index['name']}] ON {index['table']};")
+        lines.extend(['GO', ''])
+
+    return '\n'.join(lines)
+
+
+def print_summary(final, removed):
+    """打印合并结论"""
+    reasons = {'duplicate': '完全重复', 'left_prefix': '左前缀冗余', 'include_merge': '可合并INCLUDE列'}
+    print(f"\n[+] 合并结果: 保留 {len(final)} 个索引, 合并/删除 {len(removed)} 个")
+    for index, reason, target in removed:
+        cost = f" (线上写入 {index['writes']:,} 次)" if index['source'] == 'live' and index['writes'] else ''
+        print(f"  - [{reasons[reason]}] {index['database']}.{index['table']}.{index['name']} "
+              f"({index['source']}) -> {target['name']}{cost}")
+    for index in final:
+        if index.get('include_changed') or index['source'] != 'live':
+            print(f"  + {index['database']}.{index['table']}.{index['name']} ({index['source']}): "
+                  f"({_format_keys(index)}) INCLUDE ({', '.join(index['include'])})")
+
+
+def main():
+    """主函数"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+
+    indexes = []
+    for script in INDEX_SCRIPTS:
+        parsed = parse_index_script(os.path.join(base_dir, script))
+        print(f"[+] {script}: {len(parsed)} 个索引定义")
+        indexes.extend(parsed)
+
+    for database in sorted({i['database'] for i in indexes}):
+        conn = connect(database)
+        try:
+            tables = {i['table'].lower() for i in indexes if i['database'] == database}
+            live = [i for i in load_live_indexes(conn, database) if i['table'].lower() in tables]
+            missing = [i for i in load_missing_indexes(conn, database) if i['table'].lower() in tables]
+            print(f"[+] {database}: 线上索引 {len(live)} 个, 缺失索引建议 {len(missing)} 个")
+            indexes.extend(live + missing)
+        finally:
+            conn.close()
+
+    final, removed = consolidate(indexes)
+    print_summary(final, removed)
+
+    output_file = f"Consolidated_Indexes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(generate_script(final, removed))
+    print(f"\n[+] 合并后的索引脚本已保存到: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
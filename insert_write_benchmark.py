@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+INSERT 写入路径基准测试
+执行真实的 INSERT ... SELECT(及客户端 fast_executemany 变体)，
+把目标表的索引维护、日志写入和触发器开销一并计入；
+每次写入都在事务内完成并始终回滚，按批大小扫描，报告行/秒、日志字节数和持有的锁数量
+"""
+
+import json
+import re
+import time
+from datetime import datetime, timedelta
+
+from db_connection import connect
+from param_binding import bind_statement
+from query_watchdog import StatementWatchdog, timeout_message
+from timing_harness import percentile
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+INSERT_SQL_FILE = 'INSERT_ProductionDailyReportDetails优化/ProductionDailyReportDetails_INSERT_Optimized_V1.sql'
+
+# insert_select: 原语句一次性 INSERT ... SELECT；
+# insert_select_batched: 源数据先暂存，再按批 INSERT ... SELECT；
+# fast_executemany: 源数据取到客户端，按批参数数组插入
+WRITE_STRATEGIES = ('insert_select', 'insert_select_batched', 'fast_executemany')
+DEFAULT_BATCH_SIZES = (500, 2000, 10000)
+
+STAGE_TABLE = '#write_source'
+STAGE_ROW_COLUMN = 'write_rn'
+
+# 与存储过程一致；@ReportDate 参与 DATEADD(HOUR, ...)，须按 DATETIME 绑定
+WRITE_PARAM_TYPES = {
+    'Creator': 'NVARCHAR(50)',
+    'TenantID': 'INT',
+    'ReportDate': 'DATETIME',
+    'DefaultDepartment': 'NVARCHAR(50)',
+    'DefaultPaymentType': 'NVARCHAR(50)',
+    'DefaultProductCategory': 'NVARCHAR(50)',
+    'DefaultUnit': 'NVARCHAR(10)',
+    'DefaultGHSJUnit': 'NVARCHAR(10)',
+    'ProCoeff': 'DECIMAL(18, 4)',
+    'DefaultFinancialTime': 'INT'
+}
+
+# 当前会话事务在各库产生的日志量(触发器写入其他库时也能看到)
+TRAN_LOG_SQL = """
+SELECT DB_NAME(dt.database_id) AS database_name,
+       SUM(dt.database_transaction_log_record_count) AS log_records,
+       SUM(dt.database_transaction_log_bytes_used) AS log_bytes,
+       SUM(dt.database_transaction_log_bytes_reserved) AS log_bytes_reserved
+FROM sys.dm_tran_session_transactions st
+INNER JOIN sys.dm_tran_database_transactions dt ON dt.transaction_id = st.transaction_id
+WHERE st.session_id = @@SPID
+GROUP BY dt.database_id
+"""
+
+# 当前会话事务持有的锁，按资源类型和模式汇总(出现 OBJECT X 说明已锁升级)
+TRAN_LOCKS_SQL = """
+SELECT resource_type, request_mode, DB_NAME(resource_database_id) AS database_name, COUNT(*) AS lock_count
+FROM sys.dm_tran_locks
+WHERE request_session_id = @@SPID AND request_owner_type = 'TRANSACTION'
+GROUP BY resource_type, request_mode, resource_database_id
+"""
+
+
+def load_insert_statement(path=INSERT_SQL_FILE):
+    """
+    读取 INSERT 脚本，返回 (statement, target, columns)
+
+    去掉脚本末尾的 SELECT @@ROWCOUNT 查看语句，解析目标表和列清单
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        sql = f.read()
+    sql = re.split(r'^\s*SELECT\s+@@ROWCOUNT\b', sql, flags=re.I | re.M)[0].rstrip().rstrip(';')
+    match = re.search(r'\bINSERT\s+INTO\s+([\w\.\[\]-]+)\s*\((.*?)\)\s*SELECT\b', sql, re.I | re.S)
+    if not match:
+        raise ValueError(f"未找到 INSERT INTO ... (列清单) SELECT: {path}")
+    columns = [c.strip() for c in re.sub(r'--[^\n]*', '', match.group(2)).split(',') if c.strip()]
+    return sql, match.group(1), columns
+
+
+def redirect_insert(statement, target, new_target):
+    """把 INSERT INTO 的目标表换成 new_target，SELECT 部分保持不变"""
+    pattern = rf'\bINSERT\s+INTO\s+{re.escape(target)}(?=\s*\()'
+    return re.sub(pattern, lambda _: f"INSERT INTO {new_target}", statement, count=1, flags=re.I)
+
+
+def batch_ranges(total, batch_size):
+    """按批大小切分 1..total 的行号区间 [(起, 止)]"""
+    if not batch_size or batch_size >= total:
+        return [(1, total)] if total else []
+    return [(start, min(start + batch_size - 1, total)) for start in range(1, total + 1, batch_size)]
+
+
+def _rows_as_dicts(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def stage_source(conn, statement, target, columns, params):
+    """
+    把 SELECT 部分的结果暂存到临时表，供分批写入和客户端写入使用
+
+    临时表结构取自目标表的列定义，并附加自增行号用于分批；返回暂存行数和耗时
+    """
+    cursor = conn.cursor()
+    column_list = ', '.join(columns)
+    try:
+        cursor.execute(f"IF OBJECT_ID('tempdb..{STAGE_TABLE}') IS NOT NULL DROP TABLE {STAGE_TABLE}")
+        cursor.execute(f"SELECT TOP 0 {column_list} INTO {STAGE_TABLE} FROM {target}")
+        cursor.execute(f"ALTER TABLE {STAGE_TABLE} ADD {STAGE_ROW_COLUMN} INT IDENTITY(1, 1) PRIMARY KEY")
+
+        started = time.perf_counter()
+        exec_sql, args, _ = bind_statement(redirect_insert(statement, target, STAGE_TABLE), params,
+                                           WRITE_PARAM_TYPES)
+        cursor.execute(exec_sql, *args)
+        while cursor.nextset():
+            pass
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        cursor.execute(f"SELECT COUNT(*) FROM {STAGE_TABLE}")
+        rows = cursor.fetchone()[0]
+        # 只提交了临时表，目标表未被触碰
+        conn.commit()
+    finally:
+        cursor.close()
+    return {'rows': rows, 'elapsed_ms': round(elapsed_ms, 1)}
+
+
+def measure_transaction(cursor):
+    """在回滚前读取当前事务的日志量和锁数量"""
+    cursor.execute("SELECT @@TRANCOUNT")
+    trancount = cursor.fetchone()[0]
+    cursor.execute(TRAN_LOG_SQL)
+    log = _rows_as_dicts(cursor)
+    cursor.execute(TRAN_LOCKS_SQL)
+    locks = _rows_as_dicts(cursor)
+
+    by_type = {}
+    for lock in locks:
+        key = f"{lock['resource_type']}:{lock['request_mode']}"
+        by_type[key] = by_type.get(key, 0) + lock['lock_count']
+    return {
+        'trancount': trancount,
+        'log_bytes': sum(row['log_bytes'] or 0 for row in log),
+        'log_records': sum(row['log_records'] or 0 for row in log),
+        'log_by_database': {row['database_name']: row['log_bytes'] or 0 for row in log},
+        'lock_count': sum(by_type.values()),
+        'locks_by_type': by_type,
+        'escalated': any(lock['resource_type'] == 'OBJECT' and lock['request_mode'] in ('X', 'SIX')
+                         for lock in locks)
+    }
+
+
+def _write(cursor, strategy, statement, target, columns, params, batch_size, stage_rows, client_rows):
+    """执行一次写入，返回 (写入行数, 批次数)"""
+    column_list = ', '.join(columns)
+    if strategy == 'insert_select':
+        exec_sql, args, _ = bind_statement(statement, params, WRITE_PARAM_TYPES)
+        cursor.execute(exec_sql, *args)
+        rows = cursor.rowcount if cursor.rowcount is not None else -1
+        while cursor.nextset():
+            if cursor.rowcount not in (None, -1):
+                rows = cursor.rowcount
+        return rows, 1
+
+    ranges = batch_ranges(stage_rows, batch_size)
+    if strategy == 'insert_select_batched':
+        sql = (f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {STAGE_TABLE} "
+               f"WHERE {STAGE_ROW_COLUMN} BETWEEN ? AND ?")
+        rows = 0
+        for first, last in ranges:
+            cursor.execute(sql, first, last)
+            rows += cursor.rowcount
+        return rows, len(ranges)
+
+    # fast_executemany: 源数据预先取到客户端，计时只包含参数数组插入
+    placeholders = ', '.join('?' for _ in columns)
+    sql = f"INSERT INTO {target} ({column_list}) VALUES ({placeholders})"
+    cursor.fast_executemany = True
+    rows = 0
+    for first, last in ranges:
+        cursor.executemany(sql, client_rows[first - 1:last])
+        rows += last - first + 1
+    return rows, len(ranges)
+
+
+def fetch_stage_rows(conn, columns):
+    """按行号顺序读取暂存数据到客户端"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT {', '.join(columns)} FROM {STAGE_TABLE} ORDER BY {STAGE_ROW_COLUMN}")
+        return [tuple(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def run_write(conn, strategy, statement, target, columns, params, batch_size=None, stage_rows=0,
+              client_rows=None, timeout_ms=None, setup_ms=0.0):
+    """
+    在事务内执行一次写入，读取日志量和锁后始终回滚
+
+    setup_ms 为该策略依赖的源数据准备耗时(暂存/取到客户端)，计入行/秒，
+    使其与自带 SELECT 的 insert_select 可比；elapsed_ms 仍只是写入本身。
+    连接须为 autocommit=False；若回滚前发现事务已不存在(脚本自行提交)则报错中止
+    """
+    cursor = conn.cursor()
+    result = {'strategy': strategy, 'batch_size': batch_size, 'rows': 0, 'batches': 0,
+              'elapsed_ms': None, 'setup_ms': setup_ms, 'rows_per_s': None, 'timed_out': False, 'error': None}
+    started = time.perf_counter()
+    try:
+        with StatementWatchdog(cursor, timeout_ms) as watchdog:
+            try:
+                result['rows'], result['batches'] = _write(cursor, strategy, statement, target, columns, params,
+                                                           batch_size, stage_rows, client_rows or [])
+            except Exception as e:
+                result['error'] = str(e)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        result['elapsed_ms'] = round(elapsed_ms, 1)
+        if watchdog.fired:
+            result['timed_out'] = True
+            result['error'] = timeout_message(watchdog.fired_at_ms)
+        elif not result['error']:
+            total_ms = elapsed_ms + setup_ms
+            if result['rows'] > 0 and total_ms > 0:
+                result['rows_per_s'] = round(result['rows'] / (total_ms / 1000), 1)
+            result.update(measure_transaction(cursor))
+            if not result['trancount']:
+                raise RuntimeError("写入后事务已不存在，语句可能自行提交，停止测试")
+    finally:
+        conn.rollback()
+        cursor.close()
+    return result
+
+
+def summarize_runs(runs):
+    """同一策略/批大小多轮结果取中位数"""
+    ok = [r for r in runs if not r['error']]
+    if not ok:
+        return {'rounds': len(runs), 'errors': len(runs), 'error': runs[-1]['error'] if runs else None}
+    elapsed = sorted(r['elapsed_ms'] for r in ok)
+    rates = sorted(r['rows_per_s'] for r in ok if r['rows_per_s'])
+    last = ok[-1]
+    return {
+        'rounds': len(runs),
+        'errors': len(runs) - len(ok),
+        'timeouts': sum(1 for r in runs if r['timed_out']),
+        'rows': last['rows'],
+        'batches': last['batches'],
+        'median_ms': round(percentile(elapsed, 50), 1),
+        'max_ms': elapsed[-1],
+        'setup_ms': last['setup_ms'],
+        'rows_per_s': round(percentile(rates, 50), 1) if rates else None,
+        'log_bytes': last['log_bytes'],
+        'log_records': last['log_records'],
+        'log_by_database': last['log_by_database'],
+        'lock_count': last['lock_count'],
+        'locks_by_type': last['locks_by_type'],
+        'escalated': last['escalated']
+    }
+
+
+def sweep_write_strategies(conn, params, batch_sizes=DEFAULT_BATCH_SIZES, strategies=WRITE_STRATEGIES,
+                           rounds=3, timeout_ms=None, path=INSERT_SQL_FILE):
+    """
+    按策略 × 批大小扫描写入路径
+
+    insert_select 为一次性整体写入，不受批大小影响，计时包含其 SELECT；
+    其余策略的行/秒计入源数据暂存耗时(fast_executemany 另加取到客户端的耗时)
+    """
+    statement, target, columns = load_insert_statement(path)
+    print(f"[*] 目标表 {target}, {len(columns)} 列")
+
+    stage = None
+    client_rows = None
+    if any(s != 'insert_select' for s in strategies):
+        stage = stage_source(conn, statement, target, columns, params)
+        print(f"[+] 源数据暂存 {stage['rows']:,} 行, 耗时 {stage['elapsed_ms']:,.1f} ms")
+        if 'fast_executemany' in strategies:
+            started = time.perf_counter()
+            client_rows = fetch_stage_rows(conn, columns)
+            stage['fetch_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            print(f"[+] 暂存数据取到客户端, 耗时 {stage['fetch_ms']:,.1f} ms")
+
+    setup_ms = {'insert_select': 0.0}
+    if stage is not None:
+        setup_ms['insert_select_batched'] = stage['elapsed_ms']
+        setup_ms['fast_executemany'] = stage['elapsed_ms'] + stage.get('fetch_ms', 0.0)
+
+    results = []
+    for strategy in strategies:
+        sizes = [None] if strategy == 'insert_select' else list(batch_sizes)
+        for batch_size in sizes:
+            runs = []
+            for round_no in range(1, rounds + 1):
+                run = run_write(conn, strategy, statement, target, columns, params, batch_size,
+                                stage['rows'] if stage else 0, client_rows, timeout_ms, setup_ms[strategy])
+                runs.append(run)
+                if run['timed_out']:
+                    break
+            summary = {'strategy': strategy, 'batch_size': batch_size, **summarize_runs(runs)}
+            results.append(summary)
+            print_result(summary)
+
+    if stage is not None:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP TABLE {STAGE_TABLE}")
+        conn.commit()
+        cursor.close()
+
+    return {'target': target, 'stage': stage, 'rounds': rounds, 'results': results,
+            'recommended': recommend(results)}
+
+
+def recommend(results):
+    """在未锁升级、无错误的组合中选行/秒最高者；都锁升级时退而取最高者"""
+    candidates = [r for r in results if r.get('rows_per_s')]
+    safe = [r for r in candidates if not r['escalated']] or candidates
+    if not safe:
+        return None
+    best = max(safe, key=lambda r: r['rows_per_s'])
+    return {'strategy': best['strategy'], 'batch_size': best['batch_size'], 'rows_per_s': best['rows_per_s'],
+            'escalated': best['escalated']}
+
+
+def print_result(summary):
+    label = f"{summary['strategy']}" + (f" (批 {summary['batch_size']:,})" if summary['batch_size'] else '')
+    if summary.get('rows_per_s') is None and summary.get('error'):
+        print(f"[-] {label}: {summary['error']}")
+        return
+    setup = f" + 准备 {summary['setup_ms']:,.1f} ms" if summary['setup_ms'] else ''
+    print(f"[+] {label}: {summary['rows']:,} 行 / {summary['batches']} 批, "
+          f"中位 {summary['median_ms']:,.1f} ms{setup}, "
+          f"{summary['rows_per_s'] or 0:,.0f} 行/秒, 日志 {summary['log_bytes']:,} 字节 "
+          f"({summary['log_records']:,} 条), 锁 {summary['lock_count']:,} 个"
+          f"{' [锁升级]' if summary['escalated'] else ''}")
+
+
+def main():
+    params = {
+        'Creator': 'TestUser',
+        'TenantID': 1,
+        'ReportDate': datetime.combine((datetime.now() - timedelta(days=1)).date(), datetime.min.time()),
+        'DefaultDepartment': '默认部门',
+        'DefaultPaymentType': '现金',
+        'DefaultProductCategory': '混凝土',
+        'DefaultUnit': '方',
+        'DefaultGHSJUnit': '吨',
+        'ProCoeff': 2.4,
+        'DefaultFinancialTime': 6
+    }
+
+    print("=" * 80)
+    print("INSERT ProductionDailyReportDetails 写入路径测试 (事务内执行，始终回滚)")
+    print("=" * 80)
+
+    conn = connect(DEFAULT_DATABASE, autocommit=False)
+    try:
+        report = sweep_write_strategies(conn, params, timeout_ms=300000)
+    finally:
+        conn.close()
+
+    if report['recommended']:
+        best = report['recommended']
+        print(f"\n[+] 推荐: {best['strategy']}"
+              f"{' 批大小 ' + format(best['batch_size'], ',') if best['batch_size'] else ''}, "
+              f"{best['rows_per_s']:,.0f} 行/秒")
+
+    output_file = f"insert_write_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump({'params': params, **report}, f, ensure_ascii=False, indent=2, default=str)
+    print(f"[+] 结果已保存: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
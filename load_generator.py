@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+并发虚拟用户负载测试
+N 个虚拟用户各自持有独立连接，按权重混合执行报表存储过程和更新语句，
+可按目标到达率(泊松到达)发压，也可闭环连续执行；
+逐级增加并发，报告吞吐量、各存储过程的延迟百分位、死锁和超时次数，找出饱和点
+"""
+
+import json
+import queue
+import random
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+from db_connection import connect
+from param_binding import bind_statement
+from parallel_runner import build_exec_statement, is_procedure_name
+from query_watchdog import StatementWatchdog, timeout_message
+from row_drain import drain_rows
+from sp_sweep import classify_error
+from timing_harness import percentile
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+# 吞吐量增长低于该比例且p90明显上升时，认为已达到饱和
+SATURATION_GAIN = 0.10
+SATURATION_LATENCY_GROWTH = 2.0
+
+
+def load_sql_file(path):
+    """读取优化目录中的SQL脚本作为负载语句"""
+    with open(path, encoding='utf-8-sig') as f:
+        return f.read()
+
+
+def _prepare(item):
+    """预先构造每个负载项的执行语句和参数"""
+    target, params = item['target'], item.get('params') or {}
+    if is_procedure_name(target):
+        sql, values = build_exec_statement(target.strip(), params)
+    elif params:
+        sql, values, _ = bind_statement(target, params, item.get('types'))
+    else:
+        sql, values = target, []
+    return dict(item, sql=sql, values=values, database=item.get('database', DEFAULT_DATABASE))
+
+
+class _VirtualUser(threading.Thread):
+    """一个虚拟用户：每个数据库一条独占连接，循环领取请求执行"""
+
+    def __init__(self, index, workload, arrivals, stop, records, timeout_ms, think_time_ms):
+        super().__init__(name=f'vu-{index:03d}', daemon=True)
+        self.workload = workload
+        self.weights = [item.get('weight', 1) for item in workload]
+        self.arrivals = arrivals
+        self.stop = stop
+        self.records = records
+        self.timeout_ms = timeout_ms
+        self.think_time_ms = think_time_ms
+        self.connections = {}
+        self.ready = threading.Event()
+        self.error = None
+
+    def open_connections(self):
+        for item in self.workload:
+            if item['database'] not in self.connections:
+                self.connections[item['database']] = connect(item['database'])
+
+    def close_connections(self):
+        for conn in self.connections.values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _next_request(self):
+        """开环模式从到达队列领取(带计划到达时间)，闭环模式按权重随机选择"""
+        if self.arrivals is None:
+            if self.stop.is_set():
+                return None
+            return random.choices(self.workload, self.weights)[0], time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                return self.arrivals.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _execute(self, item, scheduled):
+        conn = self.connections[item['database']]
+        record = {'name': item['name'], 'worker': self.name, 'success': False}
+        cursor = conn.cursor()
+        watchdog = StatementWatchdog(cursor, self.timeout_ms)
+        start = time.perf_counter()
+        try:
+            with watchdog:
+                cursor.execute(item['sql'], *item['values'])
+                drain_rows(cursor, 'discard')
+            record['success'] = True
+        except Exception as e:
+            record['error'] = timeout_message(watchdog.fired_at_ms) if watchdog.fired else str(e)
+            record['category'] = 'timeout' if watchdog.fired else classify_error(str(e))
+        finally:
+            end = time.perf_counter()
+            cursor.close()
+            try:
+                if record['success'] and not item.get('rollback', False):
+                    conn.commit()
+                else:
+                    conn.rollback()
+            except Exception:
+                pass
+
+        record['service_ms'] = (end - start) * 1000
+        # 开环模式下延迟从计划到达时刻算起，包含排队等待，避免协调遗漏
+        record['latency_ms'] = (end - scheduled) * 1000
+        record['completed_at'] = end
+        return record
+
+    def run(self):
+        try:
+            self.open_connections()
+        except Exception as e:
+            self.error = str(e)
+            self.close_connections()
+            return
+        finally:
+            self.ready.set()
+
+        try:
+            while True:
+                request = self._next_request()
+                if request is None:
+                    break
+                item, scheduled = request
+                self.records.append(self._execute(item, scheduled))
+                if self.think_time_ms:
+                    time.sleep(self.think_time_ms / 1000)
+        finally:
+            self.close_connections()
+
+
+def _dispatch(workload, arrival_rate, duration_s, arrivals, stop):
+    """按泊松过程生成到达请求，放入共享队列"""
+    weights = [item.get('weight', 1) for item in workload]
+    start = time.perf_counter()
+    next_arrival = start
+    while not stop.is_set():
+        next_arrival += random.expovariate(arrival_rate)
+        if next_arrival - start >= duration_s:
+            break
+        delay = next_arrival - time.perf_counter()
+        if delay > 0 and stop.wait(delay):
+            break
+        arrivals.put((random.choices(workload, weights)[0], next_arrival))
+
+
+def summarize_records(records, elapsed_s, backlog=0):
+    """汇总一个并发级别的结果：吞吐量、各负载项延迟百分位、死锁与超时"""
+    summary = {
+        'completed': sum(1 for r in records if r['success']),
+        'failed': sum(1 for r in records if not r['success']),
+        'deadlocks': sum(1 for r in records if r.get('category') == 'deadlock'),
+        'timeouts': sum(1 for r in records if r.get('category') == 'timeout'),
+        'backlog': backlog,
+        'elapsed_s': elapsed_s,
+        'procedures': {}
+    }
+    summary['throughput_per_s'] = summary['completed'] / elapsed_s if elapsed_s else 0.0
+
+    all_latencies = sorted(r['latency_ms'] for r in records if r['success'])
+    summary['p50_ms'] = percentile(all_latencies, 50)
+    summary['p90_ms'] = percentile(all_latencies, 90)
+    summary['p99_ms'] = percentile(all_latencies, 99)
+
+    for name in dict.fromkeys(r['name'] for r in records):
+        subset = [r for r in records if r['name'] == name]
+        latencies = sorted(r['latency_ms'] for r in subset if r['success'])
+        services = [r['service_ms'] for r in subset if r['success']]
+        summary['procedures'][name] = {
+            'count': len(latencies),
+            'failed': sum(1 for r in subset if not r['success']),
+            'deadlocks': sum(1 for r in subset if r.get('category') == 'deadlock'),
+            'timeouts': sum(1 for r in subset if r.get('category') == 'timeout'),
+            'avg_service_ms': sum(services) / len(services) if services else None,
+            'p50_ms': percentile(latencies, 50),
+            'p90_ms': percentile(latencies, 90),
+            'p99_ms': percentile(latencies, 99)
+        }
+    return summary
+
+
+def run_load(workload, users, duration_s=60, arrival_rate=None, timeout_ms=60000, think_time_ms=0):
+    """
+    执行一个并发级别的负载测试
+
+    workload: [{'name': ..., 'target': 存储过程名或SQL, 'params': {...}, 'weight': 3,
+                'database': ..., 'rollback': True}, ...]
+    arrival_rate: 目标到达率(次/秒)，None 表示闭环模式(每个用户执行完立即发起下一次)
+    timeout_ms: 单次执行的时间预算，超出后取消并记为超时
+    """
+    prepared = [_prepare(item) for item in workload]
+    stop = threading.Event()
+    arrivals = queue.Queue() if arrival_rate else None
+    records = []
+
+    vus = [_VirtualUser(i + 1, prepared, arrivals, stop, records, timeout_ms, think_time_ms) for i in range(users)]
+    for vu in vus:
+        vu.start()
+    for vu in vus:
+        vu.ready.wait()
+    failed = [vu for vu in vus if vu.error]
+    if failed:
+        stop.set()
+        raise Exception(f"{len(failed)} 个虚拟用户连接失败: {failed[0].error}")
+
+    # 连接全部建立后才开始计时
+    start = time.perf_counter()
+    if arrival_rate:
+        dispatcher = threading.Thread(target=_dispatch, args=(prepared, arrival_rate, duration_s, arrivals, stop),
+                                      name='vu-dispatcher', daemon=True)
+        dispatcher.start()
+        dispatcher.join()
+        # 到达结束后留出一个超时预算的时间消化队列，仍未领取的请求计为积压
+        deadline = time.perf_counter() + timeout_ms / 1000
+        while not arrivals.empty() and time.perf_counter() < deadline:
+            time.sleep(0.05)
+    else:
+        stop.wait(duration_s)
+
+    stop.set()
+    for vu in vus:
+        vu.join()
+    elapsed_s = time.perf_counter() - start
+
+    backlog = arrivals.qsize() if arrivals is not None else 0
+    summary = summarize_records(records, elapsed_s, backlog)
+    summary.update({'users': users, 'arrival_rate': arrival_rate})
+    return summary
+
+
+def find_saturation(levels):
+    """吞吐量增长停滞且p90显著上升的第一个并发级别即为饱和点"""
+    for previous, current in zip(levels, levels[1:]):
+        if current['deadlocks'] or current['timeouts'] or current['backlog']:
+            return current['users']
+        if not previous['throughput_per_s'] or previous['p90_ms'] is None or current['p90_ms'] is None:
+            continue
+        gain = current['throughput_per_s'] / previous['throughput_per_s'] - 1
+        growth = current['p90_ms'] / previous['p90_ms'] if previous['p90_ms'] else float('inf')
+        if gain < SATURATION_GAIN and growth >= SATURATION_LATENCY_GROWTH:
+            return current['users']
+    return None
+
+
+def print_level(summary):
+    """打印单个并发级别的结果"""
+    rate = f"{summary['arrival_rate']:.1f}/s" if summary['arrival_rate'] else '闭环'
+    print(f"\n[+] {summary['users']} 用户 ({rate}): 吞吐 {summary['throughput_per_s']:.2f}/s, "
+          f"完成 {summary['completed']}, 失败 {summary['failed']}, 死锁 {summary['deadlocks']}, "
+          f"超时 {summary['timeouts']}, 积压 {summary['backlog']}")
+    print(f"  {'负载项':<45} {'次数':>6} {'p50':>10} {'p90':>10} {'p99':>10} {'死锁':>5} {'超时':>5}")
+    for name, stats in summary['procedures'].items():
+        p50, p90, p99 = (f"{stats[k]:.0f}" if stats[k] is not None else '-' for k in ('p50_ms', 'p90_ms', 'p99_ms'))
+        print(f"  {name:<45} {stats['count']:>6} {p50:>10} {p90:>10} {p99:>10} "
+              f"{stats['deadlocks']:>5} {stats['timeouts']:>5}")
+
+
+def run_ramp(workload, levels, duration_s=60, timeout_ms=60000, think_time_ms=0, sampler=None):
+    """
+    逐级增加并发执行负载测试
+
+    levels: [{'users': 1, 'arrival_rate': 0.5}, {'users': 4, 'arrival_rate': 2}, ...]
+    sampler: 正在运行的 BlockingSampler，采样按并发级别标记
+    """
+    results = []
+    for level in levels:
+        print(f"\n[*] 并发 {level['users']} 用户, 持续 {duration_s} 秒...")
+        with sampler.active(f"load:{level['users']}users") if sampler is not None else nullcontext():
+            summary = run_load(workload, level['users'], duration_s, level.get('arrival_rate'),
+                               timeout_ms, think_time_ms)
+        print_level(summary)
+        results.append(summary)
+
+    saturation = find_saturation(results)
+    if saturation:
+        print(f"\n[!] 饱和点: {saturation} 个并发用户")
+    else:
+        print("\n[+] 测试范围内未达到饱和")
+    return {'levels': results, 'saturation_users': saturation}
+
+
+def main():
+    """主函数"""
+    workload = [
+        {'name': 'usp_GenerateWorkbenchKanban_Business', 'target': 'dbo.usp_GenerateWorkbenchKanban_Business',
+         'weight': 3, 'rollback': True},
+        {'name': 'usp_CheckProjectRiskWarn_Contract', 'target': 'dbo.usp_CheckProjectRiskWarn_Contract',
+         'weight': 2, 'rollback': True},
+        {'name': 'WbMaterialIns_UPDATE_V2_Batch',
+         'target': load_sql_file('UPDATE-ins优化/WbMaterialIns_UPDATE_Optimized_V2_Batch.sql'),
+         'params': {'TenantID': 1, 'ReportDate': datetime(2025, 11, 30)},
+         'weight': 1, 'rollback': True}
+    ]
+    levels = [{'users': users, 'arrival_rate': users * 0.5} for users in (1, 2, 4, 8, 16)]
+
+    print("=" * 60)
+    print("并发虚拟用户负载测试")
+    print("=" * 60)
+
+    report = run_ramp(workload, levels, duration_s=60, timeout_ms=60000)
+    report['test_date'] = datetime.now().isoformat()
+    report['workload'] = [{k: v for k, v in item.items() if k != 'target' or is_procedure_name(v)}
+                          for item in workload]
+
+    output_file = f"load_test_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    print(f"[+] 结果已保存到: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
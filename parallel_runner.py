@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+并行存储过程性能测试
+把多个存储过程及其参数组分发到线程池，每个工作线程独占一条连接，
+结果中标记工作线程及起止时间，用于全库扫描时缩短总耗时
+"""
+
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from db_connection import connect
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+_PROCEDURE_RE = re.compile(r'^[\w\.\[\]\-]+$')
+
+
+def is_procedure_name(target):
+    """判断目标是存储过程名(如 dbo.CashFlowBalance)而不是SQL语句"""
+    return bool(_PROCEDURE_RE.match(target.strip()))
+
+
+def build_exec_statement(sp_name, params=None):
+    """构造带参数占位符的EXEC语句，返回 (sql, 参数值列表)"""
+    params = params or {}
+    if not params:
+        return f"EXEC {sp_name}", []
+
+    assignments = ', '.join(f"@{name.lstrip('@')} = ?" for name in params)
+    return f"EXEC {sp_name} {assignments}", list(params.values())
+
+
+def execute_procedure(conn, sp_name, params=None):
+    """执行一次存储过程并排空所有结果集，返回耗时(毫秒)"""
+    sql, values = build_exec_statement(sp_name, params)
+    cursor = conn.cursor()
+    try:
+        start = time.perf_counter()
+        cursor.execute(sql, *values)
+        while cursor.nextset():
+            pass
+        duration_ms = (time.perf_counter() - start) * 1000
+        conn.commit()
+        return duration_ms
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+class _WorkerConnections:
+    """每个工作线程按数据库各持有一条专用连接"""
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+
+    def get(self, database):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get(database)
+        if conn is None:
+            conn = connect(database, timeout=self.timeout)
+            conns[database] = conn
+            with self._lock:
+                self._all.append(conn)
+        return conn
+
+    def close_all(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def _run_task(connections, task, round_no):
+    """在当前工作线程的专用连接上执行一轮"""
+    database = task.get('database', DEFAULT_DATABASE)
+    result = {
+        'procedure': task['procedure'],
+        'parameters': task.get('params') or {},
+        'database': database,
+        'round': round_no,
+        'worker': threading.current_thread().name,
+        'start_time': datetime.now().isoformat()
+    }
+
+    try:
+        conn = connections.get(database)
+        result['duration_ms'] = execute_procedure(conn, task['procedure'], task.get('params'))
+        result['success'] = True
+    except Exception as e:
+        result['success'] = False
+        result['error'] = str(e)
+
+    result['end_time'] = datetime.now().isoformat()
+    return result
+
+
+def run_parallel(tasks, max_workers=4, timeout=10):
+    """
+    并行执行存储过程测试
+
+    tasks: [{'procedure': 'dbo.CashFlowBalance', 'params': {...}, 'rounds': 3, 'database': ...}, ...]
+    max_workers: 并发上限，同时也是专用连接数上限(按数据库计)
+    """
+    connections = _WorkerConnections(timeout=timeout)
+    results = []
+
+    print(f"[*] 并行执行 {len(tasks)} 个测试任务 (并发上限 {max_workers})...")
+    sweep_start = time.perf_counter()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bench-worker') as executor:
+            futures = []
+            for task in tasks:
+                for round_no in range(1, task.get('rounds', 1) + 1):
+                    futures.append(executor.submit(_run_task, connections, task, round_no))
+
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if result['success']:
+                    print(f"  [{result['worker']}] {result['procedure']} 第 {result['round']} 轮: {result['duration_ms']:.0f} ms")
+                else:
+                    print(f"  [{result['worker']}] {result['procedure']} 第 {result['round']} 轮执行出错: {result['error']}")
+    finally:
+        connections.close_all()
+
+    wall_ms = (time.perf_counter() - sweep_start) * 1000
+    serial_ms = sum(r.get('duration_ms', 0) for r in results)
+    print(f"\n[+] 总墙钟时间: {wall_ms:.0f} ms, 串行累计: {serial_ms:.0f} ms")
+
+    results.sort(key=lambda r: (r['procedure'], r['round']))
+    return results
+
+
+def main():
+    """主函数"""
+    tasks = [
+        {'procedure': 'dbo.CashFlowBalance', 'params': {'beginDate': '2025-11-01', 'endDate': '2025-11-30'}},
+        {'procedure': 'dbo.usp_UpdateProjectRiskRelationInfo'},
+        {'procedure': 'dbo.usp_CheckProjectRiskWarn_Contract'},
+        {'procedure': 'dbo.usp_CheckProjectRiskWarn_Settlement'},
+        {'procedure': 'dbo.usp_GenerateWorkbenchKanban_Business'},
+        {'procedure': 'dbo.usp_UpdateProjectProgess'}
+    ]
+
+    print("=" * 60)
+    print("并行存储过程性能测试")
+    print("=" * 60)
+
+    results = run_parallel(tasks, max_workers=4)
+
+    output_file = f"parallel_benchmark_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump({'test_date': datetime.now().isoformat(), 'results': results}, f, ensure_ascii=False, indent=2)
+    print(f"[+] 结果已保存到: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+参数化执行
+把带 @参数 的语句通过 sp_executesql 以强类型参数绑定执行，
+与存储过程内部语句一样复用执行计划，并可查询计划缓存命中情况
+"""
+
+import re
+from datetime import date, datetime
+from decimal import Decimal
+
+BINDING_MODES = ('literal', 'sp_executesql')
+
+# 计划缓存中 sp_executesql 语句的文本为 "(参数声明)语句"，字面量语句则为原文
+PLAN_USECOUNT_SQL = """
+SELECT TOP 1 cp.usecounts
+FROM sys.dm_exec_cached_plans cp
+CROSS APPLY sys.dm_exec_sql_text(cp.plan_handle) st
+WHERE cp.objtype IN ('Prepared', 'Adhoc') AND st.text = ?
+ORDER BY cp.usecounts DESC
+"""
+
+
+def infer_sql_type(value):
+    """根据Python值推断参数的SQL类型"""
+    if isinstance(value, bool):
+        return 'BIT'
+    if isinstance(value, int):
+        return 'BIGINT' if abs(value) > 2 ** 31 - 1 else 'INT'
+    if isinstance(value, float):
+        return 'FLOAT'
+    if isinstance(value, Decimal):
+        return 'DECIMAL(38, 10)'
+    if isinstance(value, datetime):
+        return 'DATETIME'
+    if isinstance(value, date):
+        return 'DATE'
+    return 'NVARCHAR(4000)'
+
+
+def referenced_params(sql, params):
+    """只保留语句中实际引用的参数，保持原有顺序"""
+    return {name: value for name, value in params.items()
+            if re.search(rf'@{re.escape(name)}\b', sql, re.I)}
+
+
+def build_declaration(params, types=None):
+    """生成 sp_executesql 的参数声明串，如 '@Creator NVARCHAR(50), @TenantID INT'"""
+    types = types or {}
+    return ', '.join(f"@{name} {types.get(name) or infer_sql_type(value)}" for name, value in params.items())
+
+
+def bind_statement(sql, params, types=None):
+    """
+    构造 sp_executesql 调用
+
+    返回 (exec_sql, args, cached_text)，cached_text 为该语句在计划缓存中的文本
+    """
+    used = referenced_params(sql, params)
+    declaration = build_declaration(used, types)
+    assignments = ''.join(f", @{name} = ?" for name in used)
+    exec_sql = f"EXEC sp_executesql ?, ?{assignments}"
+    return exec_sql, [sql, declaration, *used.values()], f"({declaration}){sql}"
+
+
+def substitute_literals(sql, params):
+    """把参数替换为字面量(旧的执行方式，每组参数都会生成新的即席计划)"""
+    # 先替换较长的参数名，避免 @DefaultUnit 被 @Default 之类的前缀误替换
+    for key in sorted(params, key=len, reverse=True):
+        value = params[key]
+        if isinstance(value, datetime):
+            literal = f"'{value.strftime('%Y-%m-%d')}'"
+        elif isinstance(value, (int, float)):
+            literal = str(value)
+        else:
+            literal = f"'{value}'"
+        sql = re.sub(rf'@{re.escape(key)}\b', lambda _: literal, sql)
+    return sql
+
+
+def get_plan_usecount(conn, cached_text):
+    """查询语句在计划缓存中的使用次数，未缓存时返回 None"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(PLAN_USECOUNT_SQL, cached_text)
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
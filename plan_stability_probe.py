@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+参数敏感性与执行计划稳定性探测
+对存储过程或参数化语句按一组参数值执行两遍：
+  重编译: 每组参数都单独编译(WITH RECOMPILE / 先清除缓存计划)，作为该参数的最优基线
+  缓存顺序: 依次以每组参数首次编译并缓存计划，再用该计划执行其余各组参数
+按计划哈希分组，标记"复用为其他参数编译的计划比重编译慢 N 倍以上"的参数嗅探回退，
+无参数的过程则多次重复执行，检查同一参数下计划是否翻转
+"""
+
+import json
+import time
+import xml.etree.ElementTree as ET
+from datetime import date, datetime, timedelta
+
+from db_connection import connect
+from param_binding import bind_statement
+from parallel_runner import build_exec_statement, is_procedure_name
+from query_watchdog import StatementWatchdog, timeout_message
+from showplan import NS, drain_with_plans
+from statistics_parser import messages_from_error, parse_messages
+from timing_harness import percentile, set_statistics
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+# 复用计划耗时超过重编译基线的倍数即视为回退
+DEFAULT_RATIO = 3.0
+# 差值低于该毫秒数时不标记，避免短查询的计时噪声
+MIN_REGRESSION_MS = 100
+DATE_WINDOWS = (1, 7, 30, 90, 365)
+
+# 清除某条参数化语句的缓存计划(只影响这一条计划)
+EVICT_STATEMENT_SQL = """
+DECLARE @handle VARBINARY(64);
+SELECT TOP 1 @handle = cp.plan_handle
+FROM sys.dm_exec_cached_plans cp
+CROSS APPLY sys.dm_exec_sql_text(cp.plan_handle) st
+WHERE cp.objtype = 'Prepared' AND st.text = ?;
+IF @handle IS NOT NULL DBCC FREEPROCCACHE(@handle) WITH NO_INFOMSGS;
+"""
+
+
+def date_window_grid(end_date, days=DATE_WINDOWS, begin_name='beginDate', end_name='endDate'):
+    """
+    以 end_date 为终点、不同天数的日期区间参数组，覆盖从极窄到极宽的选择度
+
+    取值为 datetime，语句目标按 DATETIME 绑定，避免 NVARCHAR→datetime 隐式转换干扰计划
+    """
+    end = date.fromisoformat(end_date) if isinstance(end_date, str) else end_date
+    if isinstance(end, datetime):
+        end = end.date()
+    end = datetime.combine(end, datetime.min.time())
+    return [{begin_name: end - timedelta(days=n - 1), end_name: end} for n in days]
+
+
+def plan_signature(plans):
+    """各语句 QueryPlanHash 拼接成的计划签名，同一签名视为同一套计划"""
+    hashes = []
+    for plan_xml in plans:
+        for stmt in ET.fromstring(plan_xml).iter(f"{{{NS['sp']}}}StmtSimple"):
+            if stmt.get('QueryPlanHash'):
+                hashes.append(stmt.get('QueryPlanHash'))
+    return ','.join(hashes) or None
+
+
+def _statement(target, params, recompile=False):
+    """返回 (执行语句, 参数值, 计划缓存中的语句文本)"""
+    if is_procedure_name(target):
+        sql, values = build_exec_statement(target, params)
+        return f"{sql} WITH RECOMPILE" if recompile else sql, values, None
+    if params:
+        return bind_statement(target, params)
+    return target, [], target
+
+
+def evict_plan(conn, target, params):
+    """清除目标的缓存计划：存储过程用 sp_recompile，语句只清除自身那条计划"""
+    cursor = conn.cursor()
+    try:
+        if is_procedure_name(target):
+            cursor.execute("EXEC sp_recompile ?", target)
+        else:
+            cursor.execute(EVICT_STATEMENT_SQL, _statement(target, params)[2])
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def execute_once(conn, target, params, recompile=False, timeout_ms=None):
+    """执行一次(结束后回滚)，返回耗时、逻辑读和计划签名"""
+    if recompile and not is_procedure_name(target):
+        evict_plan(conn, target, params)
+    sql, values, _ = _statement(target, params, recompile)
+    messages = []
+    set_statistics(conn, True, xml=True)
+    cursor = conn.cursor()
+    watchdog = StatementWatchdog(cursor, timeout_ms)
+    start = time.perf_counter()
+    try:
+        with watchdog:
+            cursor.execute(sql, *values)
+            plans = drain_with_plans(cursor, messages)
+        result = {'duration_ms': (time.perf_counter() - start) * 1000, 'plan': plan_signature(plans)}
+    except Exception as e:
+        result = {'duration_ms': (time.perf_counter() - start) * 1000, 'plan': None,
+                  'error': timeout_message(watchdog.fired_at_ms) if watchdog.fired else str(e)}
+        messages.extend(messages_from_error(e))
+    finally:
+        cursor.close()
+        conn.rollback()
+        set_statistics(conn, False, xml=True)
+    exec_call = is_procedure_name(target) or bool(params)
+    result['logical_reads'] = parse_messages(messages, exec_call)['logical_reads']
+    return result
+
+
+def measure(conn, target, params, repeats=1, recompile=False, timeout_ms=None):
+    """重复执行取耗时中位数，并记录重复之间出现的全部计划签名；recompile 时每次都重新编译"""
+    runs = [execute_once(conn, target, params, recompile, timeout_ms) for _ in range(repeats)]
+    durations = sorted(r['duration_ms'] for r in runs)
+    errors = [r['error'] for r in runs if r.get('error')]
+    return {
+        'median_ms': round(percentile(durations, 50), 1),
+        'logical_reads': sorted(r['logical_reads'] for r in runs)[len(runs) // 2],
+        'plans': sorted({r['plan'] for r in runs if r['plan']}),
+        'error': errors[0] if errors else None
+    }
+
+
+def _label(params):
+    return ', '.join(f"{k}={v}" for k, v in params.items()) or '(无参数)'
+
+
+def probe(conn, target, grid, repeats=1, ratio=DEFAULT_RATIO, min_ms=MIN_REGRESSION_MS, timeout_ms=None):
+    """
+    对一个目标执行重编译和缓存顺序两遍探测
+
+    grid: 参数组列表；无参数的过程传 [{}] 并加大 repeats
+    返回 {'recompiled': [...], 'cached': [[...]], 'plan_groups': {...}, 'regressions': [...], 'flips': [...]}
+    """
+    grid = grid or [{}]
+    print(f"\n[*] {target}: 重编译基线 ({len(grid)} 组参数 × {repeats} 次)...")
+    recompiled = []
+    for params in grid:
+        result = measure(conn, target, params, repeats, recompile=True, timeout_ms=timeout_ms)
+        recompiled.append(result)
+        print(f"  {_label(params)}: {result['median_ms']:,.1f} ms, 逻辑读 {result['logical_reads']:,}, "
+              f"计划 {len(result['plans'])} 个{'  [-] ' + result['error'] if result['error'] else ''}")
+
+    print(f"[*] {target}: 缓存计划复用矩阵...")
+    cached = []
+    for sniffed in grid:
+        evict_plan(conn, target, sniffed)
+        # 第一次执行按 sniffed 编译并缓存计划，不计入矩阵
+        execute_once(conn, target, sniffed, timeout_ms=timeout_ms)
+        cached.append([measure(conn, target, params, repeats, timeout_ms=timeout_ms) for params in grid])
+
+    plan_groups = {}
+    for params, result in zip(grid, recompiled):
+        for plan in result['plans']:
+            plan_groups.setdefault(plan, []).append(_label(params))
+
+    regressions = []
+    for i, sniffed in enumerate(grid):
+        for j, params in enumerate(grid):
+            baseline, reused = recompiled[j], cached[i][j]
+            if i == j or baseline['error'] or reused['error']:
+                continue
+            if reused['median_ms'] > baseline['median_ms'] * ratio \
+                    and reused['median_ms'] - baseline['median_ms'] >= min_ms:
+                regressions.append({
+                    'compiled_for': _label(sniffed), 'executed_with': _label(params),
+                    'reused_ms': reused['median_ms'], 'recompiled_ms': baseline['median_ms'],
+                    'ratio': round(reused['median_ms'] / baseline['median_ms'], 1) if baseline['median_ms'] else None,
+                    'reused_reads': reused['logical_reads'], 'recompiled_reads': baseline['logical_reads']
+                })
+
+    # 重编译时同一参数在重复执行之间换了计划，或缓存计划在复用过程中被重新编译
+    flips = [{'params': _label(params), 'mode': 'recompile', 'plans': result['plans']}
+             for params, result in zip(grid, recompiled) if len(result['plans']) > 1]
+    for sniffed, row in zip(grid, cached):
+        plans = sorted({plan for result in row for plan in result['plans']})
+        if len(plans) > 1:
+            flips.append({'params': _label(sniffed), 'mode': 'cached', 'plans': plans})
+
+    return {'target': target, 'grid': grid, 'repeats': repeats, 'ratio': ratio,
+            'recompiled': recompiled, 'cached': cached, 'plan_groups': plan_groups,
+            'regressions': regressions, 'flips': flips, 'recommendation': recommend(grid, recompiled, cached)}
+
+
+def recommend(grid, recompiled, cached):
+    """找出最坏情况下最稳的编译参数(适合 OPTIMIZE FOR)；任何计划都撑不住时建议 RECOMPILE"""
+    worst = []
+    for row in cached:
+        ratios = [r['median_ms'] / max(base['median_ms'], 1.0) for r, base in zip(row, recompiled)
+                  if not r['error'] and not base['error']]
+        worst.append(max(ratios) if ratios else float('inf'))
+    if not worst:
+        return None
+    best = min(range(len(worst)), key=lambda i: worst[i])
+    return {'compile_for': _label(grid[best]), 'worst_ratio': round(worst[best], 1),
+            'hint': 'OPTIMIZE FOR' if worst[best] <= DEFAULT_RATIO else 'OPTION (RECOMPILE)'}
+
+
+def print_probe(report):
+    print(f"\n{'=' * 60}")
+    print(f"{report['target']} 计划稳定性")
+    print('=' * 60)
+    print(f"[*] 重编译时出现 {len(report['plan_groups'])} 种计划:")
+    for number, (plan, labels) in enumerate(report['plan_groups'].items(), 1):
+        print(f"  计划{number} ({plan[:40]}): {'; '.join(labels)}")
+
+    for flip in report['flips']:
+        if flip['mode'] == 'recompile':
+            print(f"[!] 计划翻转: {flip['params']} 每次重编译得到的计划不同 ({len(flip['plans'])} 种)")
+        else:
+            print(f"[!] 计划翻转: 按 {flip['params']} 缓存的计划在复用期间被重新编译 ({len(flip['plans'])} 种)")
+
+    if report['regressions']:
+        print(f"[-] 参数嗅探回退 (复用计划 > {report['ratio']}× 重编译):")
+        for r in sorted(report['regressions'], key=lambda r: r['ratio'] or 0, reverse=True):
+            print(f"  按 [{r['compiled_for']}] 编译 → 执行 [{r['executed_with']}]: "
+                  f"{r['reused_ms']:,.1f} ms vs {r['recompiled_ms']:,.1f} ms (×{r['ratio']}), "
+                  f"逻辑读 {r['reused_reads']:,} vs {r['recompiled_reads']:,}")
+    else:
+        print(f"[+] 未发现超过 {report['ratio']}× 的参数嗅探回退")
+
+    recommendation = report['recommendation']
+    if recommendation and len(report['grid']) > 1:
+        print(f"[*] 最稳的编译参数: {recommendation['compile_for']} (最坏 ×{recommendation['worst_ratio']}), "
+              f"建议 {recommendation['hint']}")
+
+
+def main():
+    # verify_cross_db_query.py 中按报表日期过滤的统计查询
+    report_sql = """
+SELECT detail.ProjectID, COUNT(*) AS detail_count, SUM(detail.ProductionQty_T) AS qty
+FROM ProductionDailyReportDetails detail
+    INNER JOIN dbo.ProductionDailyReports Report ON detail.DailyReportID = Report.ID
+WHERE Report.isDeleted = 0
+      AND Report.ReportDate BETWEEN @BeginDate AND @EndDate
+GROUP BY detail.ProjectID
+"""
+    targets = [
+        ('dbo.CashFlowBalance', date_window_grid('2025-11-30'), 1),
+        (report_sql, date_window_grid('2025-11-30', begin_name='BeginDate', end_name='EndDate'), 1),
+        # 无参数过程：重复执行观察计划是否翻转(报告中同一过程各轮 447 ms 到 9.7 s 不等)
+        ('dbo.usp_UpdateProjectRiskRelationInfo', [{}], 5)
+    ]
+
+    print("=" * 60)
+    print("参数敏感性与执行计划稳定性探测")
+    print("=" * 60)
+
+    reports = []
+    conn = connect(DEFAULT_DATABASE, timeout=30)
+    try:
+        for target, grid, repeats in targets:
+            try:
+                report = probe(conn, target, grid, repeats=repeats, timeout_ms=120000)
+            except Exception as e:
+                print(f"[-] 探测出错: {e}")
+                continue
+            print_probe(report)
+            reports.append(report)
+    finally:
+        conn.close()
+
+    output_file = f"plan_stability_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump({'test_date': datetime.now().isoformat(), 'database': DEFAULT_DATABASE, 'probes': reports},
+                  f, ensure_ascii=False, indent=2, default=str)
+    print(f"\n[+] 报告已保存: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+单次执行超时看门狗
+连接参数中的 timeout 只限制登录，语句本身没有时间上限；
+看门狗线程在预算耗尽时调用 cursor.cancel() 中断正在执行的语句，
+调用方随后回滚并把该轮记录为超时
+"""
+
+import threading
+import time
+
+
+class StatementWatchdog:
+    """
+    在独立线程中计时，超过预算后取消游标上正在执行的语句
+
+    用法:
+        with StatementWatchdog(cursor, timeout_ms=30000) as watchdog:
+            cursor.execute(...)
+            drain(cursor)
+        if watchdog.fired: ...
+    """
+
+    def __init__(self, cursor, timeout_ms):
+        self.cursor = cursor
+        self.timeout_ms = timeout_ms
+        self.fired = False
+        self.fired_at_ms = None
+        self._lock = threading.Lock()
+        self._done = False
+        self._timer = None
+        self._start = None
+
+    def _fire(self):
+        with self._lock:
+            if self._done:
+                return
+            self.fired = True
+            self.fired_at_ms = (time.perf_counter() - self._start) * 1000
+            try:
+                self.cursor.cancel()
+            except Exception:
+                # 语句恰好结束或连接已断开时取消会失败，执行线程会自行收尾
+                pass
+
+    def start(self):
+        self._start = time.perf_counter()
+        if self.timeout_ms:
+            self._timer = threading.Timer(self.timeout_ms / 1000, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def stop(self):
+        """停止计时；之后不会再取消该游标(避免误伤下一条语句)"""
+        with self._lock:
+            self._done = True
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+
+def timeout_message(elapsed_ms):
+    """超时轮次的统一错误描述"""
+    return f"timed out at {elapsed_ms:.0f} ms"
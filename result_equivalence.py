@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+原始/优化版本结果等价性校验
+分块流式读取两边的结果集，逐行规范化后计算哈希，
+按哈希分区落盘后逐区比较多重集合，内存占用有界；
+哈希前数值按指定小数位舍入，哈希对不上的行再按键配对，
+数值列之差小于 10^-decimals 即视为相等，报告最先发现的差异键
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import Counter
+from datetime import date, datetime, time as dt_time
+from decimal import Decimal, ROUND_HALF_UP
+
+from db_connection import connect
+from param_binding import bind_statement
+from parallel_runner import build_exec_statement, is_procedure_name
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+PARTITIONS = 64
+CHUNK_SIZE = 5000
+
+
+def normalize_value(value, decimals):
+    """规范化单个值：数值统一量化到 decimals 位小数，字符串去除尾随空格"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, Decimal)):
+        quantized = Decimal(str(value)).quantize(Decimal(1).scaleb(-decimals), rounding=ROUND_HALF_UP)
+        return str(quantized + 0)  # +0 把 -0.00 归一为 0.00
+    if isinstance(value, str):
+        return value.rstrip(' ')
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _exact_value(value, decimals):
+    """未舍入的规范化值，供键配对后的容差比较使用；数值标记为 ['n', 原值]"""
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return ['n', str(Decimal(str(value)))]
+    return normalize_value(value, decimals)
+
+
+def within_tolerance(values_o, values_n, decimals):
+    """两行逐列比较：数值列之差小于 10^-decimals，其余列完全一致"""
+    if len(values_o) != len(values_n):
+        return False
+    epsilon = Decimal(1).scaleb(-decimals)
+    for a, b in zip(values_o, values_n):
+        if isinstance(a, list) and isinstance(b, list):
+            if abs(Decimal(a[1]) - Decimal(b[1])) >= epsilon:
+                return False
+        elif a != b:
+            return False
+    return True
+
+
+def row_digest(row, decimals):
+    """计算规范化后整行的哈希"""
+    payload = json.dumps([normalize_value(v, decimals) for v in row], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class _HashPartitions:
+    """把 (行哈希, 键, 未舍入的行值) 按哈希前缀分区写入临时文件"""
+
+    def __init__(self, directory, side, result_index):
+        self.paths = [os.path.join(directory, f"{side}_{result_index}_{i:02d}.txt") for i in range(PARTITIONS)]
+        self._files = [open(path, 'w', encoding='utf-8') for path in self.paths]
+        self.row_count = 0
+
+    def add(self, digest, key, values):
+        self._files[int(digest[:2], 16) % PARTITIONS].write(f"{digest}\t{key}\t{values}\n")
+        self.row_count += 1
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+def _read_partition(path):
+    counts = Counter()
+    rows = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            digest, key, values = line.rstrip('\n').split('\t', 2)
+            counts[digest] += 1
+            rows.setdefault(digest, (key, values))
+    return counts, rows
+
+
+def _stream_result_sets(cursor, directory, side, key_columns, decimals, chunk_size, start_index=0):
+    """流式读取游标上的所有结果集，返回各结果集的 (列名, 分区)"""
+    result_sets = []
+    index = start_index
+    while True:
+        if cursor.description is not None:
+            columns = [column[0] for column in cursor.description]
+            lowered = [c.lower() for c in columns]
+            key_positions = [lowered.index(k.lower()) for k in key_columns if k.lower() in lowered] or [0]
+            partitions = _HashPartitions(directory, side, index)
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        key = json.dumps([normalize_value(row[p], decimals) for p in key_positions], ensure_ascii=False)
+                        values = json.dumps([_exact_value(v, decimals) for v in row], ensure_ascii=False)
+                        partitions.add(row_digest(row, decimals), key, values)
+            finally:
+                partitions.close()
+            result_sets.append((columns, partitions))
+            index += 1
+        if not cursor.nextset():
+            break
+    return result_sets
+
+
+def run_variant(conn, target, params, directory, side, key_columns=(), decimals=4,
+                chunk_size=CHUNK_SIZE, probe_sql=None, rollback=True):
+    """
+    执行一个版本并把结果集哈希落盘
+
+    target: 存储过程名或SQL语句(SQL中的 @参数 通过 sp_executesql 绑定)
+    probe_sql: 执行后在同一事务内运行的检查查询(用于比较写入目标表的效果)
+    rollback: 执行结束后回滚，避免修改测试数据
+    """
+    if is_procedure_name(target):
+        sql, values = build_exec_statement(target.strip(), params)
+    elif params:
+        sql, values, _ = bind_statement(target, params)
+    else:
+        sql, values = target, []
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, *values)
+        result_sets = _stream_result_sets(cursor, directory, side, key_columns, decimals, chunk_size)
+        if probe_sql:
+            cursor.execute(probe_sql)
+            result_sets += _stream_result_sets(cursor, directory, side, key_columns, decimals, chunk_size,
+                                               start_index=len(result_sets))
+        return {'success': True, 'result_sets': result_sets}
+    except Exception as e:
+        return {'success': False, 'error': str(e), 'result_sets': []}
+    finally:
+        cursor.close()
+        if rollback:
+            conn.rollback()
+        else:
+            conn.commit()
+
+
+def _compare_result_set(original, optimized, max_report, decimals):
+    columns_o, parts_o = original
+    columns_n, parts_n = optimized
+    report = {
+        'original_rows': parts_o.row_count,
+        'optimized_rows': parts_n.row_count,
+        'missing_in_optimized': 0,
+        'extra_in_optimized': 0,
+        'within_tolerance': 0,
+        'missing_keys': [],
+        'extra_keys': []
+    }
+    if [c.lower() for c in columns_o] != [c.lower() for c in columns_n]:
+        report['column_mismatch'] = {'original': columns_o, 'optimized': columns_n}
+
+    # 哈希对不上的行跨分区收集(舍入边界两侧的值会落到不同分区)，数量只与差异行数有关
+    missing, extra = [], {}
+    for path_o, path_n in zip(parts_o.paths, parts_n.paths):
+        counts_o, rows_o = _read_partition(path_o)
+        counts_n, rows_n = _read_partition(path_n)
+        counts_o.subtract(counts_n)
+        for digest, diff in counts_o.items():
+            if diff > 0:
+                key, values = rows_o[digest]
+                missing.extend([(key, json.loads(values))] * diff)
+            elif diff < 0:
+                key, values = rows_n[digest]
+                extra.setdefault(key, []).extend([json.loads(values)] * -diff)
+
+    for key, values in missing:
+        candidates = extra.get(key, [])
+        match = next((i for i, other in enumerate(candidates) if within_tolerance(values, other, decimals)), None)
+        if match is not None:
+            candidates.pop(match)
+            report['within_tolerance'] += 1
+            continue
+        report['missing_in_optimized'] += 1
+        if len(report['missing_keys']) < max_report:
+            report['missing_keys'].append(json.loads(key))
+    for key, candidates in extra.items():
+        report['extra_in_optimized'] += len(candidates)
+        if candidates and len(report['extra_keys']) < max_report:
+            report['extra_keys'].append(json.loads(key))
+
+    report['equivalent'] = (report['missing_in_optimized'] == 0 and report['extra_in_optimized'] == 0
+                            and 'column_mismatch' not in report)
+    return report
+
+
+def compare_results(conn, original, optimized, params=None, key_columns=(), decimals=4,
+                    chunk_size=CHUNK_SIZE, probe_sql=None, rollback=True, max_report=10):
+    """
+    比较原始与优化版本的结果(按多重集合，不要求顺序一致)
+
+    decimals 决定数值容差：键相同的行数值列之差小于 10^-decimals 视为相等
+
+    返回 {'equivalent': bool, 'result_sets': [...], 'original_error'/'optimized_error': ...}
+    """
+    with tempfile.TemporaryDirectory(prefix='equivalence_') as directory:
+        run_o = run_variant(conn, original, params, directory, 'original', key_columns, decimals,
+                            chunk_size, probe_sql, rollback)
+        run_n = run_variant(conn, optimized, params, directory, 'optimized', key_columns, decimals,
+                            chunk_size, probe_sql, rollback)
+
+        report = {'original': original, 'optimized': optimized, 'result_sets': []}
+        if not run_o['success']:
+            report['original_error'] = run_o['error']
+        if not run_n['success']:
+            report['optimized_error'] = run_n['error']
+        if not (run_o['success'] and run_n['success']):
+            report['equivalent'] = False
+            return report
+
+        sets_o, sets_n = run_o['result_sets'], run_n['result_sets']
+        for index, (set_o, set_n) in enumerate(zip(sets_o, sets_n)):
+            report['result_sets'].append({'index': index,
+                                          **_compare_result_set(set_o, set_n, max_report, decimals)})
+
+        report['result_set_count'] = {'original': len(sets_o), 'optimized': len(sets_n)}
+        report['equivalent'] = len(sets_o) == len(sets_n) and all(r['equivalent'] for r in report['result_sets'])
+        return report
+
+
+def print_report(report):
+    """打印等价性校验结果"""
+    print(f"\n[*] {report['original']}  vs  {report['optimized']}")
+    for side in ('original', 'optimized'):
+        if f'{side}_error' in report:
+            print(f"  [-] {side} 执行出错: {report[f'{side}_error']}")
+
+    for rs in report['result_sets']:
+        status = '一致' if rs['equivalent'] else '不一致'
+        print(f"  结果集 {rs['index']}: {status} (原始 {rs['original_rows']:,} 行, 优化 {rs['optimized_rows']:,} 行)")
+        if 'column_mismatch' in rs:
+            print(f"    列不一致: {rs['column_mismatch']['original']} / {rs['column_mismatch']['optimized']}")
+        if rs.get('within_tolerance'):
+            print(f"    {rs['within_tolerance']:,} 行数值差异在容差内")
+        if rs['missing_in_optimized']:
+            print(f"    优化版缺少 {rs['missing_in_optimized']:,} 行, 例如键: {rs['missing_keys'][:5]}")
+        if rs['extra_in_optimized']:
+            print(f"    优化版多出 {rs['extra_in_optimized']:,} 行, 例如键: {rs['extra_keys'][:5]}")
+
+    counts = report.get('result_set_count')
+    if counts and counts['original'] != counts['optimized']:
+        print(f"  结果集数量不一致: 原始 {counts['original']}, 优化 {counts['optimized']}")
+
+    print(f"[{'+' if report['equivalent'] else '-'}] 结论: {'结果等价' if report['equivalent'] else '结果不等价'}")
+
+
+def main():
+    """主函数"""
+    conn = connect(DEFAULT_DATABASE)
+    try:
+        report = compare_results(
+            conn,
+            'dbo.CashFlowBalance',
+            'dbo.CashFlowBalance_Optimized',
+            params={'beginDate': '2025-11-01', 'endDate': '2025-11-30'},
+            key_columns=('CashFlowID',),
+            decimals=2,
+            probe_sql="SELECT CashFlowID, BankAccountID, IncomeAmt, ExpenditureAmt, Balance FROM dbo.BankCashBalance"
+        )
+        print_report(report)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试历史库
+每次测试的每一轮连同存储过程、参数、定义哈希、环境信息和指标写入本地 SQLite，
+可查询某个存储过程的历史记录；对固定基线做 Mann-Whitney U 检验，
+检测到性能回退时以非零退出码结束，便于上线前拦截
+
+用法:
+    python results_store.py                         # 检查所有已固定基线的存储过程
+    python results_store.py history <存储过程> [N]  # 最近 N 次运行
+    python results_store.py pin <存储过程> [run_id]  # 把某次运行(默认最近一次)固定为基线
+"""
+
+import hashlib
+import json
+import math
+import os
+import platform
+import socket
+import sqlite3
+import sys
+from datetime import datetime
+
+STORE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_history.db')
+
+# 单侧显著性水平，以及中位数至少变慢的比例(避免统计显著但差异可以忽略的误报)
+REGRESSION_ALPHA = 0.05
+MIN_SLOWDOWN = 0.05
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_at TEXT NOT NULL,
+    procedure TEXT NOT NULL,
+    database TEXT,
+    label TEXT,
+    params TEXT,
+    code_hash TEXT,
+    cache_mode TEXT,
+    environment TEXT,
+    statistics TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_runs_procedure ON runs (procedure, run_at);
+
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    round_no INTEGER,
+    success INTEGER NOT NULL,
+    timed_out INTEGER NOT NULL DEFAULT 0,
+    outlier INTEGER NOT NULL DEFAULT 0,
+    duration_ms REAL,
+    cpu_ms REAL,
+    logical_reads INTEGER,
+    physical_reads INTEGER,
+    server_elapsed_ms REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_rounds_run ON rounds (run_id);
+
+CREATE TABLE IF NOT EXISTS baselines (
+    procedure TEXT PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    pinned_at TEXT NOT NULL
+);
+"""
+
+# 环境信息一次往返取回
+ENVIRONMENT_SQL = """
+SELECT @@SERVERNAME AS server_name,
+       CAST(SERVERPROPERTY('ProductVersion') AS NVARCHAR(128)) AS product_version,
+       CAST(SERVERPROPERTY('Edition') AS NVARCHAR(128)) AS edition,
+       DB_NAME() AS database_name,
+       si.cpu_count, si.physical_memory_kb / 1024 AS memory_mb, si.sqlserver_start_time
+FROM sys.dm_os_sys_info si
+"""
+
+
+class ResultsStore:
+    """SQLite 历史库，可作为上下文管理器使用"""
+
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA_SQL)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.db.commit()
+        self.close()
+        return False
+
+    def add_run(self, procedure, benchmark, params=None, database=None, code_hash=None, environment=None,
+                label=None, run_at=None):
+        """写入 benchmark_procedure 的返回结果(含全部轮次)，返回 run_id"""
+        cursor = self.db.execute(
+            "INSERT INTO runs (run_at, procedure, database, label, params, code_hash, cache_mode, environment, "
+            "statistics) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (run_at or datetime.now().isoformat(), procedure, database, label,
+             json.dumps(params or {}, ensure_ascii=False, default=str), code_hash, benchmark.get('cache_mode'),
+             json.dumps(environment or {}, ensure_ascii=False, default=str),
+             json.dumps(benchmark.get('statistics'), ensure_ascii=False, default=str)))
+        run_id = cursor.lastrowid
+
+        for result in benchmark['results']:
+            io = result.get('io_time') or {}
+            server = result.get('server') or {}
+            self.db.execute(
+                "INSERT INTO rounds (run_id, round_no, success, timed_out, outlier, duration_ms, cpu_ms, "
+                "logical_reads, physical_reads, server_elapsed_ms, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, result.get('round'), int(bool(result.get('success'))), int(bool(result.get('timed_out'))),
+                 int(bool(result.get('outlier'))), result.get('duration_ms'), io.get('cpu_ms'),
+                 io.get('logical_reads'), io.get('physical_reads'), server.get('elapsed_ms'), result.get('error')))
+        self.db.commit()
+        return run_id
+
+    def recent_runs(self, procedure, limit=30):
+        """某存储过程最近 limit 次运行(新的在前)，附带成功轮次的中位耗时"""
+        rows = self.db.execute(
+            "SELECT id, run_at, database, label, code_hash, cache_mode, statistics FROM runs "
+            "WHERE procedure = ? ORDER BY run_at DESC, id DESC LIMIT ?", (procedure, limit)).fetchall()
+        runs = []
+        for row in rows:
+            durations = self.durations(row['id'])
+            runs.append({**dict(row), 'statistics': json.loads(row['statistics'] or 'null'),
+                         'rounds': len(durations), 'median_ms': median(durations)})
+        return runs
+
+    def durations(self, run_id, include_outliers=True):
+        sql = "SELECT duration_ms FROM rounds WHERE run_id = ? AND success = 1"
+        if not include_outliers:
+            sql += " AND outlier = 0"
+        return [row[0] for row in self.db.execute(sql, (run_id,)).fetchall()]
+
+    def latest_run_id(self, procedure):
+        row = self.db.execute("SELECT id FROM runs WHERE procedure = ? ORDER BY run_at DESC, id DESC LIMIT 1",
+                              (procedure,)).fetchone()
+        return row[0] if row else None
+
+    def run(self, run_id):
+        row = self.db.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return dict(row) if row else None
+
+    def pin_baseline(self, procedure, run_id=None):
+        """把某次运行固定为基线，默认取最近一次"""
+        run_id = run_id or self.latest_run_id(procedure)
+        if run_id is None:
+            raise ValueError(f"没有 {procedure} 的运行记录")
+        self.db.execute("INSERT OR REPLACE INTO baselines (procedure, run_id, pinned_at) VALUES (?, ?, ?)",
+                        (procedure, run_id, datetime.now().isoformat()))
+        self.db.commit()
+        return run_id
+
+    def baselines(self):
+        return {row['procedure']: row['run_id'] for row in self.db.execute("SELECT * FROM baselines").fetchall()}
+
+
+def median(values):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def mann_whitney_u(baseline, current):
+    """
+    单侧 Mann-Whitney U 检验：current 是否整体大于 baseline
+
+    正态近似(含并列秩修正和连续性修正)，返回 (U, z, p)
+    """
+    n1, n2 = len(current), len(baseline)
+    combined = sorted([(value, 0) for value in current] + [(value, 1) for value in baseline])
+    ranks, ties = [0.0] * len(combined), []
+    i = 0
+    while i < len(combined):
+        j = i
+        while j + 1 < len(combined) and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        ties.append(j - i + 1)
+        i = j + 1
+
+    rank_sum = sum(rank for rank, (_, group) in zip(ranks, combined) if group == 0)
+    u = rank_sum - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    tie_term = sum(t ** 3 - t for t in ties) / (n * (n - 1)) if n > 1 else 0.0
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term)) if n1 and n2 else 0.0
+    if sigma == 0:
+        return u, 0.0, 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / sigma
+    return u, z, 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def check_regression(store, procedure, run_id=None, alpha=REGRESSION_ALPHA, min_slowdown=MIN_SLOWDOWN):
+    """
+    以固定基线对比某次运行(默认最近一次)
+
+    p < alpha 且中位耗时变慢超过 min_slowdown 判定为回退；定义哈希变化单独提示
+    """
+    baseline_id = store.baselines().get(procedure)
+    run_id = run_id or store.latest_run_id(procedure)
+    if baseline_id is None or run_id is None:
+        return {'procedure': procedure, 'status': 'no_baseline' if baseline_id is None else 'no_run'}
+    if run_id == baseline_id:
+        return {'procedure': procedure, 'status': 'baseline', 'run_id': run_id}
+
+    baseline, current = store.durations(baseline_id, False), store.durations(run_id, False)
+    if not baseline or not current:
+        return {'procedure': procedure, 'status': 'no_data', 'run_id': run_id, 'baseline_run_id': baseline_id}
+
+    u, z, p = mann_whitney_u(baseline, current)
+    baseline_median, current_median = median(baseline), median(current)
+    ratio = current_median / baseline_median if baseline_median else None
+    regressed = p < alpha and ratio is not None and ratio > 1 + min_slowdown
+    base_run, this_run = store.run(baseline_id), store.run(run_id)
+    return {
+        'procedure': procedure,
+        'status': 'regression' if regressed else 'ok',
+        'run_id': run_id,
+        'baseline_run_id': baseline_id,
+        'baseline_median_ms': baseline_median,
+        'current_median_ms': current_median,
+        'ratio': round(ratio, 3) if ratio else None,
+        'u': u,
+        'z': round(z, 3),
+        'p_value': round(p, 4),
+        'samples': [len(baseline), len(current)],
+        'code_changed': bool(base_run['code_hash'] and this_run['code_hash']
+                             and base_run['code_hash'] != this_run['code_hash'])
+    }
+
+
+def procedure_code_hash(conn, sp_name):
+    """存储过程定义的 SHA-256(统一换行符后计算)，定义不存在时返回 None"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT OBJECT_DEFINITION(OBJECT_ID(?))", sp_name)
+        definition = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if definition is None:
+        return None
+    return hashlib.sha256(definition.replace('\r\n', '\n').encode('utf-8')).hexdigest()
+
+
+def environment_info(conn):
+    """服务器、数据库和测试客户端的环境信息"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(ENVIRONMENT_SQL)
+        columns = [column[0] for column in cursor.description]
+        environment = dict(zip(columns, cursor.fetchone()))
+    finally:
+        cursor.close()
+    environment.update({'client_host': socket.gethostname(), 'python': platform.python_version(),
+                        'platform': platform.platform()})
+    return environment
+
+
+def record_benchmark(store, conn, sp_name, benchmark, params=None, database=None, label=None):
+    """记录一次 benchmark_procedure 结果，定义哈希和环境信息从当前连接读取"""
+    return store.add_run(sp_name, benchmark, params=params, database=database,
+                         code_hash=procedure_code_hash(conn, sp_name), environment=environment_info(conn),
+                         label=label)
+
+
+def record_report(store, conn, report, original, optimized, params=None):
+    """记录 compare_procedures 报告中的原始/优化两组结果，返回 {'original': run_id, 'optimized': run_id}"""
+    return {side: record_benchmark(store, conn, name, report[side], params, report.get('database'),
+                                   label=report.get('test_date'))
+            for side, name in (('original', original), ('optimized', optimized))}
+
+
+def print_history(runs):
+    for run in runs:
+        median_text = f"{run['median_ms']:,.0f} ms" if run['median_ms'] is not None else '-'
+        print(f"  #{run['id']:<5} {run['run_at'][:19]}  {run['rounds']} 轮  中位 {median_text:>10}  "
+              f"{run['cache_mode'] or '':<5} {(run['code_hash'] or '')[:12]}")
+
+
+def print_check(check):
+    status = check['status']
+    if status in ('no_baseline', 'no_run', 'no_data', 'baseline'):
+        print(f"[*] {check['procedure']}: {status}")
+        return
+    marker = '[!]' if status == 'regression' else '[+]'
+    print(f"{marker} {check['procedure']}: 基线 #{check['baseline_run_id']} {check['baseline_median_ms']:,.0f} ms → "
+          f"#{check['run_id']} {check['current_median_ms']:,.0f} ms (×{check['ratio']}, p={check['p_value']})"
+          f"{' [定义已变更]' if check['code_changed'] else ''}{' 性能回退' if status == 'regression' else ''}")
+
+
+def main():
+    args = sys.argv[1:]
+    with ResultsStore() as store:
+        if args[:1] == ['history'] and len(args) >= 2:
+            limit = int(args[2]) if len(args) > 2 else 30
+            print(f"[+] {args[1]} 最近 {limit} 次运行:")
+            print_history(store.recent_runs(args[1], limit))
+            return 0
+        if args[:1] == ['pin'] and len(args) >= 2:
+            run_id = store.pin_baseline(args[1], int(args[2]) if len(args) > 2 else None)
+            print(f"[+] {args[1]} 基线已固定为运行 #{run_id}")
+            return 0
+
+        checks = [check_regression(store, procedure) for procedure in sorted(store.baselines())]
+        if not checks:
+            print("[*] 尚未固定任何基线")
+        for check in checks:
+            print_check(check)
+        regressions = [c for c in checks if c['status'] == 'regression']
+        if regressions:
+            print(f"\n[!] {len(regressions)} 个存储过程性能回退")
+            return 1
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
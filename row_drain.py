@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+结果集排空策略
+- fetchmany:    按 arraysize 批量获取，可保留前N行样本
+- discard:      流式读取所有结果集并立即丢弃，只计数
+- server_count: 在服务器端用 COUNT_BIG/CHECKSUM_AGG 包装查询，不向客户端传输任何数据行
+用于把客户端取数开销从查询耗时中剔除，每次运行都会记录所用策略
+"""
+
+import re
+
+from statistics_parser import collect_messages
+
+DRAIN_STRATEGIES = ('fetchmany', 'discard', 'server_count')
+
+DEFAULT_ARRAYSIZE = 1000
+
+_WITH_RE = re.compile(r'^\s*;?\s*WITH\b', re.I)
+_AS_RE = re.compile(r'\bAS\s*\(', re.I)
+
+
+def _skip_literal(sql, i):
+    """跳过从 i 开始的字符串或注释，返回其后的位置；不是字符串/注释时返回 i"""
+    if sql.startswith('--', i):
+        end = sql.find('\n', i)
+        return len(sql) if end < 0 else end + 1
+    if sql.startswith('/*', i):
+        end = sql.find('*/', i + 2)
+        return len(sql) if end < 0 else end + 2
+    if sql[i] in ("'", '['):
+        close = "'" if sql[i] == "'" else ']'
+        j = i + 1
+        while j < len(sql):
+            if sql[j] == close:
+                if j + 1 < len(sql) and sql[j + 1] == close:
+                    j += 2
+                    continue
+                return j + 1
+            j += 1
+        return len(sql)
+    return i
+
+
+def _matching_paren(sql, open_index):
+    """返回与 open_index 处左括号匹配的右括号位置"""
+    depth = 0
+    i = open_index
+    while i < len(sql):
+        skipped = _skip_literal(sql, i)
+        if skipped != i:
+            i = skipped
+            continue
+        if sql[i] == '(':
+            depth += 1
+        elif sql[i] == ')':
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise ValueError("SQL括号不匹配")
+
+
+def split_cte(sql):
+    """把 WITH ... 查询拆成 (CTE定义部分, 主查询)；没有CTE时前者为空串"""
+    sql = sql.strip().rstrip(';')
+    if not _WITH_RE.match(sql):
+        return '', sql
+
+    i = _WITH_RE.match(sql).end()
+    while True:
+        # CTE名称和可选的列清单
+        match = _AS_RE.search(sql, i)
+        if not match:
+            raise ValueError("无法解析CTE定义")
+        close = _matching_paren(sql, match.end() - 1)
+        i = close + 1
+        rest = sql[i:].lstrip()
+        if not rest.startswith(','):
+            break
+        i = sql.index(',', i) + 1
+
+    return sql[:i], sql[i:].strip()
+
+
+def wrap_server_count(sql):
+    """把单条SELECT(可带CTE)包装成只返回行数和校验和的查询"""
+    cte, query = split_cte(sql)
+    return (
+        f"{cte}\nSELECT COUNT_BIG(*) AS row_count, CHECKSUM_AGG(BINARY_CHECKSUM(*)) AS checksum\n"
+        f"FROM (\n{query}\n) AS drained"
+    )
+
+
+def drain_rows(cursor, strategy='fetchmany', arraysize=DEFAULT_ARRAYSIZE, sample=0, messages=None):
+    """
+    排空已执行游标上的数据行
+
+    fetchmany: 只读当前结果集，sample>0 时保留前 sample 行
+    discard:   读完所有结果集(包括后续 nextset)，不保留任何行
+    messages:  传入列表时，沿途的信息消息会追加到其中
+    """
+    if strategy not in ('fetchmany', 'discard'):
+        raise ValueError(f"游标排空不支持的策略: {strategy}")
+
+    cursor.arraysize = arraysize
+    row_count = 0
+    kept = []
+
+    while True:
+        if cursor.description is not None:
+            while True:
+                batch = cursor.fetchmany(arraysize)
+                if not batch:
+                    break
+                row_count += len(batch)
+                if len(kept) < sample:
+                    kept.extend(batch[:sample - len(kept)])
+        if messages is not None:
+            messages.extend(collect_messages(cursor))
+        if strategy == 'fetchmany' or not cursor.nextset():
+            break
+
+    result = {'strategy': strategy, 'arraysize': arraysize, 'row_count': row_count}
+    if sample:
+        result['sample'] = kept
+    return result
+
+
+def drain_executed(cursor, strategy='fetchmany', arraysize=DEFAULT_ARRAYSIZE, sample=0, messages=None):
+    """排空已执行的游标；server_count 策略下读取包装查询返回的行数和校验和"""
+    if strategy not in DRAIN_STRATEGIES:
+        raise ValueError(f"未知的排空策略: {strategy}")
+
+    if strategy != 'server_count':
+        return drain_rows(cursor, strategy, arraysize, sample, messages)
+
+    row = cursor.fetchone()
+    if messages is not None:
+        messages.extend(collect_messages(cursor))
+    return {'strategy': strategy, 'row_count': row[0], 'checksum': row[1]}
+
+
+def execute_and_drain(cursor, sql, params=(), strategy='fetchmany', arraysize=DEFAULT_ARRAYSIZE, sample=0,
+                      messages=None):
+    """按指定策略执行并排空查询，返回 {'strategy', 'row_count', ...}"""
+    if strategy == 'server_count':
+        sql = wrap_server_count(sql)
+    cursor.execute(sql, *params)
+    return drain_executed(cursor, strategy, arraysize, sample, messages)
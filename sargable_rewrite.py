@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+谓词可索引化(SARG)改写
+识别 ISNULL(col, 0) = 0、ISNULL(col, '') != ''、YEAR(col) = YEAR(GETDATE())、RTRIM(col) = 'x'
+等对列套函数的谓词，生成语义等价、可走索引查找的写法；
+逐条执行原语句与改写后语句，确认结果一致并比较耗时和逻辑读，
+验证通过的改写记入目录，可批量应用到其他脚本
+"""
+
+import json
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from db_connection import connect
+from param_binding import bind_statement
+from query_watchdog import StatementWatchdog, timeout_message
+from result_equivalence import compare_results
+from row_drain import drain_rows
+from statistics_parser import messages_from_error, parse_messages
+from timing_harness import percentile, set_statistics
+from tsql_scanner import clause_states, matching_paren, tokenize
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+_COMPARISONS = {'=', '<>', '!=', '<', '>', '<=', '>='}
+_FLIPPED = {'=': '=', '<>': '<>', '!=': '!=', '<': '>', '>': '<', '<=': '>=', '>=': '<='}
+_ARITHMETIC = {'+', '-', '*', '/', '%'}
+# 被替换片段前后出现这些词时，改写会改变运算优先级或三值逻辑的结果
+_UNSAFE_BEFORE = _ARITHMETIC | {'NOT', '~', '&', '|', '^'}
+_UNSAFE_AFTER = _ARITHMETIC | {'COLLATE', '&', '|', '^'}
+_PREDICATE_BOUNDARIES = {'(', 'AND', 'OR', 'WHERE', 'ON', 'HAVING', 'WHEN'}
+# 年份表达式结束的位置
+_EXPRESSION_BOUNDARIES = {'AND', 'OR', 'THEN', 'WHEN', 'ELSE', 'END', 'ORDER', 'GROUP', 'HAVING', 'UNION',
+                          'EXCEPT', 'INTERSECT', 'OPTION', 'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'LEFT',
+                          'RIGHT', 'INNER', 'JOIN', 'CROSS', 'OUTER', 'WHERE', ';'}
+
+
+def _is_column(token):
+    return token.kind == 'name' and not token.text.startswith(('@', '#'))
+
+
+def _literal(tokens, index):
+    """tokens[index] 起的字面量(数值可带负号)，返回 (文本, 下一个下标)；不是字面量时返回 (None, index)"""
+    if index < len(tokens) and tokens[index].kind in ('number', 'string'):
+        return tokens[index].text, index + 1
+    if index + 1 < len(tokens) and tokens[index].text == '-' and tokens[index + 1].kind == 'number':
+        return f"-{tokens[index + 1].text}", index + 2
+    return None, index
+
+
+def _literal_value(text):
+    """字面量的比较值：数值为 Decimal，字符串按不区分大小写、忽略尾随空格的排序规则处理"""
+    if text.upper().startswith(("N'", "'")):
+        return 'string', text[text.index("'") + 1:-1].replace("''", "'").rstrip(' ').casefold()
+    try:
+        return 'number', Decimal(text)
+    except InvalidOperation:
+        return None, None
+
+
+def compare_literals(left, op, right):
+    """在客户端求值 left op right；无法确定(类型不同或字符串大小比较)时返回 None"""
+    kind_l, value_l = _literal_value(left)
+    kind_r, value_r = _literal_value(right)
+    if kind_l is None or kind_l != kind_r:
+        return None
+    if kind_l == 'string' and op not in ('=', '<>', '!='):
+        return None
+    return {
+        '=': value_l == value_r, '<>': value_l != value_r, '!=': value_l != value_r,
+        '<': value_l < value_r, '>': value_l > value_r, '<=': value_l <= value_r, '>=': value_l >= value_r
+    }[op]
+
+
+def _split_args(tokens, open_index, close_index):
+    """按顶层逗号切分函数参数，返回各参数的词列表"""
+    args, current, depth = [], [], 0
+    for token in tokens[open_index + 1:close_index]:
+        if token.text == '(':
+            depth += 1
+        elif token.text == ')':
+            depth -= 1
+        if token.text == ',' and depth == 0:
+            args.append(current)
+            current = []
+        else:
+            current.append(token)
+    args.append(current)
+    return args
+
+
+def _expression_end(tokens, start):
+    """从 start 起取一个不跨越 AND/OR 和外层右括号的表达式，返回结束下标(不含)"""
+    depth = 0
+    for index in range(start, len(tokens)):
+        token = tokens[index]
+        if token.text == '(':
+            depth += 1
+        elif token.text == ')':
+            if depth == 0:
+                return index
+            depth -= 1
+        elif depth == 0 and (token.upper in _EXPRESSION_BOUNDARIES or token.text == ','):
+            return index
+    return len(tokens)
+
+
+def _comparison_operand(tokens, function_index, close_index):
+    """
+    找到函数调用两侧的比较：返回 (op, 字面量, 替换起点下标, 替换终点下标)
+
+    支持 f(...) op literal 和 literal op f(...)(后者翻转运算符)；不是这种形式时返回 None
+    """
+    after = close_index + 1
+    if after < len(tokens) and tokens[after].text in _COMPARISONS:
+        literal, end = _literal(tokens, after + 1)
+        if literal is not None and (end >= len(tokens) or tokens[end].text not in _ARITHMETIC):
+            return tokens[after].text, literal, function_index, end - 1
+    if function_index >= 2 and tokens[function_index - 1].text in _COMPARISONS:
+        op = tokens[function_index - 1].text
+        for start in (function_index - 2, function_index - 3):
+            literal, end = _literal(tokens, start)
+            # 左侧字面量前面必须是谓词边界，x - 1 = f(...) 中的 "- 1" 不是负数字面量
+            if literal is not None and end == function_index - 1 \
+                    and (start == 0 or tokens[start - 1].upper in _PREDICATE_BOUNDARIES):
+                return _FLIPPED[op], literal, start, close_index
+    return None
+
+
+def _negated(tokens, index):
+    """index 处的谓词是否在 NOT 之下(紧跟 NOT，或外层某个括号前是 NOT)"""
+    if index and tokens[index - 1].upper == 'NOT':
+        return True
+    depth = 0
+    for k in range(index - 1, -1, -1):
+        if tokens[k].text == ')':
+            depth += 1
+        elif tokens[k].text == '(':
+            if depth:
+                depth -= 1
+            elif k and tokens[k - 1].upper == 'NOT':
+                return True
+    return False
+
+
+def _rewrite_isnull(sql, tokens, index, close):
+    args = _split_args(tokens, index + 1, close)
+    if len(args) != 2 or len(args[0]) != 1 or not _is_column(args[0][0]):
+        return None
+    default, end = _literal(args[1], 0)
+    if default is None or end != len(args[1]):
+        return None
+    comparison = _comparison_operand(tokens, index, close)
+    if comparison is None:
+        return None
+    op, literal, first, last = comparison
+    null_matches = compare_literals(default, op, literal)
+    # 去掉 ISNULL 后 NULL 行的比较结果变为 UNKNOWN，在 NOT 之下会从"保留"变成"丢弃"
+    if null_matches is None or (not null_matches and _negated(tokens, first)):
+        return None
+    column = args[0][0].text
+    text = f"({column} {op} {literal} OR {column} IS NULL)" if null_matches else f"{column} {op} {literal}"
+    return first, last, text, 'isnull_compare'
+
+
+def _rewrite_year(sql, tokens, index, close):
+    args = _split_args(tokens, index + 1, close)
+    if len(args) != 1 or len(args[0]) != 1 or not _is_column(args[0][0]):
+        return None
+    if close + 1 >= len(tokens) or tokens[close + 1].text != '=':
+        return None
+    end = _expression_end(tokens, close + 2)
+    expression = tokens[close + 2:end]
+    # 右侧不能引用列，否则无法化为常量区间
+    if not expression or any(_is_column(t) and t.upper not in ('YEAR', 'GETDATE', 'SYSDATETIME', 'CAST',
+                                                               'CONVERT', 'DATEADD', 'INT')
+                             for t in expression):
+        return None
+    column = args[0][0].text
+    if len(expression) == 1 and expression[0].kind == 'number':
+        year = int(expression[0].text)
+        text = f"({column} >= '{year:04d}0101' AND {column} < '{year + 1:04d}0101')"
+    else:
+        year = sql[expression[0].start:expression[-1].end]
+        text = f"({column} >= DATEFROMPARTS({year}, 1, 1) AND {column} < DATEFROMPARTS({year} + 1, 1, 1))"
+    return index, end - 1, text, 'year_range'
+
+
+def _rewrite_rtrim(sql, tokens, index, close):
+    # 比较时尾随空格本就被忽略，RTRIM(col) = 'x' 与 col = 'x' 等价
+    args = _split_args(tokens, index + 1, close)
+    if len(args) != 1 or len(args[0]) != 1 or not _is_column(args[0][0]):
+        return None
+    comparison = _comparison_operand(tokens, index, close)
+    if comparison is None or comparison[0] not in ('=', '<>', '!='):
+        return None
+    op, literal, first, last = comparison
+    if _literal_value(literal)[0] != 'string':
+        return None
+    return first, last, f"{args[0][0].text} {op} {literal}", 'rtrim_compare'
+
+
+_REWRITERS = {'ISNULL': _rewrite_isnull, 'COALESCE': _rewrite_isnull, 'YEAR': _rewrite_year,
+              'RTRIM': _rewrite_rtrim}
+
+
+def find_rewrites(sql):
+    """
+    找出可改写的谓词
+
+    返回 [{'rule', 'line', 'start', 'end', 'original', 'rewritten'}]，start/end 为字符偏移，互不重叠
+    """
+    tokens = tokenize(sql)
+    states = clause_states(tokens)
+    rewrites, last_end = [], -1
+    for index, token in enumerate(tokens):
+        rewriter = _REWRITERS.get(token.upper)
+        if rewriter is None or states[index] != 'predicate' or index + 1 >= len(tokens) \
+                or tokens[index + 1].text != '(':
+            continue
+        # 紧跟在另一个函数左括号后的(如 LTRIM(RTRIM(col)))不单独改写
+        if index >= 2 and tokens[index - 1].text == '(' and tokens[index - 2].kind == 'name' \
+                and tokens[index - 2].upper not in _PREDICATE_BOUNDARIES:
+            continue
+        found = rewriter(sql, tokens, index, matching_paren(tokens, index + 1))
+        if found is None:
+            continue
+        first, last, text, rule = found
+        # 1 = ISNULL(a, 0) + 1、'x' + ISNULL(a, '') = 'x'、NOT ISNULL(a, 1) = 0 这类上下文不改写
+        if (first and tokens[first - 1].upper in _UNSAFE_BEFORE) \
+                or (last + 1 < len(tokens) and tokens[last + 1].text in _UNSAFE_AFTER):
+            continue
+        start, end = tokens[first].start, tokens[last].end
+        if start < last_end:
+            continue
+        rewrites.append({'rule': rule, 'line': tokens[first].line, 'start': start, 'end': end,
+                         'original': sql[start:end], 'rewritten': text})
+        last_end = end
+    return rewrites
+
+
+def apply_rewrites(sql, rewrites):
+    """从后往前替换，偏移不受前面替换的影响"""
+    for rewrite in sorted(rewrites, key=lambda r: r['start'], reverse=True):
+        sql = sql[:rewrite['start']] + rewrite['rewritten'] + sql[rewrite['end']:]
+    return sql
+
+
+def _normalize(text):
+    return ' '.join(text.split()).upper()
+
+
+def apply_proven(sql, catalog):
+    """只应用目录中已验证等价的改写(按规范化后的原文匹配)，返回 (新SQL, 应用的改写)"""
+    proven = {_normalize(entry['original']): entry['rewritten'] for entry in catalog if entry.get('proven')}
+    applied = [r for r in find_rewrites(sql) if _normalize(r['original']) in proven]
+    for rewrite in applied:
+        rewrite['rewritten'] = proven[_normalize(rewrite['original'])]
+    return apply_rewrites(sql, applied), applied
+
+
+def measure_statement(conn, sql, params=None, rounds=3, warmup=1, timeout_ms=None):
+    """多轮执行语句(每轮回滚)，返回耗时中位数和逻辑读/CPU"""
+    if params:
+        exec_sql, values, _ = bind_statement(sql, params)
+    else:
+        exec_sql, values = sql, []
+
+    durations, reads, cpu, error = [], [], [], None
+    set_statistics(conn, True)
+    try:
+        for round_no in range(warmup + rounds):
+            messages = []
+            cursor = conn.cursor()
+            started = time.perf_counter()
+            try:
+                with StatementWatchdog(cursor, timeout_ms) as watchdog:
+                    cursor.execute(exec_sql, *values)
+                    drain_rows(cursor, 'discard', messages=messages)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+            except Exception as e:
+                error = timeout_message(watchdog.fired_at_ms) if watchdog.fired else str(e)
+                messages.extend(messages_from_error(e))
+                break
+            finally:
+                cursor.close()
+                conn.rollback()
+            if round_no >= warmup:
+                statistics = parse_messages(messages, exec_call=bool(params))
+                durations.append(elapsed_ms)
+                reads.append(statistics['logical_reads'])
+                cpu.append(statistics['cpu_ms'])
+    finally:
+        set_statistics(conn, False)
+
+    durations.sort()
+    return {
+        'rounds': len(durations),
+        'error': error,
+        'median_ms': round(percentile(durations, 50), 1) if durations else None,
+        'logical_reads': sorted(reads)[len(reads) // 2] if reads else None,
+        'cpu_ms': sorted(cpu)[len(cpu) // 2] if cpu else None
+    }
+
+
+def verify_rewrite(conn, original_sql, rewritten_sql, params=None, rounds=3, key_columns=(), decimals=4,
+                   timeout_ms=None):
+    """校验结果一致后比较耗时和逻辑读；结果不一致时不再计时"""
+    equivalence = compare_results(conn, original_sql, rewritten_sql, params, key_columns, decimals)
+    result = {'equivalent': equivalence['equivalent'],
+              'error': equivalence.get('original_error') or equivalence.get('optimized_error')}
+    if not result['equivalent']:
+        result['result_sets'] = equivalence['result_sets']
+        return result
+
+    before = measure_statement(conn, original_sql, params, rounds, timeout_ms=timeout_ms)
+    after = measure_statement(conn, rewritten_sql, params, rounds, timeout_ms=timeout_ms)
+    result.update({'before': before, 'after': after})
+    if before['median_ms'] and after['median_ms'] is not None:
+        result['speedup'] = round(before['median_ms'] / after['median_ms'], 2) if after['median_ms'] else None
+        result['logical_reads_saved'] = (before['logical_reads'] or 0) - (after['logical_reads'] or 0)
+    return result
+
+
+def rewrite_and_verify(conn, sql, params=None, rounds=3, key_columns=(), decimals=4, timeout_ms=None):
+    """
+    逐条验证每个改写，再把全部验证通过的改写合并后整体验证一次
+
+    返回 {'rewrites': [...], 'combined': {...}, 'rewritten_sql': ...}
+    """
+    rewrites = find_rewrites(sql)
+    print(f"[*] 发现 {len(rewrites)} 处可改写谓词")
+    for rewrite in rewrites:
+        print(f"  第 {rewrite['line']} 行: {' '.join(rewrite['original'].split())}  →  {rewrite['rewritten']}")
+        verification = verify_rewrite(conn, sql, apply_rewrites(sql, [rewrite]), params, rounds, key_columns,
+                                      decimals, timeout_ms)
+        rewrite['verification'] = verification
+        rewrite['proven'] = verification['equivalent']
+        print_verification(verification)
+
+    proven = [r for r in rewrites if r['proven']]
+    rewritten_sql = apply_rewrites(sql, proven)
+    combined = None
+    if len(proven) > 1:
+        print(f"[*] 合并 {len(proven)} 处已验证改写后整体验证...")
+        combined = verify_rewrite(conn, sql, rewritten_sql, params, rounds, key_columns, decimals, timeout_ms)
+        print_verification(combined)
+    return {'rewrites': rewrites, 'combined': combined, 'rewritten_sql': rewritten_sql}
+
+
+def print_verification(verification):
+    if not verification['equivalent']:
+        print(f"    [-] 结果不一致{'，' + verification['error'] if verification.get('error') else ''}，不采用")
+        return
+    before, after = verification['before'], verification['after']
+    if before['error'] or after['error']:
+        print(f"    [!] 结果一致，计时出错: {before['error'] or after['error']}")
+        return
+    print(f"    [+] 结果一致: {before['median_ms']:,.1f} → {after['median_ms']:,.1f} ms "
+          f"(×{verification.get('speedup')}), 逻辑读 {before['logical_reads']:,} → {after['logical_reads']:,}")
+
+
+def catalog_entries(results):
+    """把验证结果整理为改写目录条目，供 apply_proven 批量应用"""
+    return [{'rule': r['rule'], 'original': ' '.join(r['original'].split()), 'rewritten': r['rewritten'],
+             'proven': r['proven'], 'speedup': r['verification'].get('speedup'),
+             'logical_reads_saved': r['verification'].get('logical_reads_saved')}
+            for r in results['rewrites']]
+
+
+def main():
+    # verify_cross_db_query.py 中的跨库统计查询(只保留谓词相关部分)
+    sql = """
+SELECT detail.ID, detail.ProjectID, detail.StrengthGrade, Report.ReportDate, Periods.ID AS PeriodID
+FROM ProductionDailyReportDetails detail
+    LEFT JOIN dbo.ProductionDailyReports Report ON detail.DailyReportID = Report.ID
+    LEFT JOIN dbo.Periods ON Report.ReportDate BETWEEN Periods.StartDate AND EndDate AND ISNULL(Periods.isDeleted, 0) = 0
+WHERE ISNULL(Report.isDeleted, 0) = 0
+      AND detail.ProjectID IS NOT NULL
+      AND Report.ReportDate BETWEEN @BeginDate AND @EndDate
+      AND ISNULL(detail.StrengthGrade, '') != ''
+"""
+    params = {'BeginDate': datetime(2025, 11, 1), 'EndDate': datetime(2025, 11, 30)}
+
+    print("=" * 60)
+    print("谓词可索引化改写与验证")
+    print("=" * 60)
+
+    conn = connect(DEFAULT_DATABASE)
+    try:
+        results = rewrite_and_verify(conn, sql, params, rounds=3, key_columns=('ID',), timeout_ms=120000)
+    finally:
+        conn.close()
+
+    print("\n[+] 改写后的语句:")
+    print(results['rewritten_sql'])
+
+    output_file = f"sargable_rewrites_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump({'test_date': datetime.now().isoformat(), 'catalog': catalog_entries(results),
+                   'combined': results['combined'], 'rewritten_sql': results['rewritten_sql']},
+                  f, ensure_ascii=False, indent=2, default=str)
+    print(f"[+] 改写目录已保存: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
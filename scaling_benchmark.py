@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+数据量扩展基准测试
+把 BankCashFlow 按多个数据量(如 1万/10万/100万/1000万行)复制到会话临时表，
+以临时存储过程分别运行原始游标版与窗口函数优化版 CashFlowBalance，
+拟合耗时增长曲线(线性 / n log n / 平方)，计算各版本越过延迟SLO的数据量，
+并按近一年的流水增长速度估算优化还能撑多久
+"""
+
+import json
+import math
+import os
+import re
+import time
+from datetime import datetime
+
+from db_connection import connect
+from index_consolidation import parse_index_script
+from query_watchdog import StatementWatchdog, timeout_message
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cashflowBalance存储过程优化')
+PROCEDURE_FILES = {
+    'original': os.path.join(BASE_DIR, 'CashFlowBalance_definition.sql'),
+    'optimized': os.path.join(BASE_DIR, 'CashFlowBalance_Optimized.sql')
+}
+INDEX_FILE = os.path.join(BASE_DIR, 'CashFlowBalance_Indexes.sql')
+
+# 业务表 → 会话临时表，测试不触碰真实数据
+SCALE_TABLES = {'BankCashFlow': '#ScaleBankCashFlow', 'BankCashBalance': '#ScaleBankCashBalance'}
+
+DEFAULT_VOLUMES = (10_000, 100_000, 1_000_000, 10_000_000)
+DEFAULT_SLO_MS = 5000
+
+# 数据增长方式：(BankAccountID 表达式, TxnDate 表达式)，copy_no 为第几份复制
+GROWTH_MODES = {
+    # 账户数随数据量增长，每个账户的流水密度不变
+    'accounts': ('src.BankAccountID + n.copy_no * {account_span}', 'src.TxnDate'),
+    # 账户不变，同一时间段内每个账户的流水变多
+    'density': ('src.BankAccountID', 'DATEADD(SECOND, n.copy_no, src.TxnDate)'),
+    # 账户不变，历史向前延伸(查询区间内的流水不变，期初余额要扫描的历史变长)
+    'history': ('src.BankAccountID', 'DATEADD(DAY, -n.copy_no * {day_span}, src.TxnDate)')
+}
+
+SOURCE_PROFILE_SQL = """
+SELECT COUNT_BIG(*) AS source_rows,
+       ISNULL(MAX(BankAccountID), 0) + 1 AS account_span,
+       ISNULL(DATEDIFF(DAY, MIN(TxnDate), MAX(TxnDate)), 0) + 1 AS day_span,
+       SUM(CASE WHEN TxnDate >= DATEADD(DAY, -365, GETDATE()) THEN 1 ELSE 0 END) AS rows_last_year
+FROM dbo.BankCashFlow
+"""
+
+# 临时表必须在非参数化批处理中创建，否则随 sp_executesql 作用域结束而被删除
+LOAD_SQL = """
+IF OBJECT_ID('tempdb..#ScaleBankCashFlow') IS NOT NULL DROP TABLE #ScaleBankCashFlow;
+IF OBJECT_ID('tempdb..#ScaleBankCashBalance') IS NOT NULL DROP TABLE #ScaleBankCashBalance;
+
+WITH src AS (
+    SELECT BankAccountID, TxnDate, IncomeAmt, ExpenditureAmt, isDeleted, ifSplited,
+           ROW_NUMBER() OVER (ORDER BY id) AS src_rn
+    FROM dbo.BankCashFlow
+),
+n AS (
+    SELECT TOP ({copies}) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) - 1 AS copy_no
+    FROM sys.all_columns a CROSS JOIN sys.all_columns b
+)
+SELECT TOP ({rows})
+       CAST(ROW_NUMBER() OVER (ORDER BY n.copy_no, src.src_rn) AS BIGINT) AS id,
+       CAST({account} AS BIGINT) AS BankAccountID,
+       {txn_date} AS TxnDate,
+       src.IncomeAmt, src.ExpenditureAmt, src.isDeleted, src.ifSplited
+INTO #ScaleBankCashFlow
+FROM n CROSS JOIN src
+ORDER BY n.copy_no, src.src_rn;
+
+CREATE UNIQUE CLUSTERED INDEX CX_ScaleBankCashFlow ON #ScaleBankCashFlow (id);
+
+SELECT TOP 0 * INTO #ScaleBankCashBalance FROM dbo.BankCashBalance;
+"""
+
+OUTPUT_CHECKSUM_SQL = """
+SELECT COUNT_BIG(*) AS row_count, SUM(CAST(Balance AS DECIMAL(38, 4))) AS balance_sum
+FROM #ScaleBankCashBalance
+"""
+
+_CREATE_PROCEDURE_RE = re.compile(r"\bCREATE\s+PROC(?:EDURE)?\s+[\w\.\[\]]+", re.I)
+_GO_RE = re.compile(r"^\s*GO\s*$", re.I | re.M)
+
+# 拟合模型：耗时 ≈ a·f(n) + b
+MODELS = {
+    'linear': lambda n: n,
+    'n_log_n': lambda n: n * math.log(n),
+    'quadratic': lambda n: n * n
+}
+
+
+def scale_procedure_name(version):
+    return f"#CashFlowBalance_Scale_{version}"
+
+
+def load_scaled_procedure(path, version):
+    """读取存储过程定义，改名为会话临时过程并把业务表替换为临时表"""
+    with open(path, encoding='utf-8-sig') as f:
+        sql = _GO_RE.split(f.read())[0]
+    sql = _CREATE_PROCEDURE_RE.sub(f"CREATE PROCEDURE {scale_procedure_name(version)}", sql, count=1)
+    for table, scale_table in SCALE_TABLES.items():
+        sql = re.sub(rf"(?:\[?dbo\]?\.)?\[?\b{table}\b\]?", scale_table, sql)
+    return sql
+
+
+def scaled_index_statements(path=INDEX_FILE):
+    """把索引脚本中建在 BankCashFlow/BankCashBalance 上的索引改建到临时表"""
+    statements = []
+    for index in parse_index_script(path):
+        scale_table = SCALE_TABLES.get(index['table'].split('.')[-1])
+        if scale_table is None:
+            continue
+        keys = ', '.join(f"{column} {direction}" for column, direction in index['keys'])
+        include = f" INCLUDE ({', '.join(index['include'])})" if index['include'] else ''
+        statements.append(f"CREATE NONCLUSTERED INDEX {index['name']} ON {scale_table} ({keys}){include}")
+    return statements
+
+
+def source_profile(conn):
+    """源表行数、账户/日期跨度和近一年新增行数"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SOURCE_PROFILE_SQL)
+        row = cursor.fetchone()
+        return {name: (int(value) if value is not None else 0)
+                for name, value in zip((c[0] for c in cursor.description), row)}
+    finally:
+        cursor.close()
+
+
+def load_volume(conn, rows, profile, growth='density', indexes=()):
+    """按增长方式把源表复制到 #ScaleBankCashFlow，至 rows 行"""
+    if profile['source_rows'] == 0:
+        raise ValueError("dbo.BankCashFlow 为空，无法按比例生成测试数据")
+    account, txn_date = GROWTH_MODES[growth]
+    sql = LOAD_SQL.format(
+        copies=math.ceil(rows / profile['source_rows']), rows=int(rows),
+        account=account.format(account_span=profile['account_span']),
+        txn_date=txn_date.format(day_span=profile['day_span'])
+    )
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql)
+        while cursor.nextset():
+            pass
+        for statement in indexes:
+            cursor.execute(statement)
+        conn.commit()
+    finally:
+        cursor.close()
+    return round(time.perf_counter() - started, 1)
+
+
+def create_procedures(conn, definitions):
+    """CREATE PROCEDURE 必须单独成批"""
+    cursor = conn.cursor()
+    try:
+        for version, sql in definitions.items():
+            cursor.execute(f"IF OBJECT_ID('tempdb..{scale_procedure_name(version)}') IS NOT NULL "
+                           f"DROP PROCEDURE {scale_procedure_name(version)}")
+            cursor.execute(sql)
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def output_checksum(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(OUTPUT_CHECKSUM_SQL)
+        row = cursor.fetchone()
+        return {'row_count': row.row_count, 'balance_sum': float(row.balance_sum or 0)}
+    finally:
+        cursor.close()
+
+
+def run_version(conn, version, begin_date, end_date, rounds=2, timeout_ms=None):
+    """多轮执行某个版本，返回耗时中位数和输出校验值"""
+    durations, error = [], None
+    for _ in range(rounds):
+        cursor = conn.cursor()
+        started = time.perf_counter()
+        try:
+            with StatementWatchdog(cursor, timeout_ms) as watchdog:
+                cursor.execute(f"EXEC {scale_procedure_name(version)} ?, ?", begin_date, end_date)
+                while cursor.nextset():
+                    pass
+            durations.append((time.perf_counter() - started) * 1000)
+        except Exception as e:
+            error = timeout_message(watchdog.fired_at_ms) if watchdog.fired else str(e)
+            conn.rollback()
+            break
+        finally:
+            cursor.close()
+        conn.commit()
+
+    durations.sort()
+    return {
+        'rounds': len(durations),
+        'median_ms': round(durations[len(durations) // 2], 1) if durations else None,
+        'error': error,
+        'checksum': output_checksum(conn) if not error else None
+    }
+
+
+def outputs_match(left, right):
+    if not left or not right:
+        return None
+    return left['row_count'] == right['row_count'] \
+        and math.isclose(left['balance_sum'], right['balance_sum'], rel_tol=1e-9, abs_tol=0.01)
+
+
+def fit_model(points, model):
+    """最小二乘拟合 耗时 = a·f(n) + b，返回系数、残差平方和和R²"""
+    f = MODELS[model]
+    xs = [f(n) for n, _ in points]
+    ys = [y for _, y in points]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if sxx == 0:
+        return None
+    a = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+    b = mean_y - a * mean_x
+    sse = sum((y - (a * x + b)) ** 2 for x, y in zip(xs, ys))
+    sst = sum((y - mean_y) ** 2 for y in ys)
+    return {'model': model, 'a': a, 'b': b, 'sse': sse, 'r2': 1 - sse / sst if sst else 1.0}
+
+
+def power_exponent(points):
+    """双对数回归得到的增长指数 k(耗时 ∝ n^k)，作为模型选择的参考"""
+    logs = [(math.log(n), math.log(y)) for n, y in points if n > 0 and y > 0]
+    if len(logs) < 2:
+        return None
+    mean_x = sum(x for x, _ in logs) / len(logs)
+    mean_y = sum(y for _, y in logs) / len(logs)
+    sxx = sum((x - mean_x) ** 2 for x, _ in logs)
+    return round(sum((x - mean_x) * (y - mean_y) for x, y in logs) / sxx, 2) if sxx else None
+
+
+def fit_growth(points):
+    """对三种模型分别拟合，选残差最小且斜率为正的模型；少于3个数据点时不拟合"""
+    if len(points) < 3:
+        return None
+    fits = [fit for fit in (fit_model(points, model) for model in MODELS) if fit and fit['a'] > 0]
+    if not fits:
+        return None
+    best = min(fits, key=lambda fit: fit['sse'])
+    return {'best': best, 'fits': fits, 'exponent': power_exponent(points)}
+
+
+def predict(fit, n):
+    return fit['a'] * MODELS[fit['model']](n) + fit['b']
+
+
+def slo_crossing(fit, slo_ms, upper=1e12):
+    """二分求解拟合曲线越过SLO的数据量；在 upper 行以内不越过时返回 None"""
+    if predict(fit, 1) >= slo_ms:
+        return 1
+    if predict(fit, upper) < slo_ms:
+        return None
+    low, high = 1.0, upper
+    while high - low > max(1.0, low * 1e-4):
+        middle = (low + high) / 2
+        if predict(fit, middle) < slo_ms:
+            low = middle
+        else:
+            high = middle
+    return int(high)
+
+
+def months_until(crossing, profile):
+    """按近一年的月均新增行数估算还有几个月达到越界数据量"""
+    if crossing is None:
+        return None
+    remaining = crossing - profile['source_rows']
+    if remaining <= 0:
+        return 0.0
+    monthly = profile['rows_last_year'] / 12
+    return round(remaining / monthly, 1) if monthly else None
+
+
+def scaling_benchmark(conn, volumes=DEFAULT_VOLUMES, begin_date='2025-01-01', end_date='2025-12-31',
+                      growth='density', rounds=2, timeout_ms=600000, slo_ms=DEFAULT_SLO_MS, indexed=True):
+    """
+    逐个数据量加载数据并运行两个版本
+
+    某个版本超时或出错后，更大的数据量不再运行该版本
+    """
+    profile = source_profile(conn)
+    print(f"[*] 源表 BankCashFlow: {profile['source_rows']:,} 行, 近一年新增 {profile['rows_last_year']:,} 行")
+
+    definitions = {version: load_scaled_procedure(path, version) for version, path in PROCEDURE_FILES.items()}
+    indexes = scaled_index_statements() if indexed else []
+    active = set(definitions)
+    levels = []
+
+    for rows in sorted(volumes):
+        if not active:
+            print(f"[!] 两个版本均已超出时限，跳过 {rows:,} 行及以上")
+            break
+        print(f"\n[*] 加载 {rows:,} 行 (增长方式: {growth})...")
+        load_seconds = load_volume(conn, rows, profile, growth, indexes)
+        create_procedures(conn, {v: sql for v, sql in definitions.items() if v in active})
+        level = {'rows': rows, 'load_seconds': load_seconds, 'versions': {}}
+        for version in definitions:
+            if version not in active:
+                level['versions'][version] = {'skipped': True}
+                continue
+            result = run_version(conn, version, begin_date, end_date, rounds, timeout_ms)
+            level['versions'][version] = result
+            if result['error']:
+                active.discard(version)
+                print(f"  [-] {version}: {result['error']}")
+            else:
+                print(f"  [+] {version}: {result['median_ms']:,.1f} ms")
+        level['outputs_match'] = outputs_match(level['versions']['original'].get('checksum'),
+                                               level['versions']['optimized'].get('checksum'))
+        if level['outputs_match'] is False:
+            print("  [!] 两个版本写入 BankCashBalance 的结果不一致")
+        levels.append(level)
+
+    analysis = {}
+    for version in definitions:
+        points = [(level['rows'], level['versions'][version]['median_ms']) for level in levels
+                  if level['versions'][version].get('median_ms') is not None]
+        growth_fit = fit_growth(points)
+        crossing = slo_crossing(growth_fit['best'], slo_ms) if growth_fit else None
+        analysis[version] = {
+            'points': points,
+            'fit': growth_fit,
+            'slo_crossing_rows': crossing,
+            'months_until_slo': months_until(crossing, profile),
+            'predicted_current_ms': round(predict(growth_fit['best'], profile['source_rows']), 1)
+            if growth_fit and profile['source_rows'] else None
+        }
+
+    return {'profile': profile, 'growth': growth, 'slo_ms': slo_ms, 'begin_date': begin_date,
+            'end_date': end_date, 'levels': levels, 'analysis': analysis}
+
+
+def print_summary(report):
+    print("\n" + "=" * 60)
+    print(f"扩展性汇总 (SLO {report['slo_ms']:,} ms, 增长方式 {report['growth']})")
+    print("=" * 60)
+    print(f"{'行数':>12} {'原始(ms)':>12} {'优化(ms)':>12} {'结果一致':>8}")
+    for level in report['levels']:
+        cells = []
+        for version in ('original', 'optimized'):
+            result = level['versions'][version]
+            cells.append('跳过' if result.get('skipped') else
+                         ('出错' if result['error'] else f"{result['median_ms']:,.1f}"))
+        match = {True: '是', False: '否', None: '-'}[level['outputs_match']]
+        print(f"{level['rows']:>12,} {cells[0]:>12} {cells[1]:>12} {match:>8}")
+
+    for version, analysis in report['analysis'].items():
+        fit = analysis['fit']
+        if not fit:
+            print(f"\n[!] {version}: 有效数据点不足3个，无法拟合增长曲线")
+            continue
+        best = fit['best']
+        print(f"\n[*] {version}: 最符合 {best['model']} (R² {best['r2']:.3f}, 双对数指数 {fit['exponent']})")
+        if analysis['slo_crossing_rows'] is None:
+            print("    在 1e12 行以内不会越过 SLO")
+        else:
+            months = analysis['months_until_slo']
+            eta = '已越过' if months == 0 else (f"约 {months} 个月后" if months is not None else '增长速度未知')
+            print(f"    约 {analysis['slo_crossing_rows']:,} 行时越过 SLO ({eta})")
+
+
+def main():
+    print("=" * 60)
+    print("CashFlowBalance 数据量扩展基准测试")
+    print("=" * 60)
+
+    conn = connect(DEFAULT_DATABASE, timeout=30)
+    try:
+        report = scaling_benchmark(conn, volumes=DEFAULT_VOLUMES, growth='density')
+    finally:
+        conn.close()
+
+    print_summary(report)
+
+    output_file = f"scaling_benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    report['test_date'] = datetime.now().isoformat()
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    print(f"\n[+] 报告已保存: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+实际执行计划采集与对比
+开启 SET STATISTICS XML ON 收集每条语句的实际执行计划，
+解析为精简的算子树(预估/实际行数、扫描/查找、溢出、隐式转换、缺失索引提示)，
+并对原始与优化版本的计划做并排对比
+"""
+
+import xml.etree.ElementTree as ET
+
+from db_connection import connect
+from parallel_runner import build_exec_statement, is_procedure_name
+from statistics_parser import collect_messages
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+NS = {'sp': 'http://schemas.microsoft.com/sqlserver/2004/07/showplan'}
+SHOWPLAN_COLUMN = 'Microsoft SQL Server 2005 XML Showplan'
+
+SCAN_OPS = {'Table Scan', 'Clustered Index Scan', 'Index Scan', 'Columnstore Index Scan'}
+SEEK_OPS = {'Index Seek', 'Clustered Index Seek', 'RID Lookup', 'Key Lookup'}
+SPILL_WARNINGS = ('SpillToTempDb', 'HashSpillDetails', 'SortSpillDetails', 'ExchangeSpillDetails')
+
+
+def _tag(name):
+    return f"{{{NS['sp']}}}{name}"
+
+
+def drain_with_plans(cursor, messages=None):
+    """排空所有结果集，取出其中的showplan XML；普通结果集直接丢弃"""
+    plans = []
+    while True:
+        if messages is not None:
+            messages.extend(collect_messages(cursor))
+        if cursor.description is not None:
+            if cursor.description[0][0] == SHOWPLAN_COLUMN:
+                plans.extend(row[0] for row in cursor.fetchall())
+            else:
+                while cursor.fetchmany(5000):
+                    pass
+        if not cursor.nextset():
+            break
+    if messages is not None:
+        messages.extend(collect_messages(cursor))
+    return plans
+
+
+def capture_plans(conn, target, params=None, rollback=True):
+    """执行存储过程或语句并返回各语句的实际执行计划XML"""
+    sql, values = build_exec_statement(target, params) if is_procedure_name(target) else (target, [])
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SET STATISTICS XML ON")
+        cursor.execute(sql, *values)
+        return drain_with_plans(cursor)
+    finally:
+        cursor.execute("SET STATISTICS XML OFF")
+        cursor.close()
+        if rollback:
+            conn.rollback()
+        else:
+            conn.commit()
+
+
+def _child_relops(element):
+    """返回 element 下最近一层的 RelOp(不深入到子RelOp内部)"""
+    children = []
+    for child in element:
+        if child.tag == _tag('RelOp'):
+            children.append(child)
+        else:
+            children.extend(_child_relops(child))
+    return children
+
+
+def _parse_relop(relop):
+    physical = relop.get('PhysicalOp')
+    node = {
+        'node_id': int(relop.get('NodeId', -1)),
+        'op': physical,
+        'logical': relop.get('LogicalOp'),
+        'est_rows': float(relop.get('EstimateRows', 0)),
+        'cost': float(relop.get('EstimatedTotalSubtreeCost', 0)),
+        'act_rows': None,
+        'executions': None,
+        'object': None,
+        'table': None,
+        'access': 'scan' if physical in SCAN_OPS else 'seek' if physical in SEEK_OPS else None,
+        'spill': False,
+        'warnings': [],
+        'children': []
+    }
+
+    counters = relop.findall('sp:RunTimeInformation/sp:RunTimeCountersPerThread', NS)
+    if counters:
+        node['act_rows'] = sum(int(c.get('ActualRows', 0)) for c in counters)
+        node['executions'] = sum(int(c.get('ActualExecutions', 0)) for c in counters)
+
+    # 算子自身引用的对象在其直接子元素(如 IndexScan)下
+    for child in relop:
+        obj = child.find('sp:Object', NS)
+        if obj is not None:
+            parts = [part.strip('[]') for part in (obj.get('Schema'), obj.get('Table')) if part]
+            node['table'] = '.'.join(parts)
+            node['object'] = '.'.join(parts + ([obj.get('Index').strip('[]')] if obj.get('Index') else []))
+            break
+
+    warnings = relop.find('sp:Warnings', NS)
+    if warnings is not None:
+        for warning in warnings:
+            name = warning.tag.split('}')[1]
+            node['warnings'].append(name)
+            if name in SPILL_WARNINGS:
+                node['spill'] = True
+
+    node['children'] = [_parse_relop(child) for child in _child_relops(relop)]
+    return node
+
+
+def _parse_missing_indexes(query_plan):
+    hints = []
+    for group in query_plan.findall('sp:MissingIndexes/sp:MissingIndexGroup', NS):
+        for index in group.findall('sp:MissingIndex', NS):
+            hint = {
+                'impact': float(group.get('Impact', 0)),
+                'table': f"{index.get('Schema', '').strip('[]')}.{index.get('Table', '').strip('[]')}",
+                'equality': [], 'inequality': [], 'include': []
+            }
+            for column_group in index.findall('sp:ColumnGroup', NS):
+                usage = column_group.get('Usage', '').lower()
+                if usage in hint:
+                    hint[usage] = [c.get('Name').strip('[]') for c in column_group.findall('sp:Column', NS)]
+            hints.append(hint)
+    return hints
+
+
+def parse_plan(plan_xml):
+    """把一份showplan XML解析为语句列表，每条语句含算子树与告警汇总"""
+    root = ET.fromstring(plan_xml)
+    statements = []
+    for stmt in root.iter(_tag('StmtSimple')):
+        query_plan = stmt.find('sp:QueryPlan', NS)
+        if query_plan is None:
+            continue
+
+        conversions = []
+        for convert in query_plan.findall('sp:Warnings/sp:PlanAffectingConvert', NS):
+            conversions.append({'issue': convert.get('ConvertIssue'), 'expression': convert.get('Expression')})
+
+        relops = _child_relops(query_plan)
+        statements.append({
+            'text': ' '.join((stmt.get('StatementText') or '').split())[:200],
+            'cost': float(stmt.get('StatementSubTreeCost', 0)),
+            'tree': _parse_relop(relops[0]) if relops else None,
+            'implicit_conversions': conversions,
+            'missing_indexes': _parse_missing_indexes(query_plan)
+        })
+    return statements
+
+
+def walk(node):
+    """前序遍历算子树"""
+    if node is None:
+        return
+    yield node
+    for child in node['children']:
+        yield from walk(child)
+
+
+def summarize_plans(plans):
+    """汇总一组计划：扫描/查找次数、溢出、隐式转换、缺失索引、最严重的行数预估偏差"""
+    summary = {'statements': 0, 'cost': 0.0, 'scans': 0, 'seeks': 0, 'spills': 0,
+               'implicit_conversions': 0, 'missing_indexes': [], 'objects': {}, 'misestimates': []}
+
+    for plan_xml in plans:
+        for statement in parse_plan(plan_xml):
+            summary['statements'] += 1
+            summary['cost'] += statement['cost']
+            summary['implicit_conversions'] += len(statement['implicit_conversions'])
+            summary['missing_indexes'].extend(statement['missing_indexes'])
+
+            for node in walk(statement['tree']):
+                if node['access'] == 'scan':
+                    summary['scans'] += 1
+                elif node['access'] == 'seek':
+                    summary['seeks'] += 1
+                if node['spill']:
+                    summary['spills'] += 1
+
+                if node['table'] and node['access']:
+                    entry = summary['objects'].setdefault(node['table'], {'scan': 0, 'seek': 0, 'actual_rows': 0})
+                    entry[node['access']] += 1
+                    entry['actual_rows'] += node['act_rows'] or 0
+
+                if node['act_rows'] is not None and node['executions']:
+                    estimated = max(node['est_rows'] * node['executions'], 1.0)
+                    ratio = max(node['act_rows'], 1) / estimated
+                    if ratio >= 10 or ratio <= 0.1:
+                        summary['misestimates'].append({
+                            'node_id': node['node_id'], 'op': node['op'], 'object': node['object'],
+                            'estimated': estimated, 'actual': node['act_rows'], 'ratio': ratio
+                        })
+
+    summary['misestimates'].sort(key=lambda m: max(m['ratio'], 1 / m['ratio']), reverse=True)
+    return summary
+
+
+def diff_plans(original_plans, optimized_plans):
+    """并排对比两组计划XML"""
+    return diff_summaries(summarize_plans(original_plans), summarize_plans(optimized_plans))
+
+
+def diff_summaries(before, after):
+    """并排对比两份计划汇总的指标和各表访问方式"""
+
+    metrics = []
+    for key in ('statements', 'cost', 'scans', 'seeks', 'spills', 'implicit_conversions'):
+        metrics.append({'metric': key, 'original': before[key], 'optimized': after[key]})
+    metrics.append({'metric': 'missing_indexes',
+                    'original': len(before['missing_indexes']), 'optimized': len(after['missing_indexes'])})
+
+    objects = []
+    for table in sorted(set(before['objects']) | set(after['objects'])):
+        empty = {'scan': 0, 'seek': 0, 'actual_rows': 0}
+        objects.append({'table': table,
+                        'original': before['objects'].get(table, empty),
+                        'optimized': after['objects'].get(table, empty)})
+    objects.sort(key=lambda o: o['original']['actual_rows'] - o['optimized']['actual_rows'], reverse=True)
+
+    return {'metrics': metrics, 'objects': objects, 'original': before, 'optimized': after}
+
+
+def print_diff(diff, top=15):
+    """打印计划对比"""
+    print(f"\n  {'指标':<25} {'原始':>15} {'优化':>15}")
+    for m in diff['metrics']:
+        print(f"  {m['metric']:<25} {m['original']:>15,.2f} {m['optimized']:>15,.2f}")
+
+    print(f"\n  {'表':<40} {'原始 扫描/查找/实际行':>28} {'优化 扫描/查找/实际行':>28}")
+    for o in diff['objects'][:top]:
+        b, a = o['original'], o['optimized']
+        print(f"  {o['table']:<40} {b['scan']:>6}/{b['seek']:<6}/{b['actual_rows']:>13,} "
+              f"{a['scan']:>6}/{a['seek']:<6}/{a['actual_rows']:>13,}")
+
+    for side in ('original', 'optimized'):
+        for m in diff[side]['misestimates'][:5]:
+            print(f"  [{side}] 行数预估偏差: 节点 {m['node_id']} {m['op']} {m['object'] or ''} "
+                  f"预估 {m['estimated']:,.0f} / 实际 {m['actual']:,}")
+
+
+def main():
+    """主函数"""
+    params = {'beginDate': '2025-11-01', 'endDate': '2025-11-30'}
+    conn = connect(DEFAULT_DATABASE)
+    try:
+        print("[*] 采集 dbo.CashFlowBalance 实际执行计划...")
+        original = capture_plans(conn, 'dbo.CashFlowBalance', params)
+        print("[*] 采集 dbo.CashFlowBalance_Optimized 实际执行计划...")
+        optimized = capture_plans(conn, 'dbo.CashFlowBalance_Optimized', params)
+        print_diff(diff_plans(original, optimized))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
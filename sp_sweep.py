@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+全库存储过程扫描
+通过 sys.procedures / sys.parameters 枚举数据库中所有存储过程，
+按参数类型和名称生成合理的参数值，在回滚事务内限时执行，
+输出按耗时排序的热点排行(自动生成Top 10列表)
+"""
+
+import json
+import re
+import time
+from datetime import date, datetime, timedelta
+
+from analyze_usp_GenerateWorkbenchKanban_Business import get_sp_definition
+from db_connection import connect
+from statistics_parser import rank_tables
+from timing_harness import compute_statistics, run_round
+from tsql_scanner import tokenize
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+PROCEDURES_SQL = """
+SELECT SCHEMA_NAME(p.schema_id) AS schema_name, p.name AS procedure_name,
+       prm.name AS parameter_name, TYPE_NAME(prm.user_type_id) AS type_name,
+       prm.max_length, prm.precision, prm.scale, prm.is_output, prm.has_default_value,
+       prm.is_readonly
+FROM sys.procedures p
+LEFT JOIN sys.parameters prm ON prm.object_id = p.object_id
+WHERE p.is_ms_shipped = 0
+ORDER BY SCHEMA_NAME(p.schema_id), p.name, prm.parameter_id
+"""
+
+# 对ID类参数尝试从同名表中取一个真实存在的值
+SAMPLE_ID_SQL = """
+SELECT TOP 1 t.name
+FROM sys.tables t
+INNER JOIN sys.columns c ON c.object_id = t.object_id AND c.name = 'ID'
+WHERE t.name IN (?, ?) AND SCHEMA_NAME(t.schema_id) = 'dbo'
+"""
+
+# 常见失败原因，按错误号/关键字归类
+ERROR_CATEGORIES = [
+    ('timeout', re.compile(r'HYT00|Query timeout expired|操作已取消|timed out', re.I)),
+    ('linked_server', re.compile(r'\(7202\)|sys\.servers', re.I)),
+    ('missing_object', re.compile(r'\(208\)|Invalid object name', re.I)),
+    ('invalid_parameter', re.compile(r'\(1014\)|\(8114\)|\(245\)|\(201\)|expects parameter|conversion failed', re.I)),
+    ('permission', re.compile(r'\(229\)|\(262\)|permission', re.I)),
+    ('deadlock', re.compile(r'\(1205\)|deadlock', re.I))
+]
+
+def list_procedures(conn):
+    """枚举所有用户存储过程及其参数"""
+    cursor = conn.cursor()
+    cursor.execute(PROCEDURES_SQL)
+    procedures = {}
+    for row in cursor.fetchall():
+        name = f"{row.schema_name}.{row.procedure_name}"
+        procedure = procedures.setdefault(name, {
+            'procedure': name,
+            'schema': row.schema_name,
+            'name': row.procedure_name,
+            'parameters': []
+        })
+        if row.parameter_name:
+            procedure['parameters'].append({
+                'name': row.parameter_name,
+                'type': row.type_name,
+                'max_length': row.max_length,
+                'precision': row.precision,
+                'scale': row.scale,
+                'is_output': bool(row.is_output),
+                'has_default': bool(row.has_default_value),
+                'is_table_type': bool(row.is_readonly)
+            })
+    cursor.close()
+    return list(procedures.values())
+
+
+def external_temp_tables(definition):
+    """找出定义中引用但未在本过程内创建的临时表(依赖调用方预先创建)，注释与字符串中的 # 不计
+
+    只有 CREATE TABLE #t 与 SELECT ... INTO #t 算作创建(INSERT/MERGE INTO 不算)，
+    且创建必须出现在该临时表第一次被引用之前。
+    """
+    if not definition:
+        return []
+    tokens = tokenize(definition)
+    first_use = {}
+    for i, token in enumerate(tokens):
+        if token.kind != 'name' or not token.text.startswith('#') or token.text.startswith('##'):
+            continue
+        table = token.text.split('.')[0]
+        if len(table) < 2 or table.lower() in first_use:
+            continue
+        previous = [t.upper for t in tokens[max(i - 2, 0):i]]
+        creates = previous == ['CREATE', 'TABLE'] or (
+            previous[-1:] == ['INTO'] and previous[:-1] not in (['INSERT'], ['MERGE']))
+        first_use[table.lower()] = (table, creates)
+    return [table for table, creates in first_use.values() if not creates]
+
+
+def _last_month():
+    first_of_this_month = date.today().replace(day=1)
+    end = first_of_this_month - timedelta(days=1)
+    return end.replace(day=1), end
+
+
+def _sample_id(conn, name, cache):
+    """@ProjectID 之类的参数：在 Project/Projects 表中取一个存在的ID"""
+    base = re.sub(r'_?ids?$', '', name, flags=re.I)
+    if not base:
+        return None
+    if base.lower() in cache:
+        return cache[base.lower()]
+
+    value = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SAMPLE_ID_SQL, base, base + 's')
+        row = cursor.fetchone()
+        if row:
+            cursor.execute(f"SELECT TOP 1 [ID] FROM dbo.[{row[0]}] WHERE [ID] IS NOT NULL ORDER BY [ID] DESC")
+            sample = cursor.fetchone()
+            value = sample[0] if sample else None
+    except Exception:
+        value = None
+    finally:
+        cursor.close()
+    cache[base.lower()] = value
+    return value
+
+
+def generate_value(conn, parameter, id_cache):
+    """按参数类型和名称生成合理的参数值"""
+    name = parameter['name'].lstrip('@')
+    lowered = name.lower()
+    sql_type = (parameter['type'] or '').lower()
+    month_start, month_end = _last_month()
+
+    if sql_type in ('date', 'datetime', 'datetime2', 'smalldatetime', 'datetimeoffset'):
+        if re.search(r'begin|start|from', lowered):
+            return datetime.combine(month_start, datetime.min.time())
+        if re.search(r'end|to$|finish', lowered):
+            return datetime.combine(month_end, datetime.min.time())
+        return datetime.combine(date.today() - timedelta(days=30), datetime.min.time())
+
+    if sql_type in ('int', 'bigint', 'smallint', 'tinyint'):
+        if re.search(r'skip|offset', lowered):
+            return 0
+        if re.search(r'pageindex|pageno|pagenum', lowered):
+            return 1
+        if re.search(r'count|size|top|rows|limit', lowered):
+            return 100
+        if re.search(r'year', lowered):
+            return month_start.year
+        if re.search(r'month', lowered):
+            return month_start.month
+        if lowered.endswith('id') or lowered.endswith('ids'):
+            return _sample_id(conn, name, id_cache) or 1
+        return 1
+
+    if sql_type == 'bit':
+        return 0
+    if sql_type in ('decimal', 'numeric', 'money', 'smallmoney', 'float', 'real'):
+        return 0
+    if sql_type == 'uniqueidentifier':
+        return '00000000-0000-0000-0000-000000000000'
+
+    if re.search(r'date|time', lowered):
+        return month_start.isoformat()
+    if lowered.endswith('ids'):
+        sample = _sample_id(conn, name, id_cache)
+        return str(sample) if sample is not None else ''
+    if re.search(r'creator|user|operator', lowered):
+        return 'sweep'
+    return ''
+
+
+def build_parameters(conn, procedure, id_cache):
+    """生成整组参数；表值参数无法自动构造，返回 None"""
+    params = {}
+    for parameter in procedure['parameters']:
+        if parameter['is_table_type']:
+            return None
+        params[parameter['name'].lstrip('@')] = generate_value(conn, parameter, id_cache)
+    return params
+
+
+def classify_error(error):
+    """把错误信息归类为常见失败原因"""
+    for category, pattern in ERROR_CATEGORIES:
+        if pattern.search(error or ''):
+            return category
+    return 'other'
+
+
+def _serialize(params):
+    return {k: v.isoformat() if isinstance(v, (date, datetime)) else v for k, v in (params or {}).items()}
+
+
+def sweep_procedures(conn, procedures, rounds=1, time_budget=60, total_budget=None):
+    """
+    逐个执行存储过程
+
+    time_budget: 单轮执行的时间预算(秒)，超时后由看门狗取消执行并继续下一个存储过程
+    total_budget: 整次扫描的时间预算(秒)，用尽后剩余存储过程标记为跳过
+    每轮执行均在事务中进行并回滚，不修改测试数据
+    """
+    id_cache = {}
+    entries = []
+    sweep_start = time.perf_counter()
+
+    for index, procedure in enumerate(procedures, 1):
+        entry = dict(procedure, success=False, error=None, timestamp=datetime.now().isoformat())
+        entries.append(entry)
+
+        if total_budget is not None and time.perf_counter() - sweep_start > total_budget:
+            entry['skipped'] = 'total_budget'
+            continue
+
+        definition = get_sp_definition(conn, procedure['procedure'])
+        entry['definition_length'] = len(definition) if definition else 0
+        missing_temp = external_temp_tables(definition)
+        if missing_temp:
+            entry['skipped'] = 'caller_temp_table'
+            entry['error'] = f"依赖调用方创建的临时表: {', '.join(missing_temp)}"
+            print(f"  [{index}/{len(procedures)}] {procedure['procedure']}: 跳过 ({entry['error']})")
+            continue
+
+        params = build_parameters(conn, procedure, id_cache)
+        if params is None:
+            entry['skipped'] = 'table_valued_parameter'
+            entry['error'] = '包含表值参数，无法自动生成'
+            print(f"  [{index}/{len(procedures)}] {procedure['procedure']}: 跳过 ({entry['error']})")
+            continue
+        entry['generated_parameters'] = _serialize(params)
+
+        results = []
+        for i in range(rounds):
+            result = run_round(conn, procedure['procedure'], params, round_no=i + 1, rollback=True,
+                               timeout_ms=time_budget * 1000)
+            results.append(result)
+            if result.get('timed_out'):
+                break
+        statistics = compute_statistics(results)
+        entry['results'] = results
+        entry['statistics'] = statistics
+
+        if statistics:
+            entry['success'] = True
+            entry['execution_time'] = round(statistics['avg_ms'], 2)
+            entry['cpu_time'] = statistics['cpu_time_ms'] or 0
+            entry['logical_reads'] = statistics['logical_reads'] or 0
+            entry['physical_reads'] = statistics['physical_reads'] or 0
+            tables = rank_tables([r.get('io_time') for r in results])
+            if tables:
+                entry['hottest_table'] = tables[0]['table']
+            print(f"  [{index}/{len(procedures)}] {procedure['procedure']}: {entry['execution_time']:.0f} ms, "
+                  f"逻辑读 {entry['logical_reads']:,.0f}")
+        elif results[-1].get('timed_out'):
+            # 超时的存储过程同样是热点，按超时时的耗时(下界)和已收到的部分统计参与排行
+            partial = results[-1].get('io_time') or {}
+            entry['timed_out'] = True
+            entry['execution_time'] = round(results[-1]['duration_ms'], 2)
+            entry['cpu_time'] = partial.get('cpu_ms', 0)
+            entry['logical_reads'] = partial.get('logical_reads', 0)
+            entry['physical_reads'] = partial.get('physical_reads', 0)
+            if partial.get('tables'):
+                entry['hottest_table'] = partial['tables'][0]['table']
+            entry['error'] = results[-1]['error']
+            entry['error_category'] = 'timeout'
+            print(f"  [{index}/{len(procedures)}] {procedure['procedure']}: {entry['error']}")
+        else:
+            entry['execution_time'] = 0
+            entry['error'] = results[-1].get('error')
+            entry['error_category'] = classify_error(entry['error'])
+            print(f"  [{index}/{len(procedures)}] {procedure['procedure']}: 执行出错 [{entry['error_category']}]")
+
+    return entries
+
+
+def rank_hot_spots(entries, top=10):
+    """按平均耗时排序，耗时相同时按逻辑读排序(超时的存储过程以超时耗时参与排行)"""
+    succeeded = [e for e in entries if e['success'] or e.get('timed_out')]
+    succeeded.sort(key=lambda e: (e['execution_time'], e['logical_reads']), reverse=True)
+    return succeeded[:top]
+
+
+def build_report(database, entries, top=10):
+    """生成与 performance_report.json 相同结构的报告"""
+    failures = {}
+    for entry in entries:
+        if not entry['success'] and not entry.get('skipped'):
+            failures[entry['error_category']] = failures.get(entry['error_category'], 0) + 1
+
+    return {
+        'database': database,
+        'analysis_date': datetime.now().isoformat(),
+        'total_procedures': len(entries),
+        'successful_executions': sum(1 for e in entries if e['success']),
+        'failed_executions': sum(1 for e in entries if not e['success'] and not e.get('skipped')),
+        'skipped_procedures': sum(1 for e in entries if e.get('skipped')),
+        'failure_categories': failures,
+        'procedures': entries,
+        'slowest_procedures': rank_hot_spots(entries, top)
+    }
+
+
+def format_hot_spots(report):
+    """生成Markdown格式的热点排行表"""
+    lines = [
+        f"## 性能排名 - 最慢的{len(report['slowest_procedures'])}个存储过程",
+        '',
+        f"数据库: {report['database']}，扫描时间: {report['analysis_date']}",
+        '',
+        '| 排名 | 存储过程 | 平均耗时(ms) | CPU(ms) | 逻辑读 | 物理读 | 最热的表 |',
+        '|------|----------|-------------:|--------:|-------:|-------:|----------|'
+    ]
+    for rank, entry in enumerate(report['slowest_procedures'], 1):
+        duration = f"≥{entry['execution_time']:,.0f}" if entry.get('timed_out') else f"{entry['execution_time']:,.0f}"
+        lines.append(f"| {rank} | {entry['procedure']} | {duration} | {entry['cpu_time']:,.0f} | "
+                     f"{entry['logical_reads']:,.0f} | {entry['physical_reads']:,.0f} | {entry.get('hottest_table', '-')} |")
+
+    if report['failure_categories']:
+        lines += ['', '### 失败原因分布', '']
+        for category, count in sorted(report['failure_categories'].items(), key=lambda kv: -kv[1]):
+            lines.append(f"- {category}: {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    """主函数"""
+    print("=" * 60)
+    print(f"全库存储过程扫描: {DEFAULT_DATABASE}")
+    print("=" * 60)
+
+    conn = connect(DEFAULT_DATABASE)
+    try:
+        procedures = list_procedures(conn)
+        print(f"[+] 共找到 {len(procedures)} 个存储过程")
+        entries = sweep_procedures(conn, procedures, rounds=1, time_budget=60, total_budget=3600)
+    finally:
+        conn.close()
+
+    report = build_report(DEFAULT_DATABASE, entries)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    output_file = f"performance_report_{timestamp}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    print(f"\n[+] 报告已保存到: {output_file}")
+
+    ranking_file = f"存储过程热点排行_{timestamp}.md"
+    with open(ranking_file, 'w', encoding='utf-8') as f:
+        f.write(format_hot_spots(report))
+    print(f"[+] 热点排行已保存到: {ranking_file}")
+
+    print(f"\n[+] 成功 {report['successful_executions']}, 失败 {report['failed_executions']}, "
+          f"跳过 {report['skipped_procedures']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+SET STATISTICS IO/TIME 输出解析
+在排空 nextset() 的同时收集驱动返回的信息消息，
+解析为按语句、按表的扫描次数、逻辑/物理/预读次数以及CPU和耗时
+"""
+
+import re
+
+# 去掉 "[01000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]" 之类的前缀
+_PREFIX_RE = re.compile(r'^\s*(?:\[[^\]]*\]\s*)+')
+# 去掉结尾的 "(3613)" 消息号
+_SUFFIX_RE = re.compile(r'\s*\(\d+\)\s*(?:\(SQL\w+\))?\s*$')
+
+_TABLE_RE = re.compile(r"Table '([^']+)'\.\s*(.*)", re.S)
+_COUNTER_RE = re.compile(r'([A-Za-z][A-Za-z\- ]*?)\s+(\d+)')
+_TIME_RE = re.compile(r'CPU time = (\d+) ms,\s*elapsed time = (\d+) ms')
+# 临时表在tempdb中的名称带有下划线填充和十六进制后缀
+_TEMP_SUFFIX_RE = re.compile(r'_{3,}[0-9A-Fa-f]{12}$')
+
+IO_COUNTERS = ('scan_count', 'logical_reads', 'physical_reads', 'read_ahead_reads')
+
+
+def collect_messages(cursor):
+    """取出当前结果集上的信息消息文本"""
+    return [message for _, message in getattr(cursor, 'messages', None) or []]
+
+
+def drain_with_messages(cursor, messages=None):
+    """
+    排空所有结果集，返回沿途收集的全部消息
+
+    messages: 传入列表时消息边收集边追加，执行被取消时调用方仍能拿到已收到的部分
+    """
+    if messages is None:
+        messages = []
+    messages.extend(collect_messages(cursor))
+    while True:
+        has_next = cursor.nextset()
+        messages.extend(collect_messages(cursor))
+        if not has_next:
+            break
+    return messages
+
+
+def messages_from_error(error):
+    """从pyodbc异常文本中拆出各条消息，执行失败时仍可解析部分统计"""
+    text = str(error)
+    return [part for part in re.split(r';\s*(?=\[\w{5}\])', text) if part.strip()]
+
+
+def _clean(message):
+    message = _PREFIX_RE.sub('', message)
+    return _SUFFIX_RE.sub('', message).strip()
+
+
+def _parse_counters(text):
+    counters = {}
+    for name, value in _COUNTER_RE.findall(text):
+        key = name.strip().lower().replace('-', '_').replace(' ', '_')
+        counters[key] = int(value)
+    return counters
+
+
+def parse_messages(messages, exec_call=False):
+    """
+    解析统计消息
+
+    exec_call: 本批是否为一次 EXEC 调用(存储过程或 sp_executesql)，
+               只有这时才把末尾的调用合计单独拆出
+
+    返回:
+        {
+            'statements': [{'tables': [...], 'cpu_ms': .., 'elapsed_ms': ..}, ...],
+            'compile_cpu_ms': .., 'compile_elapsed_ms': ..,
+            'call_cpu_ms': .., 'call_elapsed_ms': ..,   EXEC 整个调用的合计(非EXEC时为 None)
+            'cpu_ms': .., 'elapsed_ms': ..,              逐语句合计，不含调用合计
+            'logical_reads': .., 'physical_reads': .., 'read_ahead_reads': .., 'scan_count': ..,
+            'tables': [按逻辑读降序的表汇总]
+        }
+    """
+    statements = []
+    pending_tables = []
+    compile_cpu = compile_elapsed = 0
+
+    for raw in messages:
+        message = _clean(raw)
+
+        table_match = _TABLE_RE.search(message)
+        if table_match:
+            entry = {'table': _TEMP_SUFFIX_RE.sub('', table_match.group(1))}
+            entry.update(_parse_counters(table_match.group(2)))
+            pending_tables.append(entry)
+            continue
+
+        time_match = _TIME_RE.search(message)
+        if not time_match:
+            continue
+
+        cpu_ms, elapsed_ms = int(time_match.group(1)), int(time_match.group(2))
+        if 'parse and compile' in message:
+            compile_cpu += cpu_ms
+            compile_elapsed += elapsed_ms
+        else:
+            statements.append({'tables': pending_tables, 'cpu_ms': cpu_ms, 'elapsed_ms': elapsed_ms})
+            pending_tables = []
+
+    # EXEC 存储过程(含 sp_executesql)时，最后一条执行时间是整个调用的合计，前面没有IO消息；
+    # 它已包含各内部语句的时间，单独报告而不计入逐语句合计
+    call = None
+    if exec_call and len(statements) > 1 and not pending_tables and not statements[-1]['tables'] \
+            and statements[-1]['elapsed_ms'] >= max(s['elapsed_ms'] for s in statements[:-1]):
+        call = statements.pop()
+
+    # 没有对应执行时间的IO消息(例如只开启了STATISTICS IO)单独成一条
+    if pending_tables:
+        statements.append({'tables': pending_tables, 'cpu_ms': None, 'elapsed_ms': None})
+
+    summary = {
+        'statements': statements,
+        'compile_cpu_ms': compile_cpu,
+        'compile_elapsed_ms': compile_elapsed,
+        'call_cpu_ms': call['cpu_ms'] if call else None,
+        'call_elapsed_ms': call['elapsed_ms'] if call else None,
+        'cpu_ms': sum(s['cpu_ms'] or 0 for s in statements),
+        'elapsed_ms': sum(s['elapsed_ms'] or 0 for s in statements),
+        'tables': rank_tables([{'statements': statements}])
+    }
+    for counter in IO_COUNTERS:
+        summary[counter] = sum(t.get(counter, 0) for s in statements for t in s['tables'])
+    return summary
+
+
+def rank_tables(parsed_list):
+    """汇总多轮(或多条语句)的解析结果，按逻辑读降序排列各表IO"""
+    totals = {}
+    for parsed in parsed_list:
+        if not parsed:
+            continue
+        for statement in parsed['statements']:
+            for entry in statement['tables']:
+                total = totals.setdefault(entry['table'], {'table': entry['table'], **{c: 0 for c in IO_COUNTERS}})
+                for counter in IO_COUNTERS:
+                    total[counter] += entry.get(counter, 0)
+
+    return sorted(totals.values(), key=lambda t: t['logical_reads'], reverse=True)
+
+
+def print_table_ranking(tables, top=10):
+    """打印按逻辑读排序的表IO排行"""
+    if not tables:
+        print("  (无IO统计)")
+        return
+
+    print(f"  {'表名':<40} {'扫描次数':>10} {'逻辑读':>12} {'物理读':>10} {'预读':>10}")
+    for entry in tables[:top]:
+        print(f"  {entry['table']:<40} {entry['scan_count']:>10,} {entry['logical_reads']:>12,} "
+              f"{entry['physical_reads']:>10,} {entry['read_ahead_reads']:>10,}")
@@ -0,0 +1,642 @@
+# -*- coding: utf-8 -*-
+"""
+基于表结构的合成数据生成器
+从共享测试库读取表定义、主键/唯一键和外键，在本地基准库中重建表结构，
+按种子生成引用一致的数据(可配置行数、列基数、热点项目、月末高峰和NULL比例)，
+分批并行批量插入，使任意规模的基准库都能在几分钟内从同一种子重建
+"""
+
+import json
+import random
+import string
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from db_connection import connect
+
+BATCH_SIZE = 5000
+DEFAULT_WORKERS = 4
+DEFAULT_SEED = 20251101
+# 引用了计划外的表时自动补充的父表行数
+DEFAULT_PARENT_ROWS = 1000
+DEFAULT_DATE_RANGE = ('2024-01-01', '2025-12-31')
+# 未配置时 bit 列取 1 的比例(isDeleted/ifSplited 这类标记大多为 0)
+DEFAULT_FLAG_RATE = 0.02
+TARGET_SUFFIX = '-bench'
+
+# 各库默认生成计划
+#   rows:            行数
+#   references:      表结构中未声明外键的逻辑引用 {列: 父表 或 (父表, 父列)}
+#   hot:             热点 {列: (父行占比, 引用占比)}，如 5% 的项目占 60% 的明细
+#   null_rate:       可空列默认的 NULL 比例；null_rates 按列覆盖
+#   cardinality:     列的不同取值个数
+#   values:          列的取值及权重 {列: ([取值...], [权重...])}
+#   date_range:      日期列范围；month_end_share 为落在每月最后 month_end_days 天的比例
+DEFAULT_PLANS = {
+    'Statistics-CT-test': {
+        'Stations': {'rows': 200, 'null_rate': 0.05},
+        'ProductionDailyReports': {
+            'rows': 20000, 'references': {'StationID': 'Stations'},
+            'month_end_share': 0.25, 'null_rate': 0.02
+        },
+        'ProductionDailyReportDetails': {
+            'rows': 500000,
+            'references': {'DailyReportID': 'ProductionDailyReports', 'StationID': 'Stations'},
+            'hot': {'ProjectID': (0.05, 0.6)}, 'cardinality': {'ProjectID': 2000, 'StrengthGrade': 12},
+            'null_rates': {'StrengthGrade': 0.1}, 'month_end_share': 0.3, 'null_rate': 0.05
+        }
+    },
+    'logistics-test': {
+        'Project': {'rows': 2000, 'null_rate': 0.05},
+        'WbMaterialIns': {
+            'rows': 300000, 'references': {'ProjectID': 'Project'},
+            'hot': {'ProjectID': (0.05, 0.6)}, 'month_end_share': 0.3, 'null_rate': 0.05
+        }
+    },
+    'Weighbridge-test': {
+        'Shipping': {
+            'rows': 100000, 'references': {'DeliveringID': 'Delivering'},
+            'month_end_share': 0.3, 'null_rate': 0.05
+        },
+        'Delivering': {
+            'rows': 300000, 'cardinality': {'grade': 12, 'Item': 20, 'Specification': 30, 'Vehicle': 500},
+            'month_end_share': 0.3, 'null_rate': 0.05
+        }
+    }
+}
+
+COLUMNS_SQL = """
+SELECT t.name AS table_name, c.column_id, c.name AS column_name, TYPE_NAME(c.system_type_id) AS type_name,
+       c.max_length, c.precision, c.scale, c.is_nullable, c.is_identity, c.is_computed
+FROM sys.tables t
+INNER JOIN sys.columns c ON c.object_id = t.object_id
+WHERE t.schema_id = SCHEMA_ID('dbo') AND t.name IN ({placeholders})
+ORDER BY t.name, c.column_id
+"""
+
+KEYS_SQL = """
+SELECT t.name AS table_name, i.name AS index_name, i.is_primary_key, i.type_desc, i.filter_definition,
+       c.name AS column_name, ic.key_ordinal
+FROM sys.indexes i
+INNER JOIN sys.tables t ON t.object_id = i.object_id
+INNER JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id AND ic.key_ordinal > 0
+INNER JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+WHERE (i.is_primary_key = 1 OR i.is_unique = 1) AND t.schema_id = SCHEMA_ID('dbo') AND t.name IN ({placeholders})
+ORDER BY t.name, i.index_id, ic.key_ordinal
+"""
+
+FOREIGN_KEYS_SQL = """
+SELECT fk.name AS fk_name, tp.name AS table_name, cp.name AS column_name,
+       tr.name AS referenced_table, cr.name AS referenced_column
+FROM sys.foreign_keys fk
+INNER JOIN sys.foreign_key_columns fkc ON fkc.constraint_object_id = fk.object_id
+INNER JOIN sys.tables tp ON tp.object_id = fkc.parent_object_id
+INNER JOIN sys.columns cp ON cp.object_id = fkc.parent_object_id AND cp.column_id = fkc.parent_column_id
+INNER JOIN sys.tables tr ON tr.object_id = fkc.referenced_object_id
+INNER JOIN sys.columns cr ON cr.object_id = fkc.referenced_object_id AND cr.column_id = fkc.referenced_column_id
+WHERE tp.schema_id = SCHEMA_ID('dbo') AND tp.name IN ({placeholders})
+"""
+
+_INT_RANGES = {'tinyint': 255, 'smallint': 32767, 'int': 2147483647, 'bigint': 9223372036854775807}
+_STRING_TYPES = {'char', 'varchar', 'nchar', 'nvarchar', 'text', 'ntext'}
+_DATETIME_TYPES = {'datetime', 'datetime2', 'smalldatetime', 'datetimeoffset'}
+_SKIPPED_TYPES = {'timestamp', 'rowversion'}
+_ALPHABET = string.ascii_uppercase + string.digits
+
+
+def _rows_as_dicts(cursor):
+    columns = [c[0] for c in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _query(conn, sql, tables):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql.format(placeholders=', '.join('?' * len(tables))), *tables)
+        return _rows_as_dicts(cursor)
+    finally:
+        cursor.close()
+
+
+def read_schema(conn, tables):
+    """
+    读取表结构
+
+    返回 {表: {'columns': [...], 'primary_key': [...], 'unique': [{'name', 'columns', 'filter'}],
+              'foreign_keys': [...], 'clustered_pk': bool}}
+    """
+    tables = list(tables)
+    schema = {}
+    for column in _query(conn, COLUMNS_SQL, tables):
+        schema.setdefault(column['table_name'], {'columns': [], 'primary_key': [], 'unique': [],
+                                                 'foreign_keys': [], 'clustered_pk': False})
+        schema[column['table_name']]['columns'].append(column)
+
+    keys = {}
+    for row in _query(conn, KEYS_SQL, tables):
+        keys.setdefault((row['table_name'], row['index_name']), []).append(row)
+    for (table, name), rows in keys.items():
+        columns = [row['column_name'] for row in rows]
+        if rows[0]['is_primary_key']:
+            schema[table]['primary_key'] = columns
+            schema[table]['clustered_pk'] = rows[0]['type_desc'] == 'CLUSTERED'
+        else:
+            schema[table]['unique'].append({'name': name, 'columns': columns,
+                                            'filter': rows[0]['filter_definition']})
+
+    constraints = {}
+    for row in _query(conn, FOREIGN_KEYS_SQL, tables):
+        constraints.setdefault((row['table_name'], row['fk_name']), []).append(row)
+    for (table, name), rows in constraints.items():
+        # 只处理单列外键；多列外键不建约束，生成时按普通列处理
+        if len(rows) == 1:
+            schema[table]['foreign_keys'].append({'name': name, 'column': rows[0]['column_name'],
+                                                  'referenced_table': rows[0]['referenced_table'],
+                                                  'referenced_column': rows[0]['referenced_column']})
+    return schema
+
+
+def resolve_plan(conn, plan):
+    """读取计划内各表结构，并把外键引用到的计划外父表按默认行数补进计划，直到闭合"""
+    plan = {table: dict(config) for table, config in plan.items()}
+    schema = {}
+    pending = list(plan)
+    while pending:
+        found = read_schema(conn, pending)
+        missing = [table for table in pending if table not in found]
+        if missing:
+            raise ValueError(f"源库中不存在这些表: {', '.join(missing)}")
+        schema.update(found)
+        pending = []
+        for table in found.values():
+            for fk in table['foreign_keys']:
+                if fk['referenced_table'] not in plan:
+                    plan[fk['referenced_table']] = {'rows': DEFAULT_PARENT_ROWS}
+                    pending.append(fk['referenced_table'])
+    return plan, schema
+
+
+def references_of(table, config, schema):
+    """合并声明的外键与计划中的逻辑引用，返回 {列: (父表, 父列)}"""
+    references = {fk['column']: (fk['referenced_table'], fk['referenced_column'])
+                  for fk in schema[table]['foreign_keys']}
+    names = {c['column_name'] for c in schema[table]['columns']}
+    for column, target in (config.get('references') or {}).items():
+        if column not in names:
+            continue
+        if isinstance(target, str):
+            primary_key = schema[target]['primary_key']
+            if len(primary_key) != 1:
+                raise ValueError(f"{column} 引用的 {target} 没有单列主键，请以 (父表, 父列) 指定")
+            target = (target, primary_key[0])
+        references[column] = tuple(target)
+    return references
+
+
+def _date_span(config):
+    begin, end = (date.fromisoformat(d) for d in config.get('date_range', DEFAULT_DATE_RANGE))
+    return begin, (end - begin).days + 1
+
+
+def key_layout(table, config, schema, plan):
+    """
+    为主键和每个唯一键确定由行号推导的列，保证整组键唯一
+
+    返回 (layout, skipped)：layout 为 {列: (除数, 基数)}，列取值序号 = 行号 // 除数 % 基数(基数为 None 时不取模)；
+    键内有可取任意多值的列(整数/字符串/GUID)时由该列单独承担行号；
+    否则按引用列的父表行数、日期列的天数做混合进制分解，如 (StationID, ReportDate) 按站点 × 日期展开。
+    组合数不足行数的唯一键无法保证唯一，列入 skipped 不建约束；主键无法保证时直接报错
+    """
+    table_schema = schema[table]
+    references = references_of(table, config, schema)
+    types = {c['column_name']: c['type_name'] for c in table_schema['columns']}
+    rows = plan[table]['rows']
+    keys = [{'name': f"PK_{table}", 'columns': table_schema['primary_key'], 'primary': True}] \
+        if table_schema['primary_key'] else []
+    keys += table_schema['unique']
+
+    layout, satisfied, skipped = {}, [], []
+    for key in keys:
+        columns = key['columns']
+        if any(set(done) <= set(columns) for done in satisfied):
+            continue
+        unbounded = [c for c in columns if c not in references and c not in layout
+                     and (types[c] in ('int', 'bigint', 'decimal', 'numeric', 'uniqueidentifier')
+                          or types[c] in _STRING_TYPES)]
+        if unbounded:
+            layout[unbounded[0]] = (1, None)
+            satisfied.append([unbounded[0]])
+            continue
+
+        cardinalities = {}
+        for column in columns:
+            if column in references:
+                cardinalities[column] = plan[references[column][0]]['rows']
+            elif types[column] == 'date' or types[column] in _DATETIME_TYPES:
+                cardinalities[column] = _date_span(config)[1]
+            elif types[column] in _INT_RANGES:
+                cardinalities[column] = _INT_RANGES[types[column]]
+        combinations = 1
+        for cardinality in cardinalities.values():
+            combinations *= cardinality
+        if len(cardinalities) != len(columns) or combinations < rows or any(c in layout for c in columns):
+            if key.get('primary'):
+                raise ValueError(f"{table} 的主键 ({', '.join(columns)}) 无法保证 {rows:,} 行唯一，"
+                                 f"请增大父表行数或日期范围")
+            skipped.append(key['name'])
+            continue
+        divisor = 1
+        for column in columns:
+            layout[column] = (divisor, cardinalities[column])
+            divisor *= cardinalities[column]
+        satisfied.append(columns)
+    return layout, skipped
+
+
+def key_value(table, column, type_name, index):
+    """第 index 行(从0开始)键列的确定值，子表据此在不回读父表的情况下生成引用"""
+    if type_name in _INT_RANGES or type_name in ('decimal', 'numeric'):
+        return index + 1
+    if type_name == 'uniqueidentifier':
+        return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{table}.{column}:{index}"))
+    if type_name in _STRING_TYPES:
+        return f"{table[:4].upper()}{index + 1:08d}"
+    if type_name in ('date', *_DATETIME_TYPES):
+        return datetime(2000, 1, 1) + timedelta(seconds=index)
+    raise ValueError(f"{table}.{column} 的类型 {type_name} 不支持作为键列")
+
+
+def pick_index(rng, count, hot=None):
+    """按热点配置选取父表行号：hot=(0.05, 0.6) 表示前 5% 的父行承担 60% 的引用"""
+    if hot:
+        fraction, share = hot
+        hot_count = max(1, int(count * fraction))
+        if rng.random() < share:
+            return rng.randrange(hot_count)
+    return rng.randrange(count)
+
+
+def random_date(rng, begin, end, month_end_share=0.0, month_end_days=3):
+    """范围内随机日期；按 month_end_share 的概率落在某月最后几天，模拟月末高峰"""
+    span = (end - begin).days
+    day = begin + timedelta(days=rng.randint(0, span))
+    if month_end_share and rng.random() < month_end_share:
+        next_month = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+        day = next_month - timedelta(days=rng.randint(1, month_end_days))
+        if day > end:
+            day = end
+    return day
+
+
+def _string_length(column):
+    if column['max_length'] == -1:
+        return 50
+    return column['max_length'] // 2 if column['type_name'] in ('nchar', 'nvarchar') else column['max_length']
+
+
+def random_value(rng, column, config):
+    """按列类型生成随机值，列基数由 cardinality 控制"""
+    name, type_name = column['column_name'], column['type_name']
+    cardinality = (config.get('cardinality') or {}).get(name)
+
+    if type_name == 'bit':
+        return 1 if rng.random() < config.get('flag_rate', DEFAULT_FLAG_RATE) else 0
+    if type_name in _INT_RANGES:
+        upper = min(_INT_RANGES[type_name], 100000)
+        return rng.randrange(cardinality) + 1 if cardinality else rng.randint(0, upper)
+    if type_name in ('decimal', 'numeric', 'money', 'smallmoney', 'float', 'real'):
+        scale = column['scale'] if type_name in ('decimal', 'numeric') else 2
+        digits = column['precision'] - column['scale'] if type_name in ('decimal', 'numeric') else 6
+        value = round(rng.uniform(0, min(10 ** digits - 1, 100000)), scale)
+        return Decimal(str(value)) if type_name in ('decimal', 'numeric', 'money', 'smallmoney') else value
+    if type_name in _STRING_TYPES:
+        length = _string_length(column)
+        if cardinality:
+            return f"{name}_{rng.randrange(cardinality)}"[:length]
+        return ''.join(rng.choices(_ALPHABET, k=rng.randint(1, min(length, 20))))
+    if type_name == 'uniqueidentifier':
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    if type_name == 'date' or type_name in _DATETIME_TYPES:
+        begin, end = (date.fromisoformat(d) for d in config.get('date_range', DEFAULT_DATE_RANGE))
+        day = random_date(rng, begin, end, config.get('month_end_share', 0.0), config.get('month_end_days', 3))
+        if type_name == 'date':
+            return day
+        return datetime.combine(day, datetime.min.time()) + timedelta(seconds=rng.randrange(86400))
+    if type_name in ('varbinary', 'binary', 'image'):
+        return bytes(rng.getrandbits(8) for _ in range(min(_string_length(column), 16)))
+    if column['is_nullable']:
+        return None
+    raise ValueError(f"{name} 的类型 {type_name} 不支持生成且不可为空")
+
+
+def insert_columns(table_schema):
+    return [c for c in table_schema['columns'] if not c['is_computed'] and c['type_name'] not in _SKIPPED_TYPES]
+
+
+def generate_rows(table, config, schema, plan, seed, start, count):
+    """
+    生成第 [start, start+count) 行
+
+    每批使用独立的随机源(种子 + 表名 + 起始行)，与批次执行顺序和并行度无关，同一种子总能重建相同数据
+    """
+    rng = random.Random(f"{seed}:{table}:{start}")
+    table_schema = schema[table]
+    layout, _ = key_layout(table, config, schema, plan)
+    references = references_of(table, config, schema)
+    date_begin, _ = _date_span(config)
+    hot = config.get('hot') or {}
+    values = config.get('values') or {}
+    null_rates = config.get('null_rates') or {}
+    default_null_rate = config.get('null_rate', 0.0)
+    parent_types = {table_name: {c['column_name']: c['type_name'] for c in schema[table_name]['columns']}
+                    for table_name, _ in references.values()}
+
+    columns = insert_columns(table_schema)
+    rows = []
+    for index in range(start, start + count):
+        row = []
+        for column in columns:
+            name = column['column_name']
+            null_rate = null_rates.get(name, 0.0 if name in references else default_null_rate)
+            if name in layout:
+                divisor, cardinality = layout[name]
+                ordinal = index // divisor % cardinality if cardinality else index // divisor
+                if name in references:
+                    parent, parent_column = references[name]
+                    value = key_value(parent, parent_column, parent_types[parent][parent_column], ordinal)
+                elif column['type_name'] == 'date' or column['type_name'] in _DATETIME_TYPES:
+                    day = date_begin + timedelta(days=ordinal)
+                    value = day if column['type_name'] == 'date' else datetime.combine(day, datetime.min.time())
+                elif column['type_name'] in _INT_RANGES and cardinality:
+                    value = ordinal
+                else:
+                    value = key_value(table, name, column['type_name'], ordinal)
+            elif column['is_nullable'] and null_rate and rng.random() < null_rate:
+                value = None
+            elif name in references:
+                parent, parent_column = references[name]
+                parent_index = pick_index(rng, plan[parent]['rows'], hot.get(name))
+                value = key_value(parent, parent_column, parent_types[parent][parent_column], parent_index)
+            elif name in values:
+                choices, weights = values[name]
+                value = rng.choices(choices, weights=weights)[0]
+            elif name in hot and (config.get('cardinality') or {}).get(name):
+                value = pick_index(rng, config['cardinality'][name], hot[name]) + 1
+            else:
+                value = random_value(rng, column, config)
+            row.append(value)
+        rows.append(row)
+    return rows
+
+
+def format_type(column):
+    type_name = column['type_name']
+    if type_name in ('varchar', 'char', 'varbinary', 'binary'):
+        return f"{type_name}({'MAX' if column['max_length'] == -1 else column['max_length']})"
+    if type_name in ('nvarchar', 'nchar'):
+        return f"{type_name}({'MAX' if column['max_length'] == -1 else column['max_length'] // 2})"
+    if type_name in ('decimal', 'numeric'):
+        return f"{type_name}({column['precision']}, {column['scale']})"
+    if type_name in ('datetime2', 'time', 'datetimeoffset'):
+        return f"{type_name}({column['scale']})"
+    return type_name
+
+
+def create_table_sql(table, table_schema):
+    """按源表定义生成建表语句(列、标识列、主键)；唯一键见 unique_index_sql，外键在装载完成后再加"""
+    lines = []
+    for column in table_schema['columns']:
+        if column['is_computed'] or column['type_name'] in _SKIPPED_TYPES:
+            continue
+        identity = ' IDENTITY(1,1)' if column['is_identity'] else ''
+        nullable = 'NULL' if column['is_nullable'] else 'NOT NULL'
+        lines.append(f"    [{column['column_name']}] {format_type(column)}{identity} {nullable}")
+    if table_schema['primary_key']:
+        kind = 'CLUSTERED' if table_schema['clustered_pk'] else 'NONCLUSTERED'
+        columns = ', '.join(f"[{c}]" for c in table_schema['primary_key'])
+        lines.append(f"    CONSTRAINT [PK_{table}] PRIMARY KEY {kind} ({columns})")
+    return f"CREATE TABLE [dbo].[{table}] (\n" + ',\n'.join(lines) + "\n)"
+
+
+def unique_index_sql(table, table_schema, skipped=()):
+    """按源库重建唯一索引(保留筛选条件)；无法保证唯一的键跳过"""
+    statements = []
+    for unique in table_schema['unique']:
+        if unique['name'] in skipped:
+            continue
+        columns = ', '.join(f"[{c}]" for c in unique['columns'])
+        where = f" WHERE {unique['filter']}" if unique['filter'] else ''
+        statements.append(f"CREATE UNIQUE NONCLUSTERED INDEX [{unique['name']}] ON [dbo].[{table}] ({columns}){where}")
+    return statements
+
+
+def ensure_database(database):
+    """目标库不存在时创建，并设为简单恢复模式以减少批量装载的日志开销"""
+    conn = connect('master', autocommit=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"IF DB_ID(N'{database}') IS NULL CREATE DATABASE [{database}]")
+        cursor.execute(f"ALTER DATABASE [{database}] SET RECOVERY SIMPLE")
+        cursor.close()
+    finally:
+        conn.close()
+
+
+def create_schema(conn, plan, schema):
+    """先删除子表再删除父表，随后重建计划内所有表"""
+    cursor = conn.cursor()
+    try:
+        for table in plan:
+            cursor.execute(
+                "DECLARE @drop NVARCHAR(MAX) = N''; "
+                "SELECT @drop += N'ALTER TABLE ' + QUOTENAME(OBJECT_NAME(parent_object_id)) "
+                "+ N' DROP CONSTRAINT ' + QUOTENAME(name) + N';' "
+                "FROM sys.foreign_keys WHERE referenced_object_id = OBJECT_ID(?); "
+                "EXEC sp_executesql @drop;", f"dbo.{table}")
+        for table, config in plan.items():
+            _, skipped = key_layout(table, config, schema, plan)
+            for name in skipped:
+                print(f"  [!] {table}.{name}: 组合数不足以保证唯一，不建该唯一索引")
+            cursor.execute(f"IF OBJECT_ID(N'dbo.{table}', 'U') IS NOT NULL DROP TABLE [dbo].[{table}]")
+            cursor.execute(create_table_sql(table, schema[table]))
+            for statement in unique_index_sql(table, schema[table], skipped):
+                cursor.execute(statement)
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+class _WorkerConnections:
+    """每个装载线程独占一条连接"""
+
+    def __init__(self, database):
+        self.database = database
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = connect(self.database, timeout=30)
+            with self._lock:
+                self._all.append(conn)
+        return conn
+
+    def close_all(self):
+        for conn in self._all:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def load_batch(connections, table, config, schema, plan, seed, start, count):
+    """生成一批数据并用 fast_executemany 插入；带标识列的表显式写入键值"""
+    rows = generate_rows(table, config, schema, plan, seed, start, count)
+    columns = insert_columns(schema[table])
+    column_list = ', '.join(f"[{c['column_name']}]" for c in columns)
+    sql = f"INSERT INTO [dbo].[{table}] ({column_list}) VALUES ({', '.join('?' * len(columns))})"
+    identity = any(c['is_identity'] for c in columns)
+
+    conn = connections.get()
+    cursor = conn.cursor()
+    try:
+        if identity:
+            cursor.execute(f"SET IDENTITY_INSERT [dbo].[{table}] ON")
+        cursor.fast_executemany = True
+        cursor.executemany(sql, rows)
+        if identity:
+            cursor.execute(f"SET IDENTITY_INSERT [dbo].[{table}] OFF")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        if identity:
+            cursor.execute(f"SET IDENTITY_INSERT [dbo].[{table}] OFF")
+        raise
+    finally:
+        cursor.close()
+    return len(rows)
+
+
+def load_tables(database, plan, schema, seed=DEFAULT_SEED, workers=DEFAULT_WORKERS, batch_size=BATCH_SIZE):
+    """把所有表切成批次并行装载(外键尚未建立，批次之间没有先后依赖)"""
+    connections = _WorkerConnections(database)
+    loaded = {table: 0 for table in plan}
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='load-worker') as executor:
+            futures = {}
+            for table, config in plan.items():
+                for start in range(0, config['rows'], batch_size):
+                    count = min(batch_size, config['rows'] - start)
+                    future = executor.submit(load_batch, connections, table, config, schema, plan, seed,
+                                             start, count)
+                    futures[future] = table
+            for future in as_completed(futures):
+                table = futures[future]
+                loaded[table] += future.result()
+                if loaded[table] == plan[table]['rows']:
+                    print(f"  [+] {table}: {loaded[table]:,} 行")
+    finally:
+        connections.close_all()
+    return loaded, round(time.perf_counter() - started, 1)
+
+
+def add_foreign_keys(conn, plan, schema):
+    """装载后建立源库声明的外键(WITH CHECK 校验全部已有数据)并更新统计信息"""
+    cursor = conn.cursor()
+    try:
+        for table in plan:
+            for fk in schema[table]['foreign_keys']:
+                cursor.execute(
+                    f"ALTER TABLE [dbo].[{table}] WITH CHECK ADD CONSTRAINT [{fk['name']}] "
+                    f"FOREIGN KEY ([{fk['column']}]) "
+                    f"REFERENCES [dbo].[{fk['referenced_table']}] ([{fk['referenced_column']}])")
+            cursor.execute(f"UPDATE STATISTICS [dbo].[{table}] WITH FULLSCAN")
+        conn.commit()
+    finally:
+        cursor.close()
+
+
+def count_orphans(conn, plan, schema):
+    """统计逻辑引用(未建外键约束)的孤儿行数，确认生成的数据引用一致"""
+    orphans = {}
+    cursor = conn.cursor()
+    try:
+        for table, config in plan.items():
+            declared = {fk['column'] for fk in schema[table]['foreign_keys']}
+            for column, (parent, parent_column) in references_of(table, config, schema).items():
+                if column in declared:
+                    continue
+                cursor.execute(
+                    f"SELECT COUNT_BIG(*) FROM [dbo].[{table}] c WHERE c.[{column}] IS NOT NULL "
+                    f"AND NOT EXISTS (SELECT 1 FROM [dbo].[{parent}] p WHERE p.[{parent_column}] = c.[{column}])")
+                orphans[f"{table}.{column}"] = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    return orphans
+
+
+def build_database(source_database, plan, target_database=None, seed=DEFAULT_SEED, workers=DEFAULT_WORKERS,
+                   batch_size=BATCH_SIZE, scale=1.0):
+    """
+    从源库读取结构，在目标库中重建并装载合成数据
+
+    scale: 按比例放大/缩小计划中的行数，父表行数同比变化以保持引用比例
+    """
+    target_database = target_database or f"{source_database}{TARGET_SUFFIX}"
+    print(f"[*] 读取 {source_database} 表结构...")
+    source = connect(source_database)
+    try:
+        plan, schema = resolve_plan(source, plan)
+    finally:
+        source.close()
+    for config in plan.values():
+        config['rows'] = max(1, int(config['rows'] * scale))
+
+    print(f"[*] 重建目标库 {target_database} ({len(plan)} 张表)...")
+    ensure_database(target_database)
+    conn = connect(target_database)
+    try:
+        create_schema(conn, plan, schema)
+        print(f"[*] 并行装载 (种子 {seed}, {workers} 线程, 每批 {batch_size:,} 行)...")
+        loaded, load_seconds = load_tables(target_database, plan, schema, seed, workers, batch_size)
+        print("[*] 建立外键并更新统计信息...")
+        add_foreign_keys(conn, plan, schema)
+        orphans = count_orphans(conn, plan, schema)
+    finally:
+        conn.close()
+
+    for reference, count in orphans.items():
+        print(f"  [{'+' if count == 0 else '-'}] {reference}: 孤儿行 {count:,}")
+    print(f"[+] {target_database} 装载完成: {sum(loaded.values()):,} 行, 耗时 {load_seconds:.1f} 秒")
+    return {'source_database': source_database, 'target_database': target_database, 'seed': seed,
+            'scale': scale, 'plan': plan, 'loaded': loaded, 'load_seconds': load_seconds, 'orphans': orphans}
+
+
+def main():
+    print("=" * 60)
+    print("合成基准数据生成")
+    print("=" * 60)
+
+    manifests = []
+    for database, plan in DEFAULT_PLANS.items():
+        try:
+            manifests.append(build_database(database, plan, seed=DEFAULT_SEED))
+        except Exception as e:
+            print(f"[-] {database} 生成失败: {e}")
+
+    output_file = f"synthetic_manifest_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump({'test_date': datetime.now().isoformat(), 'databases': manifests},
+                  f, ensure_ascii=False, indent=2, default=str)
+    print(f"\n[+] 生成清单已保存: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
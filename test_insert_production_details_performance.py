@@ -1,49 +1,63 @@
-import pyodbc
 import sys
 import os
 import time
 from datetime import datetime, timedelta
 
+from db_connection import connect
+from insert_write_benchmark import DEFAULT_BATCH_SIZES, sweep_write_strategies
+from param_binding import bind_statement, get_plan_usecount, substitute_literals
+from row_drain import DEFAULT_ARRAYSIZE, drain_executed, wrap_server_count
+from statistics_parser import drain_with_messages, messages_from_error, parse_messages, print_table_ranking
+
 # 设置Windows控制台UTF-8编码
 if sys.platform == 'win32':
     os.system('chcp 65001 > nul')
     sys.stdout.reconfigure(encoding='utf-8')
 
 DB_CONFIG = {
-    'server': '127.0.0.1,5433',
-    'database': 'Statistics-CT-test',
-    'username': 'sa',
-    'password': '123456',
-    'driver': None
+    'database': 'Statistics-CT-test'
+}
+
+# 与存储过程中一致的参数类型，用于 sp_executesql 绑定执行
+PARAM_TYPES = {
+    'Creator': 'NVARCHAR(50)',
+    'TenantID': 'INT',
+    'ReportDate': 'DATE',
+    'DefaultDepartment': 'NVARCHAR(50)',
+    'DefaultPaymentType': 'NVARCHAR(50)',
+    'DefaultProductCategory': 'NVARCHAR(50)',
+    'DefaultUnit': 'NVARCHAR(10)',
+    'DefaultGHSJUnit': 'NVARCHAR(10)',
+    'ProCoeff': 'DECIMAL(18, 4)',
+    'DefaultFinancialTime': 'INT'
 }
 
+# 查询的参数绑定方式，见 param_binding.BINDING_MODES
+QUERY_BINDING = 'sp_executesql'
+
+# 写入测试：执行真实INSERT(事务内，始终回滚)，按批大小扫描，见 insert_write_benchmark
+WRITE_BENCHMARK = False
+WRITE_BATCH_SIZES = DEFAULT_BATCH_SIZES
+
 def connect_to_database(config):
     """连接到数据库"""
-    if not config['driver']:
-        all_drivers = pyodbc.drivers()
-        for driver in ['ODBC Driver 18 for SQL Server', 'ODBC Driver 17 for SQL Server', 'SQL Server']:
-            if driver in all_drivers:
-                config['driver'] = driver
-                break
-
     try:
-        connection_string = (
-            f"DRIVER={{{config['driver']}}};"
-            f"SERVER={config['server']};"
-            f"DATABASE={config['database']};"
-            f"UID={config['username']};"
-            f"PWD={config['password']};"
-            f"TrustServerCertificate=yes;"
-        )
-        conn = pyodbc.connect(connection_string)
+        conn = connect(config['database'])
         print(f"✓ 成功连接到数据库: {config['database']}\n")
         return conn
     except Exception as e:
         print(f"✗ 数据库连接失败: {str(e)}")
         return None
 
-def test_query_performance(conn, sql, description, params):
-    """测试查询性能（不实际INSERT）"""
+def test_query_performance(conn, sql, description, params, drain_strategy='fetchmany', arraysize=DEFAULT_ARRAYSIZE,
+                           binding='literal', param_types=None):
+    """
+    测试查询性能（不实际INSERT）
+
+    drain_strategy: 见 row_drain.DRAIN_STRATEGIES
+    binding: 'literal' 参数替换为字面量；'sp_executesql' 以强类型参数绑定执行，与存储过程内的计划复用方式一致
+    param_types: binding='sp_executesql' 时各参数的SQL类型，未指定的按值推断
+    """
     print(f"\n{'='*80}")
     print(f"{description}")
     print(f"{'='*80}")
@@ -51,15 +65,16 @@ def test_query_performance(conn, sql, description, params):
     cursor = conn.cursor()
 
     try:
-        # 替换参数
-        sql_formatted = sql
-        for key, value in params.items():
-            if isinstance(value, datetime):
-                sql_formatted = sql_formatted.replace(f"@{key}", f"'{value.strftime('%Y-%m-%d')}'")
-            elif isinstance(value, (int, float)):
-                sql_formatted = sql_formatted.replace(f"@{key}", str(value))
-            else:
-                sql_formatted = sql_formatted.replace(f"@{key}", f"'{value}'")
+        statement = wrap_server_count(sql) if drain_strategy == 'server_count' else sql
+        if binding == 'sp_executesql':
+            exec_sql, args, cached_text = bind_statement(statement, params, param_types)
+        else:
+            # 替换参数
+            exec_sql, args = substitute_literals(statement, params), []
+            cached_text = exec_sql
+
+        # 执行前的计划缓存使用次数，用于判断本轮是否复用了已缓存的计划
+        usecount_before = get_plan_usecount(conn, cached_text)
 
         # 启用统计信息
         cursor.execute("SET STATISTICS TIME ON")
@@ -68,13 +83,15 @@ def test_query_performance(conn, sql, description, params):
         # 开始计时
         start_time = time.time()
 
-        # 执行查询
-        cursor.execute(sql_formatted)
+        # 执行查询并按策略排空结果，剔除客户端逐行取数的开销
+        messages = []
+        cursor.execute(exec_sql, *args)
+        drained = drain_executed(cursor, drain_strategy, arraysize=arraysize, messages=messages)
+        row_count = drained['row_count']
 
-        # 获取结果行数（不获取实际数据）
-        row_count = 0
-        while cursor.fetchone():
-            row_count += 1
+        # 排空剩余结果集并收集STATISTICS消息
+        messages.extend(drain_with_messages(cursor))
+        statistics = parse_messages(messages, exec_call=(binding == 'sp_executesql'))
 
         # 结束计时
         end_time = time.time()
@@ -84,14 +101,29 @@ def test_query_performance(conn, sql, description, params):
         cursor.execute("SET STATISTICS TIME OFF")
         cursor.execute("SET STATISTICS IO OFF")
 
+        usecount_after = get_plan_usecount(conn, cached_text)
+        plan_cache_hit = usecount_before is not None and (usecount_after or 0) > usecount_before
+
         print(f"✓ 查询成功")
         print(f"  执行时间: {elapsed:.3f} 秒")
-        print(f"  返回行数: {row_count:,}")
+        print(f"  返回行数: {row_count:,} (排空策略: {drained['strategy']})")
+        print(f"  编译耗时: {statistics['compile_elapsed_ms']:,} ms, 执行耗时: {statistics['elapsed_ms']:,} ms "
+              f"(绑定方式: {binding}, 计划缓存{'命中' if plan_cache_hit else '未命中'})")
+        print(f"  CPU时间: {statistics['cpu_ms']:,} ms (编译 {statistics['compile_cpu_ms']:,} ms)")
+        print(f"  逻辑读取: {statistics['logical_reads']:,}, 物理读取: {statistics['physical_reads']:,}")
+        print_table_ranking(statistics['tables'], top=5)
 
         return {
             'success': True,
             'elapsed': elapsed,
-            'row_count': row_count
+            'row_count': row_count,
+            'drain': drained,
+            'binding': binding,
+            'compile_ms': statistics['compile_elapsed_ms'],
+            'execute_ms': statistics['elapsed_ms'],
+            'plan_cache_hit': plan_cache_hit,
+            'plan_usecount': usecount_after,
+            'statistics': statistics
         }
 
     except Exception as e:
@@ -104,7 +136,8 @@ def test_query_performance(conn, sql, description, params):
         return {
             'success': False,
             'elapsed': elapsed,
-            'error': str(e)
+            'error': str(e),
+            'statistics': parse_messages(messages_from_error(e), exec_call=(binding == 'sp_executesql'))
         }
 
 def main():
@@ -181,7 +214,8 @@ WHERE mt.TenantId=@TenantID
   AND mt.SiteDate < DATEADD(DAY, 1, @ReportDate)
 """
 
-        result_original_part1 = test_query_performance(conn, original_sql_part1, "原始SQL - 生产数据", test_params)
+        result_original_part1 = test_query_performance(conn, original_sql_part1, "原始SQL - 生产数据", test_params,
+                                                       binding=QUERY_BINDING, param_types=PARAM_TYPES)
 
         # ==========================================
         # 测试2：优化SQL - 第一部分（使用CTE）
@@ -235,7 +269,8 @@ SELECT
 FROM ProductionBaseData
 """
 
-        result_optimized_part1 = test_query_performance(conn, optimized_sql_part1, "优化SQL - 生产数据（CTE）", test_params)
+        result_optimized_part1 = test_query_performance(conn, optimized_sql_part1, "优化SQL - 生产数据（CTE）", test_params,
+                                                        binding=QUERY_BINDING, param_types=PARAM_TYPES)
 
         # ==========================================
         # 测试3：原始SQL - 第二部分（称重数据）
@@ -278,7 +313,8 @@ WHERE Shipping.isDeleted = 0
   AND Delivering.isDeleted=0
 """
 
-        result_original_part2 = test_query_performance(conn, original_sql_part2, "原始SQL - 称重数据", test_params)
+        result_original_part2 = test_query_performance(conn, original_sql_part2, "原始SQL - 称重数据", test_params,
+                                                       binding=QUERY_BINDING, param_types=PARAM_TYPES)
 
         # ==========================================
         # 性能对比总结
@@ -327,8 +363,17 @@ WHERE Shipping.isDeleted = 0
             print(f"  原始: {result_original_part1.get('row_count', 0):,}")
             print(f"  优化: {result_optimized_part1.get('row_count', 0):,}")
 
+        # 写入路径测试：conn 为 autocommit=False，每次写入后回滚
+        write_report = None
+        if WRITE_BENCHMARK:
+            print(f"\n{'='*80}")
+            print("写入路径测试 - 实际INSERT（事务内执行，始终回滚）")
+            print(f"{'='*80}")
+            write_params = dict(test_params, ReportDate=datetime.strptime(test_params['ReportDate'], '%Y-%m-%d'))
+            write_report = sweep_write_strategies(conn, write_params, batch_sizes=WRITE_BATCH_SIZES)
+
         # 生成报告
-        generate_performance_report(results, test_params)
+        generate_performance_report(results, test_params, write_report)
 
     except Exception as e:
         print(f"\n执行过程中发生错误: {str(e)}")
@@ -341,7 +386,7 @@ WHERE Shipping.isDeleted = 0
         print(f"完成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print(f"{'='*80}\n")
 
-def generate_performance_report(results, test_params):
+def generate_performance_report(results, test_params, write_report=None):
     """生成详细的性能测试报告"""
 
     orig1 = results.get('original_part1', {})
@@ -352,7 +397,7 @@ def generate_performance_report(results, test_params):
 
 **测试时间:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 **数据库:** Statistics-CT-test, logistics-test, Weighbridge-test
-**测试方法:** SELECT查询测试（未实际INSERT）
+**测试方法:** {'SELECT查询测试 + 实际INSERT写入测试（事务内执行，已回滚）' if write_report else 'SELECT查询测试（未实际INSERT）'}
 **测试参数:**
 - @Creator = {test_params['Creator']}
 - @TenantID = {test_params['TenantID']}
@@ -394,6 +439,28 @@ def generate_performance_report(results, test_params):
         orig2_rows = orig2['row_count']
         report_content += f"| **原始SQL** | {orig2_time:.3f}秒 | {orig2_rows:,} |\n"
 
+    if write_report:
+        report_content += """
+### 写入路径：实际INSERT（事务内执行，已回滚）
+
+| 写入方式 | 批大小 | 写入行数 | 中位耗时 | 行/秒 | 日志字节 | 锁数量 | 锁升级 |
+|---------|-------|---------|---------|-------|---------|-------|-------|
+"""
+        for item in write_report['results']:
+            batch = f"{item['batch_size']:,}" if item['batch_size'] else '整体'
+            if item.get('rows_per_s') is None and item.get('error'):
+                report_content += f"| {item['strategy']} | {batch} | 失败: {item['error']} | | | | | |\n"
+                continue
+            report_content += (f"| {item['strategy']} | {batch} | {item['rows']:,} | {item['median_ms']:,.1f} ms | "
+                               f"{item['rows_per_s'] or 0:,.0f} | {item['log_bytes']:,} | {item['lock_count']:,} | "
+                               f"{'是' if item['escalated'] else '否'} |\n")
+        if write_report['stage']:
+            report_content += f"\n源数据暂存: {write_report['stage']['rows']:,} 行, {write_report['stage']['elapsed_ms']:,.1f} ms（不计入分批写入耗时）\n"
+        best = write_report['recommended']
+        if best:
+            batch = f"批大小 {best['batch_size']:,}" if best['batch_size'] else '整体写入'
+            report_content += f"\n**推荐写入方式:** {best['strategy']}（{batch}），{best['rows_per_s']:,.0f} 行/秒\n"
+
     report_content += f"""
 ---
 
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+存储过程计时引擎
+基于 perf_counter 计时，支持预热轮次、冷缓存/热缓存模式，
+输出 p50/p90/p99、标准差、置信区间和离群值标记，
+报告格式与 performance_test_report_*.json 保持一致
+"""
+
+import json
+import math
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+from blocking_sampler import BlockingSampler, print_summary as print_blocking_summary
+from db_connection import connect
+from dmv_snapshot import diff_snapshots, split_server_time, take_snapshot
+from parallel_runner import build_exec_statement
+from query_watchdog import StatementWatchdog, timeout_message
+from results_store import ResultsStore, record_report
+from showplan import diff_summaries, drain_with_plans, print_diff, summarize_plans
+from statistics_parser import drain_with_messages, messages_from_error, parse_messages, print_table_ranking, rank_tables
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+
+CACHE_MODES = ('warm', 'cold')
+
+# 双侧95%置信区间的t分布临界值 (自由度1-30)，超出后近似为正态分布
+T_CRITICAL_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042
+]
+
+
+def clear_cache(conn):
+    """清空数据缓存和执行计划缓存(需要sysadmin权限)，用于冷启动测试"""
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    cursor = conn.cursor()
+    try:
+        cursor.execute("CHECKPOINT")
+        cursor.execute("DBCC DROPCLEANBUFFERS WITH NO_INFOMSGS")
+        cursor.execute("DBCC FREEPROCCACHE WITH NO_INFOMSGS")
+    finally:
+        cursor.close()
+        conn.autocommit = autocommit
+
+
+def set_statistics(conn, enabled, xml=False):
+    """开关 SET STATISTICS IO/TIME(以及可选的 STATISTICS XML)"""
+    state = 'ON' if enabled else 'OFF'
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SET STATISTICS IO {state}; SET STATISTICS TIME {state};")
+        if xml:
+            cursor.execute(f"SET STATISTICS XML {state}")
+    finally:
+        cursor.close()
+
+
+def run_round(conn, sp_name, params=None, round_no=1, collect_statistics=True, collect_dmv=False,
+              collect_plan=False, rollback=False, timeout_ms=None):
+    """
+    执行一轮存储过程并计时，返回单轮结果(可附带IO/TIME统计、DMV差值和实际执行计划汇总)
+
+    rollback: 执行成功后回滚而不是提交，用于不应修改数据的探测执行
+    timeout_ms: 单轮时间预算，超出后由看门狗取消执行并回滚，该轮记为超时(保留已收到的部分统计)
+    """
+    sql, values = build_exec_statement(sp_name, params)
+    result = {'round': round_no}
+
+    if collect_dmv:
+        before = take_snapshot(conn, sp_name)
+    if collect_statistics or collect_plan:
+        set_statistics(conn, True, xml=collect_plan)
+
+    plans = []
+    messages = []
+    cursor = conn.cursor()
+    watchdog = StatementWatchdog(cursor, timeout_ms)
+    start_time = datetime.now()
+    start = time.perf_counter()
+    try:
+        with watchdog:
+            cursor.execute(sql, *values)
+            if collect_plan:
+                plans = drain_with_plans(cursor, messages)
+            else:
+                drain_with_messages(cursor, messages)
+        result['duration_ms'] = (time.perf_counter() - start) * 1000
+        result['success'] = True
+        if rollback:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception as e:
+        result['duration_ms'] = (time.perf_counter() - start) * 1000
+        result['success'] = False
+        if watchdog.fired:
+            result['timed_out'] = True
+            result['error'] = timeout_message(watchdog.fired_at_ms)
+        else:
+            result['error'] = str(e)
+        messages.extend(messages_from_error(e))
+        conn.rollback()
+    finally:
+        cursor.close()
+
+    result['start_time'] = start_time.isoformat()
+    result['end_time'] = datetime.now().isoformat()
+
+    if collect_statistics or collect_plan:
+        set_statistics(conn, False, xml=collect_plan)
+    if collect_statistics:
+        result['io_time'] = parse_messages(messages, exec_call=True)
+    if collect_plan:
+        result['plan_summary'] = summarize_plans(plans)
+    if collect_dmv:
+        result['server'] = diff_snapshots(before, take_snapshot(conn, sp_name))
+        result['transport_ms'] = split_server_time(result['duration_ms'], result['server'])
+
+    return result
+
+
+def percentile(sorted_values, pct):
+    """线性插值百分位数，sorted_values 须已升序排列"""
+    if not sorted_values:
+        return None
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+
+    rank = (len(sorted_values) - 1) * pct / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    weight = rank - lower
+    return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+
+
+def find_outliers(values, k=1.5):
+    """按Tukey四分位距规则返回离群值的下标集合(样本少于4个时不判定)"""
+    if len(values) < 4:
+        return set()
+
+    ordered = sorted(values)
+    q1 = percentile(ordered, 25)
+    q3 = percentile(ordered, 75)
+    iqr = q3 - q1
+    low, high = q1 - k * iqr, q3 + k * iqr
+    return {i for i, v in enumerate(values) if v < low or v > high}
+
+
+def compute_statistics(results):
+    """计算统计指标；保留原报告字段，并补充百分位、置信区间和离群值"""
+    durations = [r['duration_ms'] for r in results if r['success']]
+    failed_count = sum(1 for r in results if not r['success'])
+
+    if not durations:
+        return None
+
+    n = len(durations)
+    ordered = sorted(durations)
+    mean = sum(durations) / n
+    variance = sum((d - mean) ** 2 for d in durations) / n
+    sample_std = math.sqrt(sum((d - mean) ** 2 for d in durations) / (n - 1)) if n > 1 else 0.0
+
+    if n > 1:
+        t = T_CRITICAL_95[n - 2] if n - 1 <= len(T_CRITICAL_95) else 1.96
+        margin = t * sample_std / math.sqrt(n)
+    else:
+        margin = 0.0
+
+    outliers = find_outliers(durations)
+    io_rounds = [r['io_time'] for r in results if r['success'] and r.get('io_time')]
+
+    return {
+        'count': n,
+        'failed_count': failed_count,
+        'timeout_count': sum(1 for r in results if r.get('timed_out')),
+        'avg_ms': mean,
+        'min_ms': ordered[0],
+        'max_ms': ordered[-1],
+        'total_ms': sum(durations),
+        'std_dev': math.sqrt(variance),
+        'sample_std_dev': sample_std,
+        'p50_ms': percentile(ordered, 50),
+        'p90_ms': percentile(ordered, 90),
+        'p99_ms': percentile(ordered, 99),
+        'ci95_low_ms': mean - margin,
+        'ci95_high_ms': mean + margin,
+        'outlier_count': len(outliers),
+        'cpu_time_ms': sum(io['cpu_ms'] for io in io_rounds) / len(io_rounds) if io_rounds else None,
+        'logical_reads': sum(io['logical_reads'] for io in io_rounds) / len(io_rounds) if io_rounds else None,
+        'physical_reads': sum(io['physical_reads'] for io in io_rounds) / len(io_rounds) if io_rounds else None
+    }
+
+
+def benchmark_procedure(conn, sp_name, params=None, rounds=5, warmup=1, cache_mode='warm',
+                        collect_statistics=True, collect_dmv=False, collect_plan=False, timeout_ms=None,
+                        sampler=None):
+    """
+    测试单个存储过程
+
+    warmup: 预热轮次(不计入统计)，仅在热缓存模式下生效
+    cache_mode: 'warm' 热缓存；'cold' 每轮执行前清空数据缓存和计划缓存
+    collect_dmv: 每轮前后抓取DMV快照，区分服务器耗时与传输耗时
+    collect_plan: 开启 STATISTICS XML 采集实际执行计划(会增加执行开销，计时仅供参考)
+    timeout_ms: 每轮时间预算；某轮超时后不再执行剩余轮次，整体耗时有上界
+    sampler: 正在运行的 BlockingSampler，各轮执行期间的阻塞/等待采样会标记为该存储过程和轮次
+    """
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"未知的缓存模式: {cache_mode}")
+
+    print(f"\n[*] 测试 {sp_name} ({cache_mode} 模式, 预热 {warmup if cache_mode == 'warm' else 0} 轮, 测试 {rounds} 轮)...")
+
+    if sampler is not None:
+        sampler.watch_session(conn, sp_name)
+
+    def tagged(round_no):
+        return sampler.active(sp_name, round_no) if sampler is not None else nullcontext()
+
+    results = []
+    if cache_mode == 'warm':
+        for i in range(warmup):
+            with tagged(0):
+                warm = run_round(conn, sp_name, params, round_no=0, collect_statistics=False, timeout_ms=timeout_ms)
+            if warm.get('timed_out'):
+                # 预热即超时，记录该轮后直接结束
+                print(f"  预热 {i+1}: {warm['error']}，跳过剩余轮次")
+                results.append(warm)
+                rounds = 0
+                break
+            print(f"  预热 {i+1}: {warm['duration_ms']:.0f} ms")
+
+    for i in range(rounds):
+        if cache_mode == 'cold':
+            clear_cache(conn)
+
+        with tagged(i + 1):
+            result = run_round(conn, sp_name, params, round_no=i + 1,
+                               collect_statistics=collect_statistics, collect_dmv=collect_dmv,
+                               collect_plan=collect_plan, timeout_ms=timeout_ms)
+        results.append(result)
+
+        if result['success'] and result.get('transport_ms') is not None:
+            server = result['server']
+            print(f"  第 {i+1} 轮: {result['duration_ms']:.0f} ms (服务器 {server['elapsed_ms']:.0f} ms, "
+                  f"CPU {server['worker_time_ms']:.0f} ms, 等待 {server['wait_time_ms']:.0f} ms, 传输 {result['transport_ms']:.0f} ms)")
+        elif result['success']:
+            print(f"  第 {i+1} 轮: {result['duration_ms']:.0f} ms")
+        elif result.get('timed_out'):
+            print(f"  第 {i+1} 轮: {result['error']}，跳过剩余轮次")
+            break
+        else:
+            print(f"  第 {i+1} 轮执行出错: {result['error']}")
+
+    # 在成功轮次上标记离群值
+    succeeded = [r for r in results if r['success']]
+    outliers = find_outliers([r['duration_ms'] for r in succeeded])
+    for index, result in enumerate(succeeded):
+        result['outlier'] = index in outliers
+
+    statistics = compute_statistics(results)
+    if statistics:
+        print(f"[+] p50: {statistics['p50_ms']:.0f} ms, p90: {statistics['p90_ms']:.0f} ms, "
+              f"p99: {statistics['p99_ms']:.0f} ms, 95%CI: [{statistics['ci95_low_ms']:.0f}, {statistics['ci95_high_ms']:.0f}] ms")
+    else:
+        print("[-] 所有测试均失败")
+
+    io_tables = rank_tables([r.get('io_time') for r in results])
+    if collect_statistics:
+        print("[+] 各表IO排行 (所有轮次累计):")
+        print_table_ranking(io_tables)
+
+    return {
+        'cache_mode': cache_mode,
+        'warmup_rounds': warmup if cache_mode == 'warm' else 0,
+        'results': results,
+        'statistics': statistics,
+        'io_tables': io_tables
+    }
+
+
+def compare_procedures(conn, original, optimized, params=None, rounds=5, warmup=1,
+                       cache_mode='warm', database=DEFAULT_DATABASE, collect_dmv=False, collect_plan=False,
+                       timeout_ms=None, sampler=None):
+    """对比原始与优化后的存储过程，返回与现有JSON报告相同结构的结果"""
+    report = {
+        'test_date': datetime.now().isoformat(),
+        'database': database,
+        'test_rounds': rounds,
+        'original': benchmark_procedure(conn, original, params, rounds, warmup, cache_mode,
+                                        collect_dmv=collect_dmv, collect_plan=collect_plan, timeout_ms=timeout_ms, sampler=sampler),
+        'optimized': benchmark_procedure(conn, optimized, params, rounds, warmup, cache_mode,
+                                         collect_dmv=collect_dmv, collect_plan=collect_plan, timeout_ms=timeout_ms, sampler=sampler)
+    }
+
+    if collect_plan and report['original']['results'] and report['optimized']['results']:
+        # 以各自最后一轮的计划做并排对比
+        before = report['original']['results'][-1].get('plan_summary')
+        after = report['optimized']['results'][-1].get('plan_summary')
+        if before and after:
+            report['plan_diff'] = diff_summaries(before, after)
+            print("\n[+] 执行计划对比:")
+            print_diff(report['plan_diff'])
+
+    return report
+
+
+def save_report(report, output_file=None):
+    """保存测试报告"""
+    if output_file is None:
+        output_file = f"performance_test_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[+] 报告已保存到: {output_file}")
+    return output_file
+
+
+def main():
+    """主函数"""
+    original = 'dbo.usp_UpdateProjectRiskRelationInfo'
+    optimized = 'dbo.usp_UpdateProjectRiskRelationInfo_Optimized'
+
+    print("=" * 60)
+    print(f"存储过程性能对比: {original}")
+    print("=" * 60)
+
+    sampler = BlockingSampler(interval_ms=500)
+    sampler.start()
+    conn = connect(DEFAULT_DATABASE)
+    try:
+        report = compare_procedures(conn, original, optimized, rounds=5, warmup=1, cache_mode='warm',
+                                    collect_dmv=True, sampler=sampler)
+        # 每轮结果同时写入历史库，供 results_store.py 做回退检查
+        with ResultsStore() as store:
+            run_ids = record_report(store, conn, report, original, optimized)
+        print(f"[+] 已写入历史库: 原始 #{run_ids['original']}, 优化 #{run_ids['optimized']}")
+    finally:
+        conn.close()
+        sampler.stop()
+
+    report['blocking'] = sampler.summarize()
+    print_blocking_summary(report['blocking'])
+    save_report(report)
+
+
+if __name__ == "__main__":
+    main()
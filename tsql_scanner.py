@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+T-SQL 反模式静态扫描
+基于词法切分(正确跳过注释和字符串)扫描存储过程定义，标记游标、不可走索引的谓词、
+四段名跨服务器引用、标量/表值函数调用、SELECT * INTO 临时表和无条件 DELETE，
+给出行号和严重度得分；本地 *_definition.sql / *_Optimized.sql 与线上定义并行扫描
+"""
+
+import glob
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from analyze_usp_GenerateWorkbenchKanban_Business import get_sp_definition
+from db_connection import connect
+
+DEFAULT_DATABASE = 'Statistics-CT-test'
+FILE_PATTERNS = ('**/*_definition.sql', '**/*_Optimized.sql')
+
+# 各规则的严重度(1-10)，文件/存储过程得分为命中规则的严重度之和
+RULES = {
+    'cursor': (8, '游标逐行处理'),
+    'non_sargable': (6, '谓词中对列套函数，无法使用索引查找'),
+    'leading_wildcard': (5, "LIKE 以 '%' 开头，无法使用索引查找"),
+    'four_part_name': (7, '四段名跨服务器引用'),
+    'scalar_udf': (7, '标量函数调用(逐行执行，阻止并行)'),
+    'table_udf': (4, '表值函数调用(多语句表值函数按固定行数估算)'),
+    'select_star_into_temp': (5, 'SELECT * INTO 临时表'),
+    'delete_all': (8, '无 WHERE 条件的 DELETE'),
+    'delete_all_temp': (3, '无 WHERE 条件的 DELETE 临时表(可用 TRUNCATE)')
+}
+
+_PART = r'(?:\[[^\]]*(?:\]\][^\]]*)*\]|"[^"]*"|[^\W\d][\w$@#]*)'
+_TOKEN_RE = re.compile(rf"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>N?'(?:[^']|'')*')
+  | (?P<name>(?:@@?|\#\#?)?{_PART}(?:\.(?:{_PART})?)*)
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<op><>|!=|>=|<=|[(),;=<>+\-*/%.])
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.S | re.X)
+
+_PART_RE = re.compile(rf'\.|{_PART}')
+
+# 常作为谓词一侧包裹列的内置函数
+_PREDICATE_FUNCTIONS = {
+    'ISNULL', 'COALESCE', 'CONVERT', 'CAST', 'TRY_CONVERT', 'TRY_CAST', 'DATEADD', 'DATEDIFF', 'DATEPART',
+    'DATENAME', 'YEAR', 'MONTH', 'DAY', 'UPPER', 'LOWER', 'LTRIM', 'RTRIM', 'TRIM', 'SUBSTRING', 'LEFT',
+    'RIGHT', 'LEN', 'ABS', 'REPLACE', 'FORMAT', 'EOMONTH'
+}
+# 函数参数中不是列引用的标识符：日期部分、数据类型和关键字
+_NON_COLUMN_WORDS = {
+    'YEAR', 'YY', 'YYYY', 'QUARTER', 'QQ', 'Q', 'MONTH', 'MM', 'M', 'DAYOFYEAR', 'DY', 'Y', 'DAY', 'DD', 'D',
+    'WEEK', 'WK', 'WW', 'WEEKDAY', 'DW', 'HOUR', 'HH', 'MINUTE', 'MI', 'N', 'SECOND', 'SS', 'S', 'MILLISECOND',
+    'MS', 'AS', 'NULL', 'INT', 'BIGINT', 'SMALLINT', 'TINYINT', 'BIT', 'DECIMAL', 'NUMERIC', 'FLOAT', 'REAL',
+    'MONEY', 'DATE', 'DATETIME', 'DATETIME2', 'SMALLDATETIME', 'TIME', 'VARCHAR', 'NVARCHAR', 'CHAR', 'NCHAR',
+    'MAX', 'UNIQUEIDENTIFIER', 'GETDATE', 'SYSDATETIME', 'GETUTCDATE'
+}
+_COMPARISONS = {'=', '<', '>', '<=', '>=', '<>', '!=', 'LIKE', 'IN', 'BETWEEN'}
+_PREDICATE_CLAUSES = {'WHERE', 'ON', 'HAVING', 'AND', 'OR'}
+_OTHER_CLAUSES = {'SELECT', 'FROM', 'GROUP', 'ORDER', 'SET', 'INTO', 'VALUES', 'JOIN', 'APPLY', 'RETURN',
+                  'OUTPUT', 'WHEN', 'THEN', 'ELSE', 'CASE', 'DECLARE'}
+# 其后紧跟 schema.name( 时不是标量函数调用
+_NOT_CALL_CONTEXT = {'INSERT', 'INTO', 'FROM', 'JOIN', 'APPLY', 'UPDATE', 'TABLE', 'EXEC', 'EXECUTE', 'REFERENCES',
+                     'ON', 'PROCEDURE', 'PROC', 'FUNCTION', 'VIEW', 'TRIGGER', 'MERGE', 'USING', 'INDEX', 'TYPE'}
+# 在括号外出现即表示上一条语句已结束
+_STATEMENT_STARTS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'IF', 'WHILE', 'BEGIN', 'END', 'DECLARE', 'SET',
+                     'EXEC', 'EXECUTE', 'RETURN', 'TRUNCATE', 'DROP', 'CREATE', 'ALTER', 'WITH', 'MERGE', 'PRINT',
+                     'GO', 'ELSE', 'COMMIT', 'ROLLBACK', 'OPEN', 'CLOSE', 'FETCH', 'DEALLOCATE', 'RAISERROR',
+                     'THROW'}
+
+
+class Token:
+    __slots__ = ('kind', 'text', 'upper', 'line', 'start')
+
+    def __init__(self, kind, text, line, start=None):
+        self.kind = kind
+        self.text = text
+        self.upper = text.upper()
+        self.line = line
+        self.start = start
+
+    @property
+    def end(self):
+        return self.start + len(self.text)
+
+
+def tokenize(sql):
+    """切分为 Token 列表(丢弃空白和注释)，保留每个词所在行号和起始偏移"""
+    tokens, line = [], 1
+    for match in _TOKEN_RE.finditer(sql):
+        kind, text = match.lastgroup, match.group()
+        if kind not in ('space', 'comment'):
+            tokens.append(Token(kind, text, line, match.start()))
+        line += text.count('\n')
+    return tokens
+
+
+def name_parts(text):
+    """多段名拆成各段(去掉方括号/引号)"""
+    parts, current = [], ''
+    for token in _PART_RE.findall(text):
+        if token == '.':
+            parts.append(current)
+            current = ''
+        else:
+            current = token.strip('[]"')
+    parts.append(current)
+    return parts
+
+
+def matching_paren(tokens, start):
+    """tokens[start] 为 '('，返回与之匹配的 ')' 下标(未闭合时返回末尾)"""
+    depth = 0
+    for index in range(start, len(tokens)):
+        if tokens[index].text == '(':
+            depth += 1
+        elif tokens[index].text == ')':
+            depth -= 1
+            if depth == 0:
+                return index
+    return len(tokens) - 1
+
+
+def _is_column(token):
+    return (token.kind == 'name' and not token.text.startswith(('@', '#'))
+            and token.upper not in _NON_COLUMN_WORDS and token.upper not in _PREDICATE_FUNCTIONS)
+
+
+def _statement_end(tokens, start):
+    """从 start 起找到语句结束位置(分号或括号外的下一条语句关键字)"""
+    depth = 0
+    for index in range(start, len(tokens)):
+        token = tokens[index]
+        if token.text == '(':
+            depth += 1
+        elif token.text == ')':
+            depth -= 1
+            if depth < 0:
+                return index
+        elif depth == 0 and (token.text == ';' or token.upper in _STATEMENT_STARTS):
+            return index
+    return len(tokens)
+
+
+def clause_states(tokens):
+    """每个词所处的子句类型('predicate'/'other')，按括号层级分别跟踪"""
+    states, stack, current = [], [], 'other'
+    for token in tokens:
+        if token.text == '(':
+            stack.append(current)
+        elif token.text == ')':
+            current = stack.pop() if stack else 'other'
+        elif token.upper in _PREDICATE_CLAUSES:
+            current = 'predicate'
+        elif token.upper in _OTHER_CLAUSES or token.upper in _STATEMENT_STARTS:
+            current = 'other'
+        states.append(current)
+    return states
+
+
+def scan_tokens(tokens):
+    """在词序列上运行全部规则，返回 [{'rule', 'line', 'severity', 'detail'}]"""
+    findings = []
+    states = clause_states(tokens)
+
+    def add(rule, token, detail):
+        findings.append({'rule': rule, 'line': token.line, 'severity': RULES[rule][0], 'detail': detail})
+
+    for index, token in enumerate(tokens):
+        previous = tokens[index - 1] if index else None
+        following = tokens[index + 1] if index + 1 < len(tokens) else None
+
+        # 游标：DECLARE x [选项] CURSOR
+        window = tokens[max(0, index - 6):index]
+        if token.upper == 'CURSOR' and any(t.upper == 'DECLARE' for t in window):
+            declare = max(i for i, t in enumerate(window) if t.upper == 'DECLARE')
+            name = window[declare + 1].text if declare + 1 < len(window) else ''
+            add('cursor', token, f"DECLARE {name} CURSOR")
+
+        elif token.kind == 'name' and following is not None and following.text == '(' \
+                and token.upper in _PREDICATE_FUNCTIONS and states[index] == 'predicate':
+            close = matching_paren(tokens, index + 1)
+            columns = [t.text for t in tokens[index + 2:close] if _is_column(t)]
+            after = tokens[close + 1] if close + 1 < len(tokens) else None
+            compared = (after is not None and (after.upper in _COMPARISONS or after.upper == 'IS')) or \
+                (previous is not None and previous.upper in _COMPARISONS)
+            if columns and compared:
+                add('non_sargable', token, f"{token.upper}({', '.join(columns[:3])})")
+
+        elif token.kind == 'string' and previous is not None and previous.upper == 'LIKE' \
+                and token.text.lstrip('Nn').startswith("'%"):
+            add('leading_wildcard', token, f"LIKE {token.text[:30]}")
+
+        if token.kind == 'name' and '.' in token.text and not token.text.startswith(('@', '#')):
+            parts = name_parts(token.text)
+            if len(parts) >= 4 and parts[1]:
+                add('four_part_name', token, '.'.join(parts[:4]))
+            elif len(parts) in (2, 3) and following is not None and following.text == '(' \
+                    and (previous is None or previous.upper not in _NOT_CALL_CONTEXT):
+                add('scalar_udf', token, token.text)
+            elif len(parts) in (2, 3) and following is not None and following.text == '(' \
+                    and previous is not None and previous.upper in ('FROM', 'JOIN', 'APPLY'):
+                add('table_udf', token, token.text)
+
+        if token.upper == 'SELECT':
+            cursor = index + 1
+            while cursor < len(tokens) and tokens[cursor].upper in ('DISTINCT', 'TOP', 'ALL'):
+                if tokens[cursor].upper == 'TOP':
+                    cursor += 1
+                    if cursor < len(tokens) and tokens[cursor].text == '(':
+                        cursor = matching_paren(tokens, cursor)
+                    if cursor + 1 < len(tokens) and tokens[cursor + 1].upper == 'PERCENT':
+                        cursor += 1
+                cursor += 1
+            star = cursor < len(tokens) and (tokens[cursor].text == '*' or
+                                             (tokens[cursor].text.endswith('.') and cursor + 1 < len(tokens)
+                                              and tokens[cursor + 1].text == '*'))
+            if star:
+                into = cursor + (1 if tokens[cursor].text == '*' else 2)
+                if into + 1 < len(tokens) and tokens[into].upper == 'INTO' and tokens[into + 1].text.startswith('#'):
+                    add('select_star_into_temp', token, f"SELECT * INTO {tokens[into + 1].text}")
+
+        if token.upper == 'DELETE':
+            end = _statement_end(tokens, index + 1)
+            body = tokens[index + 1:end]
+            if not any(t.upper in ('WHERE', 'TOP', 'JOIN', 'CURRENT') for t in body):
+                target = next((t.text for t in body if t.kind == 'name' and t.upper != 'FROM'), '')
+                rule = 'delete_all_temp' if target.startswith(('#', '@')) else 'delete_all'
+                add(rule, token, f"DELETE {target}")
+
+    return findings
+
+
+def scan_text(sql, source=None):
+    """扫描一段 SQL 文本，返回 {'source', 'lines', 'score', 'findings'}"""
+    findings = scan_tokens(tokenize(sql))
+    lines = sql.splitlines()
+    for finding in findings:
+        text = lines[finding['line'] - 1] if 0 < finding['line'] <= len(lines) else ''
+        finding['snippet'] = ' '.join(text.split())[:160]
+    return {
+        'source': source,
+        'lines': len(lines),
+        'score': sum(f['severity'] for f in findings),
+        'counts': {rule: sum(1 for f in findings if f['rule'] == rule) for rule in RULES
+                   if any(f['rule'] == rule for f in findings)},
+        'findings': findings
+    }
+
+
+def scan_file(path):
+    with open(path, encoding='utf-8-sig', errors='replace') as f:
+        return scan_text(f.read(), path)
+
+
+def find_definition_files(root='.'):
+    paths = set()
+    for pattern in FILE_PATTERNS:
+        paths.update(glob.glob(os.path.join(root, pattern), recursive=True))
+    return sorted(paths)
+
+
+def fetch_live_definitions(conn, procedures=None):
+    """通过 get_sp_definition 拉取线上定义，procedures 为空时取全部用户存储过程"""
+    from sp_sweep import list_procedures  # sp_sweep 依赖本模块的 tokenize，延迟导入避免循环
+
+    names = procedures or [p['procedure'] for p in list_procedures(conn)]
+    definitions = {}
+    for name in names:
+        definition = get_sp_definition(conn, name)
+        if definition:
+            definitions[name] = definition
+    return definitions
+
+
+def _scan_item(item):
+    source, sql = item
+    return scan_text(sql, source)
+
+
+def scan_all(paths=None, definitions=None, max_workers=None):
+    """
+    并行扫描文件和线上定义(多进程，词法扫描为纯CPU计算)
+
+    definitions: {存储过程名: 定义文本}；返回按得分降序的结果列表
+    """
+    paths = find_definition_files() if paths is None else paths
+    items = []
+    for path in paths:
+        with open(path, encoding='utf-8-sig', errors='replace') as f:
+            items.append((path, f.read()))
+    items.extend((f"[live] {name}", sql) for name, sql in (definitions or {}).items())
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_scan_item, items, chunksize=4))
+    return sorted(results, key=lambda r: -r['score'])
+
+
+def format_report(results, top_findings=20):
+    """生成Markdown格式的扫描报告"""
+    lines = [
+        '## T-SQL 反模式扫描',
+        '',
+        f"扫描时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}，共 {len(results)} 个定义",
+        '',
+        '| 排名 | 来源 | 行数 | 得分 | ' + ' | '.join(RULES) + ' |',
+        '|------|------|-----:|-----:|' + '---:|' * len(RULES)
+    ]
+    for rank, result in enumerate(results, 1):
+        counts = ' | '.join(str(result['counts'].get(rule, '')) for rule in RULES)
+        lines.append(f"| {rank} | {result['source']} | {result['lines']:,} | {result['score']} | {counts} |")
+
+    lines += ['', '### 规则说明', '']
+    lines += [f"- `{rule}` (严重度 {severity}): {description}" for rule, (severity, description) in RULES.items()]
+
+    for result in results:
+        if not result['findings']:
+            continue
+        lines += ['', f"### {result['source']} (得分 {result['score']})", '']
+        ordered = sorted(result['findings'], key=lambda f: (-f['severity'], f['line']))
+        for finding in ordered[:top_findings]:
+            lines.append(f"- 第 {finding['line']} 行 `{finding['rule']}` ({finding['severity']}): "
+                         f"{finding['detail']} — `{finding['snippet']}`")
+        if len(ordered) > top_findings:
+            lines.append(f"- ... 另有 {len(ordered) - top_findings} 处")
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    print("=" * 60)
+    print("T-SQL 反模式静态扫描")
+    print("=" * 60)
+
+    paths = find_definition_files()
+    print(f"[*] 本地定义文件 {len(paths)} 个")
+
+    definitions = {}
+    try:
+        conn = connect(DEFAULT_DATABASE)
+        try:
+            definitions = fetch_live_definitions(conn)
+            print(f"[+] 线上存储过程定义 {len(definitions)} 个")
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[-] 无法获取线上定义，只扫描本地文件: {e}")
+
+    results = scan_all(paths, definitions)
+    for result in results[:10]:
+        print(f"  {result['score']:>5}  {result['source']}  {result['counts']}")
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    with open(f"antipattern_scan_{timestamp}.json", 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    with open(f"T-SQL反模式扫描_{timestamp}.md", 'w', encoding='utf-8') as f:
+        f.write(format_report(results))
+    print(f"[+] 报告已保存: T-SQL反模式扫描_{timestamp}.md")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,8 @@
-import pyodbc
 import time
 
-server = '127.0.0.1,5433'
-username = 'sa'
-password = '123456'
+from db_connection import connect
+from row_drain import drain_rows
+
 database = 'Statistics-CT-test'
 
 print("=" * 100)
@@ -12,16 +11,11 @@ print("=" * 100)
 print()
 
 try:
-    drivers = ['ODBC Driver 18 for SQL Server', 'ODBC Driver 17 for SQL Server', 'SQL Server']
-    conn = None
-    for driver in drivers:
-        try:
-            conn_str = f'DRIVER={{{driver}}};SERVER={server};DATABASE={database};UID={username};PWD={password};TrustServerCertificate=yes'
-            conn = pyodbc.connect(conn_str, timeout=60)
-            print(f"[OK] 已连接到数据库\n")
-            break
-        except:
-            continue
+    try:
+        conn = connect(database, timeout=60)
+        print(f"[OK] 已连接到数据库\n")
+    except Exception:
+        conn = None
 
     if not conn:
         print("[ERROR] 无法连接数据库")
@@ -72,12 +66,14 @@ try:
     while cursor.nextset():
         pass
     cursor.execute("SELECT * FROM #TempData")
-    rows = cursor.fetchall()
+    drained = drain_rows(cursor, 'fetchmany', sample=10)
+    rows = drained['sample']
+    row_count = drained['row_count']
     time_with_cross = (time.time() - start_time) * 1000
 
     print(f"[OK] 执行完成")
     print(f"  执行时间: {time_with_cross:.2f} ms ({time_with_cross/1000:.2f} 秒)")
-    print(f"  返回行数: {len(rows)}")
+    print(f"  返回行数: {row_count} (排空策略: {drained['strategy']})")
 
     # 检查是否真的有跨库数据
     cross_db_data_count = 0
@@ -127,12 +123,12 @@ try:
     while cursor.nextset():
         pass
     cursor.execute("SELECT * FROM #TempData2")
-    rows2 = cursor.fetchall()
+    row_count2 = drain_rows(cursor, 'fetchmany')['row_count']
     time_without_cross = (time.time() - start_time) * 1000
 
     print(f"[OK] 执行完成")
     print(f"  执行时间: {time_without_cross:.2f} ms ({time_without_cross/1000:.2f} 秒)")
-    print(f"  返回行数: {len(rows2)}")
+    print(f"  返回行数: {row_count2}")
 
     # 对比分析
     print("\n\n【对比分析】")
@@ -177,7 +173,7 @@ try:
 
 **执行结果:**
 - 执行时间: **{time_with_cross:.2f} ms ({time_with_cross/1000:.2f} 秒)**
-- 返回行数: {len(rows)}
+- 返回行数: {row_count}
 - 跨库数据: 前10行中有 {cross_db_data_count} 行包含跨库数据
 
 ---
@@ -191,7 +187,7 @@ try:
 
 **执行结果:**
 - 执行时间: **{time_without_cross:.2f} ms ({time_without_cross/1000:.2f} 秒)**
-- 返回行数: {len(rows2)}
+- 返回行数: {row_count2}
 
 ---
 